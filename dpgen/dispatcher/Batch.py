@@ -1,10 +1,14 @@
-import os,sys,time
+import os,sys,time,shlex
 
 from dpgen.dispatcher.JobStatus import JobStatus
 from dpgen import dlog
 
 
 class Batch(object) :
+    # the environment variable of the index of a job array element,
+    # None if the job array is not supported
+    array_index = None
+
     def __init__ (self,
                   context, 
                   uuid_names = False) :
@@ -17,9 +21,24 @@ class Batch(object) :
             self.finish_tag_name = 'tag_finished'
             self.sub_script_name = 'run.sub'
             self.job_id_name = 'job_id'
+        self.job_id = ''
 
     def check_status(self) :
         raise RuntimeError('abstract method check_status should be implemented by derived class')        
+
+    def release(self) :
+        """
+        release the local resources held by the job, if any
+        """
+        pass
+
+    @classmethod
+    def check_status_all(cls, batches) :
+        """
+        check the status of a list of jobs, return the list of status.
+        the derived class may query the scheduler once for all the jobs.
+        """
+        return [bb.check_status() for bb in batches]
         
     def default_resources(self, res) :
         raise RuntimeError('abstract method sub_script_head should be implemented by derived class')        
@@ -77,6 +96,8 @@ class Batch(object) :
             self.manual_gpu = res['manual_cuda_devices']
         except:
             self.manual_gpu = 0
+        if self.manual_gpu > 0 :
+            ret += self._gpu_slot_script(self.manual_gpu)
         for ii in range(len(cmd)):            
             # for one command
             ret += self._sub_script_inner(job_dirs,
@@ -117,6 +138,71 @@ class Batch(object) :
             self.do_submit(job_dirs, cmd, args, res, outlog=outlog, errlog=errlog)
         time.sleep(sleep) # For preventing the crash of the tasks while submitting        
 
+    def write_sub_script(self,
+                         job_dirs,
+                         cmd,
+                         args = None,
+                         res = None,
+                         outlog = 'log',
+                         errlog = 'err') :
+        """
+        write the submit script without submitting it, see submit_array
+        """
+        res = self.default_resources(res)
+        script_str = self.sub_script(job_dirs, cmd, args=args, res=res, outlog=outlog, errlog=errlog)
+        self.context.write_file(self.sub_script_name, script_str)
+
+    @classmethod
+    def submit_array(cls,
+                     batches,
+                     context,
+                     res = None,
+                     max_array_size = 1000) :
+        """
+        submit the written scripts of the batches as job arrays of at most
+        max_array_size elements, i.e. one scheduler call per array. The
+        array scripts are written in context. The job id of each batch is
+        the id of its array element, so it is checked and resubmitted as a
+        single job.
+        """
+        if cls.array_index is None :
+            raise RuntimeError('job array is not supported by %s' % cls.__name__)
+        if len(batches) == 0 :
+            return
+        res = batches[0].default_resources(res)
+        for start in range(0, len(batches), max_array_size) :
+            group = batches[start:start+max_array_size]
+            script_name = '%s.array.%d.sub' % (context.job_uuid, start // max_array_size)
+            ret = group[0].sub_script_head(res)
+            ret += 'dpgen_array_dirs=(\n'
+            ret += ''.join(['%s\n' % shlex.quote(bb.context.remote_root) for bb in group])
+            ret += ')\n'
+            ret += 'dpgen_array_subs=(\n'
+            ret += ''.join(['%s\n' % shlex.quote(bb.sub_script_name) for bb in group])
+            ret += ')\n\n'
+            ret += 'dpgen_idx=%s\n' % cls.array_index
+            ret += 'cd ${dpgen_array_dirs[$dpgen_idx]} || exit 1\n'
+            ret += 'bash ${dpgen_array_subs[$dpgen_idx]}\n'
+            context.write_file(script_name, ret)
+            job_ids = cls._submit_array_script(context, script_name, len(group), res)
+            assert(len(job_ids) == len(group))
+            for bb, job_id in zip(group, job_ids) :
+                bb.context.write_file(bb.job_id_name, job_id)
+                bb.job_id = job_id
+
+    @classmethod
+    def _submit_array_script(cls, context, script_name, nelem, res) :
+        """
+        submit the array script of nelem elements, return the job ids of the elements
+        """
+        raise RuntimeError('abstract method _submit_array_script should be implemented by derived class')
+
+    def _get_job_id(self) :
+        # the job id is cached, it only changes when the job is (re)submitted
+        if self.job_id == '' and self.context.check_file_exists(self.job_id_name) :
+            self.job_id = self.context.read_file(self.job_id_name)
+        return self.job_id
+
     def check_finish_tag(self) :
         return self.context.check_file_exists(self.finish_tag_name)
 
@@ -145,13 +231,45 @@ class Batch(object) :
                     ret += '  touch tag_%d_finished \n' % idx
                 ret += 'fi\n\n'
             else :
-                # do not support task-wise restart
-                tmp_cmd = ' %s 1>> %s 2>> %s ' % (self.sub_script_cmd(cmd, jj, res), outlog, errlog)
-                ret += 'CUDA_VISIBLE_DEVICES=%d %s &\n\n' % ((self.cmd_cnt % self.manual_gpu), tmp_cmd)
+                # the task starts on the first free GPU, the finish tag makes the restart task-wise
+                tmp_cmd = '%s 1>> %s 2>> %s' % (self.sub_script_cmd(cmd, jj, res), outlog, errlog)
+                if allow_failure is False:
+                    tmp_cmd += ' && touch tag_%d_finished' % idx
+                else :
+                    tmp_cmd += ' ; touch tag_%d_finished' % idx
+                ret += 'if [ ! -f tag_%d_finished ] ;then\n' % idx
+                ret += '  dpgen_wait_gpu\n'
+                ret += '  ( export CUDA_VISIBLE_DEVICES=$dpgen_free_gpu; %s ) &\n' % tmp_cmd
+                ret += '  dpgen_gpu_pids[$dpgen_free_gpu]=$!\n'
+                ret += 'fi\n\n'
                 self.cmd_cnt += 1
             ret += 'cd %s\n' % self.context.remote_root
             ret += 'test $? -ne 0 && exit\n'
-            if self.manual_gpu > 0 and self.cmd_cnt % self.manual_gpu == 0:
-                ret += '\nwait\n\n'
         ret += '\nwait\n\n'
+        if self.manual_gpu > 0 and allow_failure is False:
+            # the next command runs only if all the tasks of this one succeeded
+            for ii in job_dirs :
+                ret += 'test -f %s/tag_%d_finished || exit 1\n' % (ii, idx)
+            ret += '\n'
+        return ret
+
+    def _gpu_slot_script(self, ngpus) :
+        """
+        bash function dpgen_wait_gpu that waits until one of the ngpus GPUs
+        is free, and sets dpgen_free_gpu to it. dpgen_gpu_pids keeps the
+        process running on each GPU.
+        """
+        ret = '\ndpgen_gpu_pids=()\n'
+        ret += 'dpgen_wait_gpu() {\n'
+        ret += '  while true; do\n'
+        ret += '    for ((dpgen_gg=0; dpgen_gg<%d; dpgen_gg++)); do\n' % ngpus
+        ret += '      dpgen_pid=${dpgen_gpu_pids[$dpgen_gg]}\n'
+        ret += '      if [ -z "$dpgen_pid" ] || ! kill -0 $dpgen_pid 2>/dev/null; then\n'
+        ret += '        dpgen_free_gpu=$dpgen_gg\n'
+        ret += '        return\n'
+        ret += '      fi\n'
+        ret += '    done\n'
+        ret += '    sleep 1\n'
+        ret += '  done\n'
+        ret += '}\n\n'
         return ret
@@ -1,4 +1,4 @@
-import os,sys,time,random
+import os,sys,time,random,heapq,json
 
 from dpgen.dispatcher.LocalContext import LocalSession
 from dpgen.dispatcher.LocalContext import LocalContext
@@ -10,22 +10,45 @@ from dpgen.dispatcher.LSF import LSF
 from dpgen.dispatcher.PBS import PBS
 from dpgen.dispatcher.Shell import Shell
 from dpgen.dispatcher.JobStatus import JobStatus
+from dpgen.dispatcher.JobRecord import JobRecord
 from dpgen import dlog
 from hashlib import sha1
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from monty.serialization import dumpfn,loadfn
 
 
 def _split_tasks(tasks,
-                 group_size):
+                 group_size,
+                 task_costs = None):
+    """
+    split the tasks into ceil(ntasks / group_size) chunks.
+    without task_costs, the tasks are dealt to the chunks in a round-robin way.
+    with task_costs, each task, from the most expensive one, goes to the
+    chunk with the least total cost (longest processing time first). The
+    costs should not change at restart, otherwise the chunks are different.
+    """
     ntasks = len(tasks)
     ngroups = ntasks // group_size
     if ngroups * group_size < ntasks:
         ngroups += 1
     chunks = [[]] * ngroups
     tot = 0
-    for ii in range(ngroups) :
-        chunks[ii] = (tasks[ii::ngroups])
-        tot += len(chunks[ii])
+    if task_costs is None :
+        for ii in range(ngroups) :
+            chunks[ii] = (tasks[ii::ngroups])
+            tot += len(chunks[ii])
+    else :
+        assert(len(task_costs) == ntasks)
+        heap = [(0, ii) for ii in range(ngroups)]
+        chunk_idx = [[] for ii in range(ngroups)]
+        # stable order of the tasks with the same cost
+        for idx in sorted(range(ntasks), key = lambda kk: -task_costs[kk]) :
+            cost, ii = heapq.heappop(heap)
+            chunk_idx[ii].append(idx)
+            heapq.heappush(heap, (cost + task_costs[idx], ii))
+        for ii in range(ngroups) :
+            chunks[ii] = [tasks[jj] for jj in sorted(chunk_idx[ii])]
+            tot += len(chunks[ii])
     assert(tot == len(tasks))
     return chunks
 
@@ -60,6 +83,20 @@ class Dispatcher(object):
             self.batch = Shell
         else :
             raise RuntimeError('unknown batch ' + batch_type)
+        # adaptive polling of the job status
+        self.poll_interval = remote_profile.get('poll_interval', 10)
+        self.max_poll_interval = remote_profile.get('max_poll_interval', 60)
+        self.poll_backoff = remote_profile.get('poll_backoff', 1.5)
+        # number of chunks uploaded and submitted, or downloaded concurrently
+        self.submit_threads = remote_profile.get('submit_threads', 1)
+        # upload the common files once for all chunks, only useful for ssh
+        self.share_common_files = remote_profile.get('share_common_files', False) and context_type == 'ssh'
+        # submit the new chunks as job arrays
+        self.job_array = remote_profile.get('job_array', False)
+        self.max_array_size = remote_profile.get('max_array_size', 1000)
+        if self.job_array and self.batch.array_index is None :
+            dlog.info('job array is not supported by %s, the jobs are submitted one by one' % batch_type)
+            self.job_array = False
 
 
     def run_jobs(self,
@@ -73,66 +110,179 @@ class Dispatcher(object):
                  backward_task_files,
                  forward_task_deference = True,
                  outlog = 'log',
-                 errlog = 'err') :
+                 errlog = 'err',
+                 callback = None,
+                 backward_task_select = None,
+                 task_costs = None,
+                 chunk_resources = None) :
+        """
+        Run the tasks as chunks of jobs, and return when all jobs finish.
+
+        callback(function):     called as callback(chunk) once the backward
+                                files of a chunk are downloaded, chunk is the
+                                list of finished tasks. A queue.Queue.put can
+                                be passed to consume the chunks as a queue.
+        backward_task_select(function):
+                                called as backward_task_select(task_path) after
+                                the backward files are downloaded, returns the
+                                extra files of the task to download.
+        task_costs(list):       estimated cost of each task, the chunks are
+                                balanced by the costs if given.
+        chunk_resources(function):
+                                called as chunk_resources(chunk) before the
+                                chunk is uploaded, returns the resources of
+                                the job. resources is used if not given.
+        """
         # task_chunks = [
         #     [os.path.basename(j) for j in tasks[i:i + group_size]] \
         #     for i in range(0, len(tasks), group_size)
         # ]
-        task_chunks = _split_tasks(tasks, group_size)    
-        _pmap=PMap(work_path)
-        path_map=_pmap.load()
-        _fr = FinRecord(work_path, len(task_chunks))        
-
-        job_list = []
+        task_chunks = _split_tasks(tasks, group_size, task_costs)
+        work_path = os.path.abspath(work_path)
         task_chunks_=['+'.join(ii) for ii in task_chunks]
-        job_fin = _fr.get_record()
+        # map chunk info. to uniq id    
+        chunk_sha1s = [sha1(ii.encode('utf-8')).hexdigest() for ii in task_chunks_]
+        _jr = JobRecord(work_path)
+        records = _jr.load()
+        if len(records) == 0 :
+            # restart from the records of older versions
+            _fr = FinRecord(work_path, len(task_chunks))
+            _pmap = PMap(work_path)
+            if os.path.isfile(_fr.fname) or os.path.isfile(_pmap.f_path_map) :
+                _jr.import_legacy(chunk_sha1s, task_chunks_, _fr.get_record(), _pmap.load())
+                records = _jr.load()
+        job_fin = [ii in records and records[ii]['status'] == 'finished' for ii in chunk_sha1s]
         assert(len(job_fin) == len(task_chunks))
-        for ii,chunk in enumerate(task_chunks) :
-            if not job_fin[ii] :
-                # map chunk info. to uniq id    
-                chunk_sha1 = sha1(task_chunks_[ii].encode('utf-8')).hexdigest() 
-                # if hash in map, recover job, else start a new job
-                if chunk_sha1 in path_map:
-                    job_uuid = path_map[chunk_sha1][1].split('/')[-1]
-                    dlog.debug("load uuid %s for chunk %s" % (job_uuid, task_chunks_[ii]))
-                else:
-                    job_uuid = None
-                # communication context, bach system
-                context = self.context(work_path, self.session, job_uuid)
-                batch = self.batch(context, uuid_names = self.uuid_names)
-                rjob = {'context':context, 'batch':batch}
-                # upload files
-                if not rjob['context'].check_file_exists('tag_upload'):
+
+        # the common files are uploaded once and linked into each chunk
+        common_context = None
+        if self.share_common_files and len(forward_common_files) > 0 and not all(job_fin) :
+            common_sha1 = sha1(('\n'.join([work_path] + task_chunks_ + list(forward_common_files))).encode('utf-8')).hexdigest()
+            common_context = self.context(work_path, self.session, 'common.' + common_sha1)
+            if not common_context.check_file_exists('tag_upload'):
+                common_context.upload('.', forward_common_files)
+                common_context.write_file('tag_upload', '')
+                dlog.info('uploaded common files to %s' % common_context.remote_root)
+
+        def _submit_chunk(chunk, chunk_name, job_uuid) :
+            # communication context, bach system
+            context = self.context(work_path, self.session, job_uuid)
+            batch = self.batch(context, uuid_names = self.uuid_names)
+            if chunk_resources is not None:
+                res = chunk_resources(chunk)
+            else:
+                res = resources
+            rjob = {'context':context, 'batch':batch, 'resources':res}
+            # upload files
+            if not rjob['context'].check_file_exists('tag_upload'):
+                if common_context is not None:
+                    rjob['context'].link_files(common_context.remote_root,
+                                               forward_common_files)
+                else :
                     rjob['context'].upload('.',
                                            forward_common_files)
-                    rjob['context'].upload(chunk,
-                                           forward_task_files, 
-                                           dereference = forward_task_deference)
-                    rjob['context'].write_file('tag_upload', '')
-                    dlog.debug('uploaded files for %s' % task_chunks_[ii])
-                # submit new or recover old submission
-                if job_uuid is None:
-                    rjob['batch'].submit(chunk, command, res = resources, outlog=outlog, errlog=errlog)
-                    dlog.debug('assigned uudi %s for %s ' % (rjob['context'].job_uuid, task_chunks_[ii]))
-                    dlog.info('new submission of %s' % rjob['context'].job_uuid)
-                else:
-                    rjob['batch'].submit(chunk, command, res = resources, outlog=outlog, errlog=errlog, restart = True)
-                    dlog.info('restart from old submission %s ' % job_uuid)
-                # record job and its hash
-                job_list.append(rjob)
-                path_map[chunk_sha1] = [context.local_root,context.remote_root]
-            else :
-                # finished job, append a None to list
-                job_list.append(None)
-        _pmap.dump(path_map)
-
-        assert(len(job_list) == len(task_chunks))
-        fcount = [0]*len(job_list)
-        while not all(job_fin) :
-            dlog.debug('checking jobs')
-            for idx,rjob in enumerate(job_list) :
-                if not job_fin[idx] :
-                    status = rjob['batch'].check_status()
+                rjob['context'].upload(chunk,
+                                       forward_task_files, 
+                                       dereference = forward_task_deference)
+                rjob['context'].write_file('tag_upload', '')
+                dlog.debug('uploaded files for %s' % chunk_name)
+            # submit new or recover old submission
+            rjob['array'] = job_uuid is None and self.job_array
+            if rjob['array']:
+                # submitted later with the other new chunks in a job array
+                rjob['batch'].write_sub_script(chunk, command, res = res, outlog=outlog, errlog=errlog)
+            elif job_uuid is None:
+                rjob['batch'].submit(chunk, command, res = res, outlog=outlog, errlog=errlog)
+                dlog.debug('assigned uudi %s for %s ' % (rjob['context'].job_uuid, chunk_name))
+                dlog.info('new submission of %s' % rjob['context'].job_uuid)
+            else:
+                rjob['batch'].submit(chunk, command, res = res, outlog=outlog, errlog=errlog, restart = True)
+                dlog.info('restart from old submission %s ' % job_uuid)
+            return rjob
+
+        def _fetch_chunk(context, chunk) :
+            context.download(chunk, backward_task_files)
+            if backward_task_select is not None :
+                # download the selected files of all tasks at once
+                extra_files = []
+                for ii in chunk :
+                    extra_files += [os.path.join(ii, jj) for jj in backward_task_select(os.path.join(work_path, ii))]
+                if len(extra_files) > 0 :
+                    context.download(['.'], extra_files)
+            context.clean()
+
+        # finished job has a None in the list
+        job_list = [None] * len(task_chunks)
+        failed_chunks = []
+        array_idx = []
+        with ThreadPoolExecutor(max_workers = self.submit_threads) as executor :
+            futures = {}
+            for ii,chunk in enumerate(task_chunks) :
+                if not job_fin[ii] :
+                    chunk_sha1 = chunk_sha1s[ii]
+                    # if hash in record, recover job, else start a new job
+                    if chunk_sha1 in records and records[chunk_sha1]['remote_root'] is not None:
+                        job_uuid = records[chunk_sha1]['remote_root'].split('/')[-1]
+                        dlog.debug("load uuid %s for chunk %s" % (job_uuid, task_chunks_[ii]))
+                    else:
+                        job_uuid = None
+                    futures[executor.submit(_submit_chunk, chunk, task_chunks_[ii], job_uuid)] = (ii, chunk_sha1)
+            for ff in as_completed(futures) :
+                ii, chunk_sha1 = futures[ff]
+                try :
+                    rjob = ff.result()
+                except Exception as err :
+                    # do not stop the submission of other chunks
+                    dlog.info('failed to submit %s: %s' % (task_chunks_[ii], err))
+                    failed_chunks.append(task_chunks_[ii])
+                    continue
+                job_list[ii] = rjob
+                if rjob['array'] :
+                    array_idx.append(ii)
+                    continue
+                # record job and its hash, once it is submitted
+                _jr.submit(chunk_sha1, ii, task_chunks_[ii],
+                           rjob['context'].local_root, rjob['context'].remote_root,
+                           rjob['batch'].job_id)
+        array_context = None
+        if len(array_idx) > 0 :
+            array_idx.sort()
+            array_context = self.context(work_path, self.session)
+            # the jobs of an array share the resources
+            groups = {}
+            for ii in array_idx :
+                groups.setdefault(json.dumps(job_list[ii]['resources'], sort_keys = True), []).append(ii)
+            for group in groups.values() :
+                self.batch.submit_array([job_list[ii]['batch'] for ii in group], array_context,
+                                        res = job_list[group[0]]['resources'], max_array_size = self.max_array_size)
+            dlog.info('new submission of %d jobs as job array(s) in %s' % (len(array_idx), array_context.job_uuid))
+            for ii in array_idx :
+                _jr.submit(chunk_sha1s[ii], ii, task_chunks_[ii],
+                           job_list[ii]['context'].local_root, job_list[ii]['context'].remote_root,
+                           job_list[ii]['batch'].job_id)
+        try :
+            if len(failed_chunks) > 0 :
+                raise RuntimeError('failed to submit %d chunk(s): %s. The submitted ones are recorded and will be recovered at restart' 
+                                   % (len(failed_chunks), ' '.join(failed_chunks)))
+
+            assert(len(job_list) == len(task_chunks))
+            fcount = [0]*len(job_list)
+            last_status = [None]*len(job_list)
+            timers = [PollTimer(self.poll_interval, self.max_poll_interval, self.poll_backoff)
+                      for ii in job_list]
+            nfin = sum(job_fin)
+            while not all(job_fin) :
+                dlog.debug('checking jobs')
+                # check the status of the jobs due in the coming poll interval at once
+                due = [idx for idx in range(len(job_list)) \
+                       if not job_fin[idx] and timers[idx].time_to_due() <= self.poll_interval]
+                if len(due) > 0 :
+                    status_list = self.batch.check_status_all([job_list[idx]['batch'] for idx in due])
+                else :
+                    status_list = []
+                finished = []
+                for idx, status in zip(due, status_list) :
+                    rjob = job_list[idx]
                     job_uuid = rjob['context'].job_uuid
                     if status == JobStatus.terminated :
                         fcount[idx] += 1
@@ -140,16 +290,70 @@ class Dispatcher(object):
                             raise RuntimeError('Job %s failed for more than 3 times' % job_uuid)
                         dlog.info('job %s terminated, submit again'% job_uuid)
                         dlog.debug('try %s times for %s'% (fcount[idx], job_uuid))
-                        rjob['batch'].submit(task_chunks[idx], command, res = resources, outlog=outlog, errlog=errlog,restart=True)
+                        rjob['batch'].submit(task_chunks[idx], command, res = rjob['resources'], outlog=outlog, errlog=errlog,restart=True)
+                        _jr.resubmit(chunk_sha1s[idx], rjob['batch'].job_id)
                     elif status == JobStatus.finished :
                         dlog.info('job %s finished' % job_uuid)
-                        rjob['context'].download(task_chunks[idx], backward_task_files)
-                        rjob['context'].clean()
+                        finished.append(idx)
+                    elif status != last_status[idx] and status in [JobStatus.waiting, JobStatus.running] :
+                        _jr.set_status(chunk_sha1s[idx], status.name)
+                    last_status[idx] = status
+                    timers[idx].update(status)
+                # download the finished chunks concurrently
+                with ThreadPoolExecutor(max_workers = self.submit_threads) as executor :
+                    futures = {executor.submit(_fetch_chunk, job_list[idx]['context'], task_chunks[idx]) : idx \
+                               for idx in finished}
+                    for ff in as_completed(futures) :
+                        idx = futures[ff]
+                        ff.result()
                         job_fin[idx] = True
-                        _fr.write_record(job_fin)
-            time.sleep(10)
-        # delete path map file when job finish
-        _pmap.delete()
+                        _jr.set_status(chunk_sha1s[idx], 'finished')
+                        nfin += 1
+                        dlog.info('%d of %d jobs finished' % (nfin, len(job_fin)))
+                        if callback is not None:
+                            callback(task_chunks[idx])
+                wait = [timers[idx].time_to_due() for idx in range(len(job_list)) if not job_fin[idx]]
+                if len(wait) > 0 :
+                    time.sleep(min(wait))
+        finally :
+            # e.g. the local pools of the jobs are shut down
+            for rjob in job_list :
+                if rjob is not None :
+                    rjob['batch'].release()
+        if common_context is not None:
+            common_context.clean()
+        if array_context is not None:
+            array_context.clean()
+
+
+class PollTimer(object):
+    '''
+    Decide when a job should be checked again. The interval grows by the
+    factor backoff while the job status is unchanged (up to max_interval),
+    and it is reset once the status changes.
+    '''
+    def __init__ (self, interval, max_interval, backoff = 1.5):
+        self.interval = interval
+        self.max_interval = max(interval, max_interval)
+        self.backoff = backoff
+        self.cur_interval = interval
+        self.last_status = None
+        # the first check is not delayed
+        self.next_check = time.time()
+
+    def is_due(self):
+        return time.time() >= self.next_check
+
+    def time_to_due(self):
+        return max(self.next_check - time.time(), 0)
+
+    def update(self, status):
+        if status == self.last_status :
+            self.cur_interval = min(self.cur_interval * self.backoff, self.max_interval)
+        else :
+            self.cur_interval = self.interval
+        self.last_status = status
+        self.next_check = time.time() + self.cur_interval
 
 
 class FinRecord(object):
@@ -192,7 +396,10 @@ class PMap(object):
 
    def dump(self,pmap,indent=4):
       f_path_map=self.f_path_map
-      dumpfn(pmap,f_path_map,indent=indent)
+      # write to a temporary file and rename, the old map survives a crash
+      f_tmp=f_path_map+'.tmp'
+      dumpfn(pmap,f_tmp,indent=indent)
+      os.replace(f_tmp,f_path_map)
 
    def delete(self):
       f_path_map=self.f_path_map
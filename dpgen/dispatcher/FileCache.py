@@ -0,0 +1,222 @@
+import os,json,time,hashlib,shlex,threading
+from dpgen import dlog
+
+
+def _file_sha1(fname, block_size = 1 << 20) :
+    sha = hashlib.sha1()
+    with open(fname, 'rb') as fp:
+        while True:
+            block = fp.read(block_size)
+            if not block:
+                break
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class FileCache(object) :
+    """
+    Content addressed cache of the uploaded files on the remote.
+
+    A file is stored once in remote_path under its sha1, the job directories
+    hardlink to it. The local manifest records the cached files and their
+    last use, the least recently used files are evicted when the cache
+    exceeds size_limit. The permissions of the files are not changed, the
+    jobs may rewrite their inputs. The sha1 of a cached file is checked on
+    the remote every time it is linked, so a file changed through a job
+    directory is never linked into a later job, it is uploaded again.
+
+    remote_path(str):       cache directory on the remote
+    manifest(str):          local file recording the remote cache
+    size_limit(float):      size limit of the cache in GB
+    min_size(float):        files smaller than min_size (in KB) are not cached
+    """
+    def __init__ (self,
+                  remote_path,
+                  manifest,
+                  size_limit = 10,
+                  min_size = 64) :
+        self.remote_path = remote_path
+        self.manifest = os.path.abspath(manifest)
+        self.size_limit = int(size_limit * (1 << 30))
+        self.min_size = int(min_size * (1 << 10))
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.hashes = {}
+        if os.path.isfile(self.manifest) :
+            with open(self.manifest) as fp:
+                data = json.load(fp)
+            self.objects = data['objects']
+            self.hashes = data['hashes']
+
+    def dump(self) :
+        with self.lock:
+            data = {'objects': self.objects, 'hashes': self.hashes}
+            f_tmp = self.manifest + '.tmp'
+            with open(f_tmp, 'w') as fp:
+                json.dump(data, fp, indent = 4)
+            os.replace(f_tmp, self.manifest)
+
+    def _hash(self, fname) :
+        # the hash is recomputed only if the file is changed
+        fname = os.path.realpath(fname)
+        fstat = os.stat(fname)
+        key = [fstat.st_size, fstat.st_mtime]
+        with self.lock:
+            if fname in self.hashes and self.hashes[fname][:2] == key :
+                return self.hashes[fname][2]
+        sha1 = _file_sha1(fname)
+        with self.lock:
+            self.hashes[fname] = key + [sha1]
+        return sha1
+
+    def _object_path(self, sha1) :
+        return os.path.join(self.remote_path, sha1)
+
+    def split_files(self,
+                    local_root,
+                    files) :
+        """
+        split the files (relative to local_root) into
+        hits:       [name, sha1, size] of the files found in the cache
+        misses:     [name, sha1, size] of the files that should be cached
+        rest:       names of the files and the empty dirs that are not cached
+        directories are expanded to the files inside.
+        """
+        hits = []
+        misses = []
+        rest = []
+        for ii in files :
+            path = os.path.join(local_root, ii)
+            if os.path.isdir(path) :
+                fnames = []
+                for root, dirs, files_ in os.walk(path, followlinks = True) :
+                    if len(dirs) == 0 and len(files_) == 0 :
+                        rest.append(os.path.relpath(root, local_root))
+                    for jj in files_ :
+                        fnames.append(os.path.relpath(os.path.join(root, jj), local_root))
+            else :
+                fnames = [ii]
+            for jj in fnames :
+                path = os.path.join(local_root, jj)
+                if not os.path.isfile(path) or os.path.getsize(path) < self.min_size :
+                    rest.append(jj)
+                    continue
+                sha1 = self._hash(path)
+                entry = [jj, sha1, os.path.getsize(path)]
+                with self.lock:
+                    if sha1 in self.objects :
+                        hits.append(entry)
+                    else :
+                        misses.append(entry)
+        return hits, misses, rest
+
+    def link(self,
+             context,
+             entries) :
+        """
+        hardlink the cached files into the job root of the context.
+        return the entries not found in the remote cache.
+        """
+        if len(entries) == 0 :
+            return []
+        script = ''
+        for fname, sha1, size in entries :
+            src = shlex.quote(self._object_path(sha1))
+            dst = shlex.quote(fname)
+            dirname = os.path.dirname(fname)
+            if dirname != '' :
+                script += 'mkdir -p %s\n' % shlex.quote(dirname)
+            # a changed file is removed and uploaded again
+            cond = '[ -f %s ] && [ "$(sha1sum < %s | cut -d" " -f1)" = %s ]' % (src, src, sha1)
+            script += 'if %s; then ln -f %s %s 2>/dev/null || cp %s %s; else rm -f %s; echo %s; fi\n' \
+                      % (cond, src, dst, src, dst, src, sha1)
+        missing_sha1 = set(self._run_script(context, script))
+        missing = []
+        now = time.time()
+        with self.lock:
+            for entry in entries :
+                if entry[1] in missing_sha1 :
+                    self.objects.pop(entry[1], None)
+                    missing.append(entry)
+                elif entry[1] in self.objects :
+                    self.objects[entry[1]]['atime'] = now
+        if len(missing) > 0 :
+            dlog.info('%d files are not found in the remote cache, upload them' % len(missing))
+        return missing
+
+    def register(self,
+                 context,
+                 entries) :
+        """
+        put the uploaded files into the cache, and evict the least recently
+        used files if the cache is too large.
+        """
+        now = time.time()
+        script = 'mkdir -p %s\n' % shlex.quote(self.remote_path)
+        with self.lock:
+            for fname, sha1, size in entries :
+                if sha1 in self.objects :
+                    continue
+                dst = shlex.quote(self._object_path(sha1))
+                src = shlex.quote(fname)
+                script += 'if [ ! -f %s ]; then ln -f %s %s 2>/dev/null || cp %s %s; fi\n' \
+                          % (dst, src, dst, src, dst)
+                self.objects[sha1] = {'size': size, 'atime': now}
+            for sha1 in self._evict() :
+                script += 'rm -f %s\n' % shlex.quote(self._object_path(sha1))
+        self._run_script(context, script)
+        self.dump()
+
+    def _evict(self) :
+        tot_size = sum([ii['size'] for ii in self.objects.values()])
+        if tot_size <= self.size_limit :
+            return []
+        evicted = []
+        for sha1 in sorted(self.objects, key = lambda kk: self.objects[kk]['atime']) :
+            if tot_size <= self.size_limit :
+                break
+            tot_size -= self.objects[sha1]['size']
+            evicted.append(sha1)
+        for sha1 in evicted :
+            del self.objects[sha1]
+        dlog.info('evict %d files from the remote cache' % len(evicted))
+        return evicted
+
+    def verify(self,
+               context) :
+        """
+        check the sha1 of all cached files on the remote, remove the broken
+        ones. return the number of removed entries.
+        """
+        with self.lock:
+            sha1_list = list(self.objects.keys())
+        script = ''
+        for sha1 in sha1_list :
+            obj = shlex.quote(self._object_path(sha1))
+            script += 'if [ -f %s ]; then echo %s $(sha1sum < %s | cut -d" " -f1); else echo %s none; fi\n' \
+                      % (obj, sha1, obj, sha1)
+        words = self._run_script(context, script)
+        broken = []
+        for sha1, digest in zip(words[0::2], words[1::2]) :
+            if sha1 != digest :
+                broken.append(sha1)
+        script = ''
+        with self.lock:
+            for sha1 in broken :
+                self.objects.pop(sha1, None)
+                script += 'rm -f %s\n' % shlex.quote(self._object_path(sha1))
+        if len(broken) > 0 :
+            dlog.info('remove %d broken or missing files from the remote cache' % len(broken))
+            self._run_script(context, script)
+        self.dump()
+        return len(broken)
+
+    def _run_script(self,
+                    context,
+                    script) :
+        if script == '' :
+            return []
+        script_name = context.job_uuid + '_cache.sh'
+        context.write_file(script_name, script)
+        stdin, stdout, stderr = context.block_checkcall('bash %s; ret=$?; rm -f %s; exit $ret' % (script_name, script_name))
+        return stdout.read().decode('utf-8').split()
@@ -0,0 +1,117 @@
+import os,time,sqlite3,threading
+from contextlib import contextmanager
+
+# the records are written by one thread at a time, the work path is often
+# on NFS where the file locks of sqlite are not reliable
+_write_lock = threading.Lock()
+
+
+class JobRecord(object):
+    """
+    Record of the jobs submitted by Dispatcher.run_jobs, stored in a sqlite
+    database in the work path. Each chunk of tasks is keyed by its sha1, the
+    record keeps the remote root, job id, status, number of resubmissions
+    and the timings. Every event updates one row in a transaction, a crash
+    never leaves a partially written record. The database uses the rollback
+    journal (not WAL, which needs shared memory and does not work on NFS),
+    and the writes of the threads are serialized.
+    """
+    columns = ['chunk_sha1', 'chunk_idx', 'chunk', 'local_root', 'remote_root', 'job_id',
+               'status', 'retries', 'submit_time', 'start_time', 'finish_time']
+
+    def __init__ (self, path, fname = 'job_record.db'):
+        self.path = os.path.abspath(path)
+        self.fname = os.path.join(self.path, fname)
+        with self._connect(write = True) as conn:
+            conn.execute('PRAGMA journal_mode = DELETE')
+            conn.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                         'chunk_sha1 TEXT PRIMARY KEY, '
+                         'chunk_idx INTEGER, '
+                         'chunk TEXT, '
+                         'local_root TEXT, '
+                         'remote_root TEXT, '
+                         'job_id TEXT, '
+                         'status TEXT, '
+                         'retries INTEGER DEFAULT 0, '
+                         'submit_time REAL, '
+                         'start_time REAL, '
+                         'finish_time REAL)')
+
+    @contextmanager
+    def _connect(self, write = False):
+        # a connection per operation, the writes hold the lock
+        if write:
+            _write_lock.acquire()
+        try:
+            conn = sqlite3.connect(self.fname, timeout = 60)
+            try:
+                with conn:
+                    yield conn
+            finally:
+                conn.close()
+        finally:
+            if write:
+                _write_lock.release()
+
+    def load(self):
+        """
+        return the records as a dict of chunk sha1 to dict of the columns
+        """
+        with self._connect() as conn:
+            rows = conn.execute('SELECT %s FROM jobs' % ', '.join(self.columns)).fetchall()
+        return {row[0] : dict(zip(self.columns, row)) for row in rows}
+
+    def get_record(self, chunk_sha1s):
+        """
+        return if the chunks are finished
+        """
+        records = self.load()
+        return [ii in records and records[ii]['status'] == 'finished' for ii in chunk_sha1s]
+
+    def submit(self, chunk_sha1, chunk_idx, chunk, local_root, remote_root, job_id = ''):
+        # no upsert (ON CONFLICT), it needs sqlite 3.24. both statements are in one transaction
+        with self._connect(write = True) as conn:
+            conn.execute('INSERT OR IGNORE INTO jobs (chunk_sha1, chunk_idx, chunk, local_root, remote_root, job_id, status, retries, submit_time) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?)',
+                         (chunk_sha1, chunk_idx, chunk, local_root, remote_root, str(job_id), 'submitted', time.time()))
+            conn.execute('UPDATE jobs SET chunk_idx = ?, local_root = ?, remote_root = ?, job_id = ?, status = ? '
+                         'WHERE chunk_sha1 = ?',
+                         (chunk_idx, local_root, remote_root, str(job_id), 'submitted', chunk_sha1))
+
+    def resubmit(self, chunk_sha1, job_id = ''):
+        with self._connect(write = True) as conn:
+            conn.execute('UPDATE jobs SET retries = retries + 1, job_id = ?, status = ?, start_time = NULL WHERE chunk_sha1 = ?',
+                         (str(job_id), 'submitted', chunk_sha1))
+
+    def set_status(self, chunk_sha1, status):
+        """
+        status is the name of JobStatus
+        """
+        now = time.time()
+        with self._connect(write = True) as conn:
+            if status == 'running':
+                conn.execute('UPDATE jobs SET status = ?, start_time = COALESCE(start_time, ?) WHERE chunk_sha1 = ?',
+                             (status, now, chunk_sha1))
+            elif status == 'finished':
+                conn.execute('UPDATE jobs SET status = ?, finish_time = ? WHERE chunk_sha1 = ?',
+                             (status, now, chunk_sha1))
+            else:
+                conn.execute('UPDATE jobs SET status = ? WHERE chunk_sha1 = ?', (status, chunk_sha1))
+
+    def import_legacy(self, chunk_sha1s, chunks, job_fin, path_map):
+        """
+        import the fin.record and pmap.json written by the older versions
+        """
+        now = time.time()
+        with self._connect(write = True) as conn:
+            for idx, (chunk_sha1, chunk) in enumerate(zip(chunk_sha1s, chunks)):
+                if job_fin[idx]:
+                    status = 'finished'
+                elif chunk_sha1 in path_map:
+                    status = 'submitted'
+                else:
+                    continue
+                local_root, remote_root = path_map.get(chunk_sha1, [None, None])
+                conn.execute('INSERT OR IGNORE INTO jobs (chunk_sha1, chunk_idx, chunk, local_root, remote_root, job_id, status, retries, submit_time) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?)',
+                             (chunk_sha1, idx, chunk, local_root, remote_root, '', status, now))
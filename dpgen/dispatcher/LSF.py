@@ -1,4 +1,4 @@
-import os,getpass,time
+import os,getpass,time,re,shlex
 from dpgen.dispatcher.Batch import Batch
 from dpgen.dispatcher.JobStatus import JobStatus
 
@@ -7,6 +7,8 @@ def _default_item(resources, key, value) :
         resources[key] = value
 
 class LSF(Batch) :
+    # the index of the lsf job array starts from 1
+    array_index = '$((LSB_JOBINDEX-1))'
     
     def check_status(self):
         try:
@@ -16,7 +18,7 @@ class LSF(Batch) :
         if job_id == "" :
             raise RuntimeError("job %s is has not been submitted" % self.remote_root)
         ret, stdin, stdout, stderr\
-            = self.context.block_call ("bjobs " + job_id)
+            = self.context.block_call ("bjobs " + shlex.quote(job_id))
         err_str = stderr.read().decode('utf-8')
         if ("Job <%s> is not found" % job_id) in err_str :
             if self.check_finish_tag() :
@@ -33,6 +35,9 @@ class LSF(Batch) :
             status_line = status_out[1]
             status_word = status_line.split()[2]
 
+        return self._check_status_word(status_word)
+
+    def _check_status_word(self, status_word):
         # ref: https://www.ibm.com/support/knowledgecenter/en/SSETD4_9.1.2/lsf_command_ref/bjobs.1.html
         if      status_word in ["PEND", "WAIT"] :
             return JobStatus.waiting
@@ -46,6 +51,55 @@ class LSF(Batch) :
         else :
             return JobStatus.unknown
 
+    @classmethod
+    def check_status_all(cls, batches, max_query = 1000):
+        """
+        check the status of all jobs with one bjobs call (per max_query jobs)
+        """
+        job_ids = []
+        for bb in batches:
+            try:
+                job_ids.append(bb._get_job_id())
+            except:
+                job_ids.append(None)
+        ret = [JobStatus.terminated] * len(batches)
+        for ii in range(len(batches)):
+            if job_ids[ii] == "" :
+                raise RuntimeError("job %s is has not been submitted" % batches[ii].context.remote_root)
+        submitted = [ii for ii in range(len(batches)) if job_ids[ii] is not None]
+        for start in range(0, len(submitted), max_query):
+            group = submitted[start:start+max_query]
+            context = batches[group[0]].context
+            code, stdin, stdout, stderr \
+                = context.block_call("bjobs " + " ".join([shlex.quote(job_ids[ii]) for ii in group]))
+            err_str = stderr.read().decode('utf-8')
+            not_found = re.findall(r"Job <(\S+)> is not found", err_str)
+            if code != 0 and len(not_found) == 0 :
+                raise RuntimeError ("status command bjobs fails to execute. erro info: %s return code %d"
+                                    % (err_str, code))
+            status_words = {}
+            # the first line is the header
+            for line in stdout.read().decode('utf-8').split('\n')[1:]:
+                words = line.split()
+                if len(words) >= 3:
+                    # the elements of a job array share the job id, the index is in the job name
+                    index = re.search(r'\[(\d+)\]', line)
+                    if index is not None :
+                        status_words['%s[%s]' % (words[0], index.group(1))] = words[2]
+                    else :
+                        status_words[words[0]] = words[2]
+            for ii in group:
+                if job_ids[ii] in status_words:
+                    ret[ii] = batches[ii]._check_status_word(status_words[job_ids[ii]])
+                elif job_ids[ii] in not_found :
+                    if batches[ii].check_finish_tag() :
+                        ret[ii] = JobStatus.finished
+                    else :
+                        ret[ii] = JobStatus.terminated
+                else :
+                    ret[ii] = JobStatus.unknown
+        return ret
+
 
     def do_submit(self, 
                   job_dirs,
@@ -65,7 +119,15 @@ class LSF(Batch) :
         subret = (stdout.readlines())
         job_id = subret[0].split()[1][1:-1]
         self.context.write_file(self.job_id_name, job_id)        
+        self.job_id = job_id
+
 
+    @classmethod
+    def _submit_array_script(cls, context, script_name, nelem, res) :
+        job_name = res['job_name'] if 'job_name' in res else 'dpgen'
+        stdin, stdout, stderr = context.block_checkcall('cd %s && bsub -J %s < %s' % (context.remote_root, shlex.quote('%s[1-%d]' % (job_name, nelem)), script_name))
+        job_id = stdout.readlines()[0].split()[1][1:-1]
+        return ['%s[%d]' % (job_id, ii + 1) for ii in range(nelem)]
 
     def default_resources(self, res_) :
         """
@@ -147,12 +209,6 @@ class LSF(Batch) :
         return ret
 
 
-    def _get_job_id(self) :
-        if self.context.check_file_exists(self.job_id_name) :
-            return self.context.read_file(self.job_id_name)
-        else:
-            return ""
-
 
     def _check_sub_limit(self, task_max, **kwarg) :
         stdin_run, stdout_run, stderr_run = self.context.block_checkcall("bjobs | grep RUN | wc -l")
@@ -52,28 +52,21 @@ class LazyLocalContext(object) :
 
     def block_checkcall(self,
                         cmd) :
-        cwd = os.getcwd()
-        os.chdir(self.local_root)
-        proc = sp.Popen(cmd, shell=True, stdout = sp.PIPE, stderr = sp.PIPE)
+        proc = sp.Popen(cmd, shell=True, cwd=self.local_root, stdout = sp.PIPE, stderr = sp.PIPE)
         o, e = proc.communicate()
         stdout = SPRetObj(o)
         stderr = SPRetObj(e)
         code = proc.returncode
         if code != 0:
-            os.chdir(cwd)        
             raise RuntimeError("Get error code %d in locally calling %s with job: %s ", (code, cmd, self.job_uuid))
-        os.chdir(cwd)        
         return None, stdout, stderr
         
     def block_call(self, cmd) :
-        cwd = os.getcwd()
-        os.chdir(self.local_root)
-        proc = sp.Popen(cmd, shell=True, stdout = sp.PIPE, stderr = sp.PIPE)
+        proc = sp.Popen(cmd, shell=True, cwd=self.local_root, stdout = sp.PIPE, stderr = sp.PIPE)
         o, e = proc.communicate()
         stdout = SPRetObj(o)
         stderr = SPRetObj(e)
         code = proc.returncode
-        os.chdir(cwd)        
         return code, None, stdout, stderr
 
     def clean(self) :
@@ -92,10 +85,7 @@ class LazyLocalContext(object) :
         return os.path.isfile(os.path.join(self.local_root, fname))
         
     def call(self, cmd) :
-        cwd = os.getcwd()
-        os.chdir(self.local_root)
-        proc = sp.Popen(cmd, shell=True, stdout = sp.PIPE, stderr = sp.PIPE)
-        os.chdir(cwd)        
+        proc = sp.Popen(cmd, shell=True, cwd=self.local_root, stdout = sp.PIPE, stderr = sp.PIPE)
         return proc
 
     def kill(self, proc):
@@ -1,12 +1,20 @@
-import os,shutil,uuid,hashlib
+import os,shutil,uuid,hashlib,errno
 import subprocess as sp
 from glob import glob
+from concurrent.futures import ThreadPoolExecutor
 from dpgen import dlog
 
+# ioctl of the reflink clone on linux (btrfs, xfs)
+_FICLONE = 0x40049409
+
 class LocalSession (object) :
     def __init__ (self, jdata) :
         self.work_path = os.path.abspath(jdata['work_path'])
         assert(os.path.exists(self.work_path))
+        self.link_mode = jdata.get('link_mode', 'symlink')
+        if self.link_mode not in ['symlink', 'hardlink', 'copy'] :
+            raise RuntimeError('unknown link_mode %s, should be symlink, hardlink or copy' % self.link_mode)
+        self.copy_threads = jdata.get('copy_threads', 4)
 
     def get_work_root(self) :
         return self.work_path
@@ -31,6 +39,56 @@ def _check_file_path(fname) :
     if dirname != "":
         os.makedirs(dirname, exist_ok=True)
 
+def _remove(path) :
+    if os.path.isdir(path) and not os.path.islink(path) :
+        shutil.rmtree(path)
+    elif os.path.lexists(path) :
+        os.remove(path)
+
+def _copy_file(src, dst) :
+    """
+    copy src to dst, by a reflink clone if the filesystem supports it,
+    otherwise by copy_file_range in the kernel, otherwise by read and write.
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst :
+        copied = False
+        try :
+            import fcntl
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+            copied = True
+        except (ImportError, OSError) :
+            pass
+        if not copied and hasattr(os, 'copy_file_range') :
+            try :
+                size = os.fstat(fsrc.fileno()).st_size
+                offset = 0
+                while offset < size :
+                    nbytes = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - offset, offset, offset)
+                    if nbytes == 0 :
+                        break
+                    offset += nbytes
+                copied = offset >= size
+            except OSError :
+                fdst.seek(0)
+                fdst.truncate()
+        if not copied :
+            shutil.copyfileobj(fsrc, fdst, 1 << 20)
+    shutil.copymode(src, dst)
+
+def _link_file(src, dst, link_mode) :
+    """
+    link_mode is hardlink or copy. the hardlink falls back to the copy
+    across devices.
+    """
+    if link_mode == 'hardlink' :
+        try :
+            os.link(src, dst)
+            return
+        except OSError as e :
+            if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK] :
+                raise
+    _copy_file(src, dst)
+
 def _identical_files(fname0, fname1) :
     with open(fname0) as fp:
         code0 = hashlib.sha1(fp.read().encode('utf-8')).hexdigest()
@@ -60,6 +118,8 @@ class LocalContext(object) :
         dlog.debug("remote_root is %s"% self.remote_root)
 
         os.makedirs(self.remote_root, exist_ok = True)
+        self.link_mode = getattr(work_profile, 'link_mode', 'symlink')
+        self.copy_threads = getattr(work_profile, 'copy_threads', 4)
         
     def get_job_root(self) :
         return self.remote_root
@@ -68,84 +128,96 @@ class LocalContext(object) :
                job_dirs,
                local_up_files,
                dereference = True) :
-        cwd = os.getcwd()
+        """
+        the files are symlinked, hardlinked or copied to the job root
+        according to the link_mode of the session.
+        """
+        links = []
         for ii in job_dirs :
             local_job = os.path.join(self.local_root, ii)
             remote_job = os.path.join(self.remote_root, ii)
-            os.makedirs(remote_job, exist_ok = True)
-            os.chdir(remote_job)
             for jj in local_up_files :
-                if not os.path.exists(os.path.join(local_job, jj)):
-                    os.chdir(cwd)
-                    raise RuntimeError('cannot find upload file ' + os.path.join(local_job, jj))
-                if os.path.exists(os.path.join(remote_job, jj)) :
-                    os.remove(os.path.join(remote_job, jj))
-                _check_file_path(jj)
-                os.symlink(os.path.join(local_job, jj),
-                           os.path.join(remote_job, jj))
-        os.chdir(cwd)
+                src = os.path.join(local_job, jj)
+                if not os.path.exists(src):
+                    raise RuntimeError('cannot find upload file ' + src)
+                links.append((src, os.path.join(remote_job, jj)))
+        if self.link_mode == 'symlink' :
+            for src, dst in links :
+                _remove(dst)
+                _check_file_path(dst)
+                os.symlink(src, dst)
+            return
+        # expand the directories, create all the target dirs before linking the files
+        files = []
+        dirs = set()
+        for src, dst in links :
+            _remove(dst)
+            if os.path.isdir(src) :
+                for root, subdirs, fnames in os.walk(src, followlinks = True) :
+                    root_dst = os.path.join(dst, os.path.relpath(root, src))
+                    dirs.add(root_dst)
+                    files += [(os.path.join(root, kk), os.path.join(root_dst, kk)) for kk in fnames]
+            else :
+                dirs.add(os.path.dirname(dst))
+                files.append((src, dst))
+        for ii in sorted(dirs) :
+            os.makedirs(ii, exist_ok = True)
+        if self.copy_threads > 1 and len(files) > 1 :
+            with ThreadPoolExecutor(max_workers = self.copy_threads) as executor :
+                list(executor.map(lambda ff : _link_file(ff[0], ff[1], self.link_mode), files))
+        else :
+            for src, dst in files :
+                _link_file(src, dst, self.link_mode)
 
     def download(self, 
                  job_dirs,
                  remote_down_files,
                  back_error=False) :
-        cwd = os.getcwd()
         for ii in job_dirs :
             local_job = os.path.join(self.local_root, ii)
             remote_job = os.path.join(self.remote_root, ii)
-            flist = remote_down_files
+            flist = list(remote_down_files)
             if back_error :
-                os.chdir(remote_job)
-                flist += glob('error*')                        
-                os.chdir(cwd)
+                flist += [os.path.basename(jj) for jj in glob(os.path.join(remote_job, 'error*'))]
             for jj in flist :
                 rfile = os.path.join(remote_job, jj)
                 lfile = os.path.join(local_job, jj)
-                if not os.path.realpath(rfile) == os.path.realpath(lfile) :
-                    if (not os.path.exists(rfile)) and (not os.path.exists(lfile)):
+                r_exists = os.path.exists(rfile)
+                l_exists = os.path.exists(lfile)
+                if not r_exists :
+                    if not l_exists :
                         raise RuntimeError('do not find download file ' + rfile)
-                    elif (not os.path.exists(rfile)) and (os.path.exists(lfile)) :
-                        # already downloaded
-                        pass
-                    elif (os.path.exists(rfile)) and (not os.path.exists(lfile)) :
-                        # trivial case, download happily
-                        shutil.move(rfile, lfile)
-                    elif (os.path.exists(rfile)) and (os.path.exists(lfile)) :
-                        # both exists, replace!
-                        dlog.info('find existing %s, replacing by %s' % (lfile, rfile))
-                        shutil.rmtree(lfile)
-                        shutil.move(rfile, lfile)
-                    else :
-                        raise RuntimeError('should not reach here!')
-                else :
+                    # already downloaded
+                    continue
+                if l_exists and (os.path.realpath(rfile) == os.path.realpath(lfile) or os.path.samefile(rfile, lfile)) :
                     # no nothing in the case of linked files
-                    pass
-        os.chdir(cwd)
+                    continue
+                if l_exists :
+                    # both exists, replace!
+                    dlog.info('find existing %s, replacing by %s' % (lfile, rfile))
+                    _remove(lfile)
+                else :
+                    _check_file_path(lfile)
+                # a rename on the same device, a copy otherwise
+                shutil.move(rfile, lfile)
 
     def block_checkcall(self,
                         cmd) :
-        cwd = os.getcwd()
-        os.chdir(self.remote_root)
-        proc = sp.Popen(cmd, shell=True, stdout = sp.PIPE, stderr = sp.PIPE)
+        proc = sp.Popen(cmd, shell=True, cwd=self.remote_root, stdout = sp.PIPE, stderr = sp.PIPE)
         o, e = proc.communicate()
         stdout = SPRetObj(o)
         stderr = SPRetObj(e)
         code = proc.returncode
         if code != 0:
-            os.chdir(cwd)        
             raise RuntimeError("Get error code %d in locally calling %s with job: %s ", (code, cmd, self.job_uuid))
-        os.chdir(cwd)        
         return None, stdout, stderr
         
     def block_call(self, cmd) :
-        cwd = os.getcwd()
-        os.chdir(self.remote_root)
-        proc = sp.Popen(cmd, shell=True, stdout = sp.PIPE, stderr = sp.PIPE)
+        proc = sp.Popen(cmd, shell=True, cwd=self.remote_root, stdout = sp.PIPE, stderr = sp.PIPE)
         o, e = proc.communicate()
         stdout = SPRetObj(o)
         stderr = SPRetObj(e)
         code = proc.returncode
-        os.chdir(cwd)        
         return code, None, stdout, stderr
 
     def clean(self) :
@@ -164,10 +236,7 @@ class LocalContext(object) :
         return os.path.isfile(os.path.join(self.remote_root, fname))
         
     def call(self, cmd) :
-        cwd = os.getcwd()
-        os.chdir(self.remote_root)
-        proc = sp.Popen(cmd, shell=True, stdout = sp.PIPE, stderr = sp.PIPE)
-        os.chdir(cwd)        
+        proc = sp.Popen(cmd, shell=True, cwd=self.remote_root, stdout = sp.PIPE, stderr = sp.PIPE)
         return proc
 
     def kill(self, proc):
@@ -0,0 +1,110 @@
+import os,queue,shutil,threading
+import subprocess as sp
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _available_cpus() :
+    if hasattr(os, 'sched_getaffinity') :
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+class LocalPool(object) :
+    """
+    A pool of workers running the task scripts on the local machine. Each
+    worker owns a slot of cpus_per_task cores, and a GPU if ngpus > 0. The
+    task process is pinned to the cores of the slot and sees only the GPU
+    of the slot through CUDA_VISIBLE_DEVICES.
+
+    size(int):              number of workers. By default the number of
+                            available cores // cpus_per_task, and no more
+                            than ngpus if ngpus > 0.
+    cpus_per_task(int):     number of cores of each worker
+    ngpus(int):             number of GPUs
+    """
+    def __init__ (self,
+                  size = None,
+                  cpus_per_task = 1,
+                  ngpus = 0) :
+        cpus = _available_cpus()
+        cpus_per_task = max(min(cpus_per_task, len(cpus)), 1)
+        if size is None :
+            size = max(len(cpus) // cpus_per_task, 1)
+            if ngpus > 0 :
+                size = min(size, ngpus)
+        self.size = size
+        self.slots = queue.Queue()
+        for ii in range(size) :
+            start = (ii * cpus_per_task) % len(cpus)
+            slot_cpus = [cpus[(start + jj) % len(cpus)] for jj in range(cpus_per_task)]
+            gpu = ii % ngpus if ngpus > 0 else None
+            self.slots.put((slot_cpus, gpu))
+        self.executor = ThreadPoolExecutor(max_workers = size)
+
+    def submit(self, script, cwd) :
+        """
+        run bash script in cwd, return a Future of the exit code
+        """
+        return self.executor.submit(self._run, script, cwd)
+
+    def _run(self, script, cwd) :
+        # there is always a free slot, the number of threads equals the number of slots
+        cpus, gpu = self.slots.get()
+        try :
+            env = os.environ.copy()
+            if gpu is not None :
+                env['CUDA_VISIBLE_DEVICES'] = str(gpu)
+            # the process is pinned without preexec_fn, which is not safe in threads
+            if shutil.which('taskset') is not None :
+                proc = sp.Popen(['taskset', '-c', ','.join([str(ii) for ii in cpus]), 'bash', script],
+                                cwd = cwd, env = env, stdout = sp.DEVNULL, stderr = sp.DEVNULL)
+            else :
+                proc = sp.Popen(['bash', script], cwd = cwd, env = env,
+                                stdout = sp.DEVNULL, stderr = sp.DEVNULL)
+                if hasattr(os, 'sched_setaffinity') :
+                    try :
+                        os.sched_setaffinity(proc.pid, cpus)
+                    except OSError :
+                        # the process has already exited
+                        pass
+            return proc.wait()
+        finally :
+            self.slots.put((cpus, gpu))
+
+    def shutdown(self, wait = True) :
+        """
+        stop the workers once the submitted tasks finish
+        """
+        self.executor.shutdown(wait = wait)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_local_pool(size = None,
+                   cpus_per_task = 1,
+                   ngpus = 0) :
+    """
+    the pool shared by all jobs in the process with the same settings. each
+    call should be paired with a release_local_pool.
+    """
+    key = (size, cpus_per_task, ngpus)
+    with _pools_lock :
+        if key not in _pools :
+            _pools[key] = [LocalPool(size, cpus_per_task, ngpus), 0]
+        _pools[key][1] += 1
+        return _pools[key][0]
+
+def release_local_pool(pool) :
+    """
+    release a pool got by get_local_pool, it is shut down when no job uses it
+    """
+    with _pools_lock :
+        for key, (ii, count) in list(_pools.items()) :
+            if ii is pool :
+                if count > 1 :
+                    _pools[key][1] -= 1
+                else :
+                    del _pools[key]
+                    pool.shutdown(wait = False)
+                return
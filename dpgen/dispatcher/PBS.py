@@ -1,4 +1,4 @@
-import os,getpass,time
+import os,getpass,time,shlex
 from dpgen.dispatcher.Batch import Batch
 from dpgen.dispatcher.JobStatus import JobStatus
 
@@ -7,13 +7,15 @@ def _default_item(resources, key, value) :
         resources[key] = value
 
 class PBS(Batch) :
+    # PBS_ARRAYID of torque, PBS_ARRAY_INDEX of pbs pro
+    array_index = '${PBS_ARRAYID:-$PBS_ARRAY_INDEX}'
 
     def check_status(self) :
         job_id = self._get_job_id()
         if job_id == "" :
             return JobStatus.unsubmitted
         ret, stdin, stdout, stderr\
-            = self.context.block_call ("qstat " + job_id)
+            = self.context.block_call ("qstat " + shlex.quote(job_id))
         err_str = stderr.read().decode('utf-8')
         if (ret != 0) :
             if str("qstat: Unknown Job Id") in err_str :
@@ -27,6 +29,9 @@ class PBS(Batch) :
         status_line = stdout.read().decode('utf-8').split ('\n')[-2]
         status_word = status_line.split ()[-2]        
         # dlog.info (status_word)
+        return self._check_status_word(status_word)
+
+    def _check_status_word(self, status_word):
         if      status_word in ["Q","H"] :
             return JobStatus.waiting
         elif    status_word in ["R"] :
@@ -38,6 +43,39 @@ class PBS(Batch) :
                 return JobStatus.terminated
         else :
             return JobStatus.unknown
+
+    @classmethod
+    def check_status_all(cls, batches, max_query = 1000):
+        """
+        check the status of all jobs with one qstat call (per max_query jobs)
+        """
+        job_ids = [bb._get_job_id() for bb in batches]
+        ret = [JobStatus.unsubmitted] * len(batches)
+        submitted = [ii for ii in range(len(batches)) if job_ids[ii] != ""]
+        for start in range(0, len(submitted), max_query):
+            group = submitted[start:start+max_query]
+            context = batches[group[0]].context
+            code, stdin, stdout, stderr \
+                = context.block_call("qstat " + " ".join([shlex.quote(job_ids[ii]) for ii in group]))
+            err_str = stderr.read().decode('utf-8')
+            if code != 0 and not str("qstat: Unknown Job Id") in err_str :
+                raise RuntimeError ("status command qstat fails to execute. erro info: %s return code %d"
+                                    % (err_str, code))
+            # qstat may truncate the server name in the job id
+            status_words = {}
+            for line in stdout.read().decode('utf-8').split('\n')[2:]:
+                words = line.split()
+                if len(words) >= 2:
+                    status_words[words[0].split('.')[0]] = words[-2]
+            for ii in group:
+                short_id = job_ids[ii].split('.')[0]
+                if short_id in status_words:
+                    ret[ii] = batches[ii]._check_status_word(status_words[short_id])
+                elif batches[ii].check_finish_tag() :
+                    ret[ii] = JobStatus.finished
+                else :
+                    ret[ii] = JobStatus.terminated
+        return ret
    
     def do_submit(self, 
                   job_dirs,
@@ -57,6 +95,14 @@ class PBS(Batch) :
         subret = (stdout.readlines())
         job_id = subret[0].split()[0]
         self.context.write_file(self.job_id_name, job_id)        
+        self.job_id = job_id
+
+    @classmethod
+    def _submit_array_script(cls, context, script_name, nelem, res) :
+        stdin, stdout, stderr = context.block_checkcall('cd %s && qsub -t 0-%d %s' % (context.remote_root, nelem - 1, script_name))
+        # e.g. 123[].server
+        job_id = stdout.readlines()[0].split()[0]
+        return [job_id.replace('[]', '[%d]' % ii) for ii in range(nelem)]
 
     def default_resources(self, res_) :
         """
@@ -129,9 +175,3 @@ class PBS(Batch) :
             ret = '%s %s' % (cmd, arg)
         return ret        
 
-    def _get_job_id(self) :
-        if self.context.check_file_exists(self.job_id_name) :
-            return self.context.read_file(self.job_id_name)
-        else:
-            return ""
-
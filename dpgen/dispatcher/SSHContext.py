@@ -1,9 +1,136 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-import os, sys, paramiko, json, uuid, tarfile, time, stat, shutil
+import os, sys, paramiko, json, uuid, tarfile, gzip, time, stat, shutil, shlex
+import queue, threading
 from glob import glob
+from contextlib import contextmanager
 from dpgen import dlog
+from dpgen.dispatcher.FileCache import FileCache
+
+class _StderrReader (threading.Thread) :
+    """
+    Read the stderr of a channel in the background while its stdin or
+    stdout is streamed, the remote command blocks once the stderr window
+    is full.
+    """
+    def __init__ (self, channel) :
+        super(_StderrReader, self).__init__(daemon = True)
+        self.fp = channel.makefile_stderr('rb')
+        self.data = b''
+        self.start()
+
+    def run(self) :
+        self.data = self.fp.read()
+
+    def text(self) :
+        self.join()
+        return self.data.decode('utf-8', errors = 'replace')
+
+
+class SFTPPool (object) :
+    """
+    A pool of sftp channels opened on demand, the channels are distributed
+    over the ssh clients in a round-robin way.
+    """
+    def __init__ (self, clients, size = 1) :
+        self.clients = clients
+        self.size = max(size, 1)
+        self.idle = queue.LifoQueue()
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def get(self) :
+        try :
+            return self.idle.get_nowait()
+        except queue.Empty :
+            pass
+        with self.lock:
+            open_new = self.count < self.size
+            if open_new :
+                client = self.clients[self.count % len(self.clients)]
+                self.count += 1
+        if not open_new :
+            # wait for a channel released by other threads
+            return self.idle.get()
+        try :
+            return client.open_sftp()
+        except :
+            with self.lock:
+                self.count -= 1
+            raise
+
+    def put(self, sftp) :
+        self.idle.put(sftp)
+
+    def discard(self, sftp) :
+        with self.lock:
+            self.count -= 1
+        try :
+            sftp.close()
+        except :
+            pass
+
+    def close(self) :
+        while True :
+            try :
+                sftp = self.idle.get_nowait()
+            except queue.Empty :
+                break
+            self.discard(sftp)
+
+
+# the ssh connections shared by all sessions in the process,
+# keyed by (hostname, port, username)
+_ssh_clients = {}
+_ssh_clients_lock = threading.Lock()
+
+def _check_alive(ssh) :
+    try :
+        transport = ssh.get_transport()
+        if transport is None or not transport.is_active() :
+            return False
+        transport.send_ignore()
+        return True
+    except Exception :
+        return False
+
+def _connect(hostname,
+             port,
+             username = None,
+             password = None) :
+    ssh = paramiko.SSHClient()
+    # ssh_client.load_system_host_keys()        
+    ssh.set_missing_host_key_policy(paramiko.WarningPolicy)
+    ssh.connect(hostname, port=port, username=username, password=password)
+    assert(ssh.get_transport().is_active())
+    transport = ssh.get_transport()
+    transport.set_keepalive(60)
+    return ssh
+
+def get_ssh_clients(hostname,
+                    port,
+                    username = None,
+                    password = None,
+                    number = 1) :
+    """
+    return number live ssh clients connected to the host. the connections
+    are reused in the process, the dead ones are replaced by new ones.
+    """
+    key = (hostname, port, username)
+    with _ssh_clients_lock :
+        clients = _ssh_clients.setdefault(key, [])
+        for ii in range(number) :
+            if ii < len(clients) and _check_alive(clients[ii]) :
+                continue
+            ssh = _connect(hostname, port, username = username, password = password)
+            if ii < len(clients) :
+                clients[ii].close()
+                clients[ii] = ssh
+            else :
+                clients.append(ssh)
+        return clients[:number]
+
 
 class SSHSession (object) :
     def __init__ (self, jdata) :
@@ -17,7 +144,24 @@ class SSHSession (object) :
         if 'password' in self.remote_profile :
             self.remote_password = self.remote_profile['password']
         self.remote_workpath = self.remote_profile['work_path']
+        # sftp: transfer temporary tgz files, stream: pipe tar through ssh
+        self.transfer_mode = self.remote_profile.get('transfer_mode', 'sftp')
+        if self.transfer_mode not in ['sftp', 'stream'] :
+            raise RuntimeError('unknown transfer_mode %s' % self.transfer_mode)
+        # gzip level of the stream transfer, 0 for no compression
+        self.compress_level = self.remote_profile.get('compress_level', 6)
+        self.file_cache = None
+        if 'file_cache' in self.remote_profile :
+            cache_profile = self.remote_profile['file_cache']
+            self.file_cache = FileCache(cache_profile.get('remote_path', os.path.join(self.remote_workpath, '.dpgen_cache')),
+                                        cache_profile.get('manifest', 'dpgen_cache.%s.json' % self.remote_host),
+                                        size_limit = cache_profile.get('size_limit', 10),
+                                        min_size = cache_profile.get('min_size', 64))
+        # number of sftp channels, and the number of ssh connections they use
+        self.sftp_channels = self.remote_profile.get('sftp_channels', 1)
+        self.ssh_connections = self.remote_profile.get('ssh_connections', 1)
         self.ssh = None
+        self.sftp_pool = None
         self._setup_ssh(self.remote_host,
                         self.remote_port,
                         username=self.remote_uname,
@@ -32,44 +176,59 @@ class SSHSession (object) :
                 raise RuntimeError('cannot connect ssh after %d failures at interval %d s' %
                                    (max_check, sleep_time))
             dlog.info('connection check failed, try to reconnect to ' + self.remote_host)
-            self._setup_ssh(self.remote_host,
-                            self.remote_port,
-                            username=self.remote_uname,
-                            password=self.remote_password)
+            try :
+                self._setup_ssh(self.remote_host,
+                                self.remote_port,
+                                username=self.remote_uname,
+                                password=self.remote_password)
+            except Exception as err :
+                dlog.info('failed to reconnect to %s: %s' % (self.remote_host, err))
+                time.sleep(sleep_time)
             count += 1
-            time.sleep(sleep)
 
     def _check_alive(self):
-        if self.ssh == None:
+        if self.sftp_pool is None:
             return False
-        try :
-            transport = self.ssh.get_transport()
-            transport.send_ignore()
-            return True
-        except EOFError:
-            return False        
+        return all([_check_alive(ii) for ii in self.sftp_pool.clients])
 
     def _setup_ssh(self,
                    hostname,
                    port, 
                    username = None,
                    password = None):
-        self.ssh = paramiko.SSHClient()        
-        # ssh_client.load_system_host_keys()        
-        self.ssh.set_missing_host_key_policy(paramiko.WarningPolicy)
-        self.ssh.connect(hostname, port=port, username=username, password=password)
-        assert(self.ssh.get_transport().is_active())
-        transport = self.ssh.get_transport()
-        transport.set_keepalive(60)
+        if self.sftp_pool is not None :
+            self.sftp_pool.close()
+        # the connections are shared with the other sessions to the same host
+        clients = get_ssh_clients(hostname,
+                                  port,
+                                  username = username,
+                                  password = password,
+                                  number = max(self.ssh_connections, 1))
+        self.ssh = clients[0]
+        self.sftp_pool = SFTPPool(clients, self.sftp_channels)
 
     def get_ssh_client(self) :
         return self.ssh
 
+    @contextmanager
+    def sftp(self) :
+        """
+        borrow a sftp channel from the pool, the broken channel is discarded
+        """
+        sftp = self.sftp_pool.get()
+        try :
+            yield sftp
+        except :
+            self.sftp_pool.discard(sftp)
+            raise
+        self.sftp_pool.put(sftp)
+
     def get_session_root(self) :
         return self.remote_workpath
 
     def close(self) :
-        self.ssh.close()
+        # the connections are kept for the other sessions
+        self.sftp_pool.close()
 
 
 class SSHContext (object):
@@ -86,15 +245,18 @@ class SSHContext (object):
            self.job_uuid = str(uuid.uuid4())
         self.remote_root = os.path.join(ssh_session.get_session_root(), self.job_uuid)
         self.ssh_session = ssh_session
-        self.ssh = self.ssh_session.get_ssh_client()        
         self.ssh_session.ensure_alive()
         try:
-           sftp = self.ssh.open_sftp() 
-           sftp.mkdir(self.remote_root)
-           sftp.close()
+           with self.ssh_session.sftp() as sftp:
+               sftp.mkdir(self.remote_root)
         except: 
            pass
 
+    @property
+    def ssh(self) :
+        # the client may be replaced by the session after a reconnection
+        return self.ssh_session.get_ssh_client()
+
     def close(self):
         self.ssh_session.close()
 
@@ -106,32 +268,44 @@ class SSHContext (object):
                local_up_files,
                dereference = True) :
         self.ssh_session.ensure_alive()
-        cwd = os.getcwd()
-        os.chdir(self.local_root) 
         file_list = []
         for ii in job_dirs :
             for jj in local_up_files :
                 file_list.append(os.path.join(ii,jj))        
         self._put_files(file_list, dereference = dereference)
-        os.chdir(cwd)
 
     def download(self, 
                  job_dirs,
                  remote_down_files,
                  back_error=False) :
         self.ssh_session.ensure_alive()
-        cwd = os.getcwd()
-        os.chdir(self.local_root) 
         file_list = []
         for ii in job_dirs :
             for jj in remote_down_files :
                 file_list.append(os.path.join(ii,jj))
             if back_error:
-               errors=glob(os.path.join(ii,'error*'))
-               file_list.extend(errors)
+               errors=glob(os.path.join(self.local_root, ii, 'error*'))
+               file_list.extend([os.path.relpath(jj, self.local_root) for jj in errors])
         self._get_files(file_list)
-        os.chdir(cwd)
         
+    def link_files(self,
+                   source_root,
+                   files) :
+        """
+        symlink the files already uploaded to source_root on the remote
+        into the job root. this is done by one remote call.
+        """
+        self.ssh_session.ensure_alive()
+        script = ''
+        for ii in files :
+            dirname = os.path.dirname(ii)
+            if dirname != '' :
+                script += 'mkdir -p %s\n' % shlex.quote(dirname)
+            script += 'ln -sfn %s %s\n' % (shlex.quote(os.path.join(source_root, ii)), shlex.quote(ii))
+        script_name = self.job_uuid + '_link.sh'
+        self.write_file(script_name, script)
+        self.block_checkcall('bash %s && rm -f %s' % (script_name, script_name))
+
     def block_checkcall(self, 
                         cmd) :
         self.ssh_session.ensure_alive()
@@ -151,34 +325,30 @@ class SSHContext (object):
 
     def clean(self) :        
         self.ssh_session.ensure_alive()
-        sftp = self.ssh.open_sftp()        
-        self._rmtree(sftp, self.remote_root)
-        sftp.close()
+        with self.ssh_session.sftp() as sftp:
+            self._rmtree(sftp, self.remote_root)
 
     def write_file(self, fname, write_str):
         self.ssh_session.ensure_alive()
-        sftp = self.ssh.open_sftp()
-        with sftp.open(os.path.join(self.remote_root, fname), 'w') as fp :
-            fp.write(write_str)
-        sftp.close()
+        with self.ssh_session.sftp() as sftp:
+            with sftp.open(os.path.join(self.remote_root, fname), 'w') as fp :
+                fp.write(write_str)
 
     def read_file(self, fname):
         self.ssh_session.ensure_alive()
-        sftp = self.ssh.open_sftp()
-        with sftp.open(os.path.join(self.remote_root, fname), 'r') as fp:
-            ret = fp.read().decode('utf-8')
-        sftp.close()
+        with self.ssh_session.sftp() as sftp:
+            with sftp.open(os.path.join(self.remote_root, fname), 'r') as fp:
+                ret = fp.read().decode('utf-8')
         return ret
 
     def check_file_exists(self, fname):
         self.ssh_session.ensure_alive()
-        sftp = self.ssh.open_sftp()
-        try:
-            sftp.stat(os.path.join(self.remote_root, fname)) 
-            ret = True
-        except IOError:
-            ret = False
-        sftp.close()
+        with self.ssh_session.sftp() as sftp:
+            try:
+                sftp.stat(os.path.join(self.remote_root, fname)) 
+                ret = True
+            except IOError:
+                ret = False
         return ret        
         
     def call(self, cmd):
@@ -218,30 +388,114 @@ class SSHContext (object):
     def _put_files(self,
                    files,
                    dereference = True) :
+        file_cache = self.ssh_session.file_cache
+        if file_cache is not None and dereference :
+            hits, misses, files = file_cache.split_files(self.local_root, files)
+            misses += file_cache.link(self, hits)
+            files += [ii[0] for ii in misses]
+        if len(files) > 0 :
+            if self.ssh_session.transfer_mode == 'stream' :
+                self._put_stream(files, dereference = dereference)
+            else :
+                self._put_tar(files, dereference = dereference)
+        if file_cache is not None and dereference :
+            file_cache.register(self, misses)
+
+    def _put_tar(self,
+                 files,
+                 dereference = True) :
         of = self.job_uuid + '.tgz'
         # local tar
-        cwd = os.getcwd()
-        os.chdir(self.local_root)
-        if os.path.isfile(of) :
-            os.remove(of)
-        with tarfile.open(of, "w:gz", dereference = dereference) as tar:
+        from_f = os.path.join(self.local_root, of)
+        if os.path.isfile(from_f) :
+            os.remove(from_f)
+        with tarfile.open(from_f, "w:gz", dereference = dereference) as tar:
             for ii in files :
-                tar.add(ii)
-        os.chdir(cwd)
+                tar.add(os.path.join(self.local_root, ii), arcname = ii)
         # trans
-        from_f = os.path.join(self.local_root, of)
         to_f = os.path.join(self.remote_root, of)
-        sftp = self.ssh.open_sftp()
-        sftp.put(from_f, to_f)
+        with self.ssh_session.sftp() as sftp:
+            sftp.put(from_f, to_f)
         # remote extract
         self.block_checkcall('tar xf %s' % of)
         # clean up
         os.remove(from_f)
-        sftp.remove(to_f)
-        sftp.close()
+        with self.ssh_session.sftp() as sftp:
+            sftp.remove(to_f)
 
-    def _get_files(self, 
+    def _put_stream(self,
+                    files,
+                    dereference = True) :
+        # the tar is written to the stdin of the remote tar, nothing is stored on disk
+        if self.ssh_session.compress_level > 0 :
+            cmd = 'tar xzf -'
+        else :
+            cmd = 'tar xf -'
+        channel, stderr = self._exec_channel(cmd)
+        try :
+            with channel.makefile('wb') as chan_file :
+                if self.ssh_session.compress_level > 0 :
+                    fileobj = gzip.GzipFile(fileobj = chan_file, mode = 'wb', compresslevel = self.ssh_session.compress_level)
+                else :
+                    fileobj = chan_file
+                with tarfile.open(fileobj = fileobj, mode = 'w|', dereference = dereference) as tar:
+                    for ii in files :
+                        tar.add(os.path.join(self.local_root, ii), arcname = ii)
+                if fileobj is not chan_file :
+                    fileobj.close()
+        except OSError :
+            # the remote command exited, e.g. the remote root is not found
+            self._check_channel(channel, stderr, cmd)
+            raise
+        channel.shutdown_write()
+        self._check_channel(channel, stderr, cmd)
+
+    def _get_files(self,
                    files) :
+        if self.ssh_session.transfer_mode == 'stream' :
+            self._get_stream(files)
+        else :
+            self._get_tar(files)
+
+    def _get_stream(self,
+                    files) :
+        flist = " ".join([shlex.quote(ii) for ii in files])
+        if self.ssh_session.compress_level > 0 :
+            cmd = 'set -o pipefail; tar cf - %s | gzip -c -%d' % (flist, self.ssh_session.compress_level)
+            mode = 'r|gz'
+        else :
+            cmd = 'tar cf - %s' % flist
+            mode = 'r|'
+        channel, stderr = self._exec_channel('bash -c %s' % shlex.quote(cmd))
+        try :
+            with channel.makefile('rb') as chan_file :
+                with tarfile.open(fileobj = chan_file, mode = mode) as tar:
+                    tar.extractall(path = self.local_root)
+        except tarfile.TarError :
+            # the remote error is more informative
+            self._check_channel(channel, stderr, cmd)
+            raise
+        self._check_channel(channel, stderr, cmd)
+
+    def _exec_channel(self, cmd) :
+        """
+        run cmd in the remote root, returns the channel and the reader of its stderr
+        """
+        channel = self.ssh.get_transport().open_session()
+        channel.exec_command(('cd %s && ' % shlex.quote(self.remote_root)) + cmd)
+        return channel, _StderrReader(channel)
+
+    def _check_channel(self, channel, stderr, cmd) :
+        exit_status = channel.recv_exit_status()
+        err = stderr.text()
+        if exit_status != 0 :
+            channel.close()
+            raise RuntimeError("Get error code %d in calling %s through ssh with job: %s . message: %s" %
+                               (exit_status, cmd, self.job_uuid, err))
+        channel.close()
+
+    def _get_tar(self,
+                 files) :
         of = self.job_uuid + '.tgz'
         flist = ""
         for ii in files :
@@ -253,15 +507,12 @@ class SSHContext (object):
         to_f = os.path.join(self.local_root, of)
         if os.path.isfile(to_f) :
             os.remove(to_f)
-        sftp = self.ssh.open_sftp()
-        sftp.get(from_f, to_f)
+        with self.ssh_session.sftp() as sftp:
+            sftp.get(from_f, to_f)
         # extract
-        cwd = os.getcwd()
-        os.chdir(self.local_root)
-        with tarfile.open(of, "r:gz") as tar:
-            tar.extractall()
-        os.chdir(cwd)        
+        with tarfile.open(to_f, "r:gz") as tar:
+            tar.extractall(path = self.local_root)
         # cleanup
         os.remove(to_f)
-        sftp.remove(from_f)
-        sftp.close()
+        with self.ssh_session.sftp() as sftp:
+            sftp.remove(from_f)
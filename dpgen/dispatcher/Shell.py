@@ -1,6 +1,8 @@
 import os,getpass,time
 from dpgen.dispatcher.Batch import Batch
 from dpgen.dispatcher.JobStatus import JobStatus
+from dpgen.dispatcher.LocalPool import get_local_pool, release_local_pool
+from dpgen import dlog
 
 def _default_item(resources, key, value) :
     if key not in resources :
@@ -10,6 +12,8 @@ def _default_item(resources, key, value) :
 class Shell(Batch) :
 
     def check_status(self) :
+        if hasattr(self, 'task_procs'):
+            return self._check_status_pool()
         if not hasattr(self, 'proc'):
             return JobStatus.unsubmitted
         if not self.context.check_finish(self.proc) :
@@ -28,6 +32,10 @@ class Shell(Batch) :
                   errlog = 'err'):
         if res == None:
             res = {}
+        res = self.default_resources(res)
+        if res['local_pool'] :
+            self._submit_pool(job_dirs, cmd, args, res, outlog, errlog)
+            return
         script_str = self.sub_script(job_dirs, cmd, args=args, res=res, outlog=outlog, errlog=errlog)
         self.context.write_file(self.sub_script_name, script_str)
         self.proc = self.context.call('cd %s && exec bash %s' % (self.context.remote_root, self.sub_script_name))
@@ -47,8 +55,81 @@ class Shell(Batch) :
         _default_item(res, 'cuda_multi_tasks', False)
         _default_item(res, 'allow_failure', False)
         _default_item(res, 'cvasp', False)
+        _default_item(res, 'local_pool', False)
+        _default_item(res, 'pool_size', None)
+        _default_item(res, 'manual_cuda_devices', 0)
         return res
 
+    def _submit_pool(self,
+                     job_dirs,
+                     cmd,
+                     args,
+                     res,
+                     outlog,
+                     errlog) :
+        """
+        run each task of the job by the local pool of workers
+        """
+        if hasattr(self.context, 'ssh_session') :
+            raise RuntimeError('local_pool only works with the local contexts')
+        if not isinstance(cmd, list):
+            cmd = [cmd]
+        if args == None :
+            args = [['' for jj in job_dirs] for ii in cmd]
+        # a resubmitted job holds the pool once
+        self.release()
+        self.pool = get_local_pool(res['pool_size'], res['task_per_node'], res['manual_cuda_devices'])
+        head = self.sub_script_head(res)
+        self.task_procs = {}
+        self.task_codes = {}
+        for kk, task in enumerate(job_dirs) :
+            script_str = head + self._task_script(task, cmd, [ii[kk] for ii in args], res, outlog, errlog)
+            script_name = '%s.%d' % (self.sub_script_name, kk)
+            self.context.write_file(script_name, script_str)
+            self.task_procs[task] = self.pool.submit(os.path.join(self.context.remote_root, script_name),
+                                                self.context.remote_root)
+
+    def release(self) :
+        """
+        release the local pool once the tasks of the job are done
+        """
+        if getattr(self, 'pool', None) is not None :
+            release_local_pool(self.pool)
+            self.pool = None
+
+    def _task_script(self,
+                     task,
+                     cmd,
+                     args,
+                     res,
+                     outlog,
+                     errlog) :
+        # the script exits with the code of the failed command
+        ret = 'cd %s\n' % task
+        ret += 'test $? -ne 0 && exit 1\n\n'
+        for idx, (cc, aa) in enumerate(zip(cmd, args)) :
+            ret += 'if [ ! -f tag_%d_finished ] ;then\n' % idx
+            ret += '  %s 1>> %s 2>> %s \n' % (self.sub_script_cmd(cc, aa, res), outlog, errlog)
+            if res['allow_failure'] is False:
+                ret += '  ret=$?; if test $ret -ne 0; then exit $ret; fi \n'
+            ret += '  touch tag_%d_finished \n' % idx
+            ret += 'fi\n\n'
+        return ret
+
+    def _check_status_pool(self) :
+        if not all([ii.done() for ii in self.task_procs.values()]) :
+            return JobStatus.running
+        self.release()
+        self.task_codes = {task : proc.result() for task, proc in self.task_procs.items()}
+        failed = [task for task in self.task_codes if self.task_codes[task] != 0]
+        for task in failed :
+            dlog.info('task %s of job %s exits with code %d' % (task, self.context.job_uuid, self.task_codes[task]))
+        if len(failed) > 0 :
+            return JobStatus.terminated
+        if not self.check_finish_tag() :
+            self.context.write_file(self.finish_tag_name, '')
+        return JobStatus.finished
+
     def sub_script_head(self, resources) :
         envs = resources['envs']
         module_list = resources['module_list']
@@ -7,6 +7,7 @@ def _default_item(resources, key, value) :
         resources[key] = value
 
 class Slurm(Batch) :
+    array_index = '$SLURM_ARRAY_TASK_ID'
 
     def check_status(self) :
         """
@@ -40,7 +41,14 @@ class Slurm(Batch) :
         subret = (stdout.readlines())
         job_id = subret[0].split()[-1]
         self.context.write_file(self.job_id_name, job_id)        
+        self.job_id = job_id
                 
+    @classmethod
+    def _submit_array_script(cls, context, script_name, nelem, res) :
+        stdin, stdout, stderr = context.block_checkcall('cd %s && sbatch --array=0-%d %s' % (context.remote_root, nelem - 1, script_name))
+        job_id = stdout.readlines()[0].split()[-1]
+        return ['%s_%d' % (job_id, ii) for ii in range(nelem)]
+
     def default_resources(self, res_) :
         """
         set default value if a key in res_ is not fhound
@@ -143,12 +151,6 @@ class Slurm(Batch) :
                 _cmd = '%s %s' % (_cmd, arg)        
         return _cmd
 
-    def _get_job_id(self) :
-        if self.context.check_file_exists(self.job_id_name) :
-            return self.context.read_file(self.job_id_name)
-        else:
-            return ""
-
     def _check_status_inner(self, job_id):
         ret, stdin, stdout, stderr\
             = self.context.block_call ("squeue --job " + job_id)
@@ -162,8 +164,18 @@ class Slurm(Batch) :
             else :
                 raise RuntimeError\
                     ("status command squeue fails to execute\nerror message:%s\nreturn code %d\n" % (err_str, ret))
-        status_line = stdout.read().decode('utf-8').split ('\n')[-2]
+        status_lines = stdout.read().decode('utf-8').split ('\n')
+        if len(status_lines) < 3 :
+            # only the header, e.g. a finished element of a job array
+            if self.check_finish_tag() :
+                return JobStatus.finished
+            else :
+                return JobStatus.terminated
+        status_line = status_lines[-2]
         status_word = status_line.split ()[-4]
+        return self._check_status_word(status_word)
+
+    def _check_status_word(self, status_word):
         if status_word in ["PD","CF","S"] :
             return JobStatus.waiting
         elif status_word in ["R"] :
@@ -178,6 +190,45 @@ class Slurm(Batch) :
         else :
             return JobStatus.unknown                    
 
+    @classmethod
+    def check_status_all(cls, batches, max_query = 1000):
+        """
+        check the status of all jobs with one squeue call (per max_query jobs)
+        """
+        job_ids = [bb._get_job_id() for bb in batches]
+        ret = [JobStatus.unsubmitted] * len(batches)
+        submitted = [ii for ii in range(len(batches)) if job_ids[ii] != '']
+        for start in range(0, len(submitted), max_query):
+            group = submitted[start:start+max_query]
+            context = batches[group[0]].context
+            code, stdin, stdout, stderr \
+                = context.block_call('squeue -h -r -o "%%i %%t" -j %s' % ','.join([job_ids[ii] for ii in group]))
+            if code != 0 :
+                err_str = stderr.read().decode('utf-8')
+                if str("Invalid job id specified") in err_str :
+                    # the whole query is refused if one job is unknown
+                    for ii in group:
+                        ret[ii] = batches[ii].check_status()
+                    continue
+                else :
+                    raise RuntimeError\
+                        ("status command squeue fails to execute\nerror message:%s\nreturn code %d\n" % (err_str, code))
+            status_words = {}
+            for line in stdout.read().decode('utf-8').split('\n'):
+                words = line.split()
+                if len(words) >= 2:
+                    status_words[words[0]] = words[1]
+            for ii in group:
+                if job_ids[ii] in status_words:
+                    stat = batches[ii]._check_status_word(status_words[job_ids[ii]])
+                    if stat == JobStatus.completing:
+                        stat = JobStatus.running
+                elif batches[ii].check_finish_tag() :
+                    stat = JobStatus.finished
+                else :
+                    stat = JobStatus.terminated
+                ret[ii] = stat
+        return ret
 
     def _check_sub_limit(self, task_max, **kwarg) :
         if task_max <= 0:
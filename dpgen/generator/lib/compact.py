@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+"""
+Store of the fp data of the iterations merged into a few deepmd/npy
+systems, one for each sys_idx and type.raw. The frames of each merged
+iteration go to new sets of at most set_size frames, a committed set is
+never changed. The sets left by an interrupted append are removed. Each
+training takes a snapshot of the store, with the sets hardlinked, so the
+data of a past training does not change as the store grows. The store is
+recorded in compact.json:
+
+iters(int):         the iterations [0, iters) are in the store
+params(dict):       the settings the store is made with, the store is made
+                    again if they change
+systems(dict):      name -> {sys_idx, type_raw (sha1 of type.raw), sets
+                    (list of [set name, nframes]), next (index of the next
+                    set name), nframes}
+"""
+
+import os,glob,json,shutil,hashlib
+import numpy as np
+
+record_name = 'compact.json'
+# sorted in the order of appending, by the name
+set_name = 'set.%06d'
+
+
+def _type_sha1(sys_path) :
+    with open(os.path.join(sys_path, 'type.raw'), 'rb') as fp :
+        return hashlib.sha1(fp.read()).hexdigest()
+
+def load_frames(sys_path) :
+    """
+    the arrays of all sets of the deepmd/npy system, keyed by the names
+    of the npy files found in every set
+    """
+    sets = sorted(glob.glob(os.path.join(sys_path, 'set.*')))
+    names = None
+    for ii in sets :
+        set_names = set([os.path.basename(jj) for jj in glob.glob(os.path.join(ii, '*.npy'))])
+        names = set_names if names is None else names & set_names
+    ret = {}
+    for name in sorted(names or []) :
+        ret[name] = np.concatenate([np.load(os.path.join(ii, name)) for ii in sets])
+    return ret
+
+
+class CompactStore(object):
+    """
+    The store of the merged fp data in path
+    """
+    def __init__ (self, path, params) :
+        self.path = path
+        self.fname = os.path.join(path, record_name)
+        self.record = None
+        if os.path.isfile(self.fname) :
+            with open(self.fname) as fp :
+                self.record = json.load(fp)
+        if self.record is None or self.record['params'] != params or \
+           any(['sets' not in ss for ss in self.record['systems'].values()]) :
+            # new store, made with other settings or by an older version
+            self.reset(params)
+        # the systems and sets left by an interrupted append
+        self._clean()
+
+    def _clean(self) :
+        # remove the systems and sets not in the record
+        for ii in glob.glob(os.path.join(self.path, 'sys.*')) :
+            if os.path.basename(ii) not in self.record['systems'] :
+                shutil.rmtree(ii)
+        for name, ss in self.record['systems'].items() :
+            sets = [jj[0] for jj in ss['sets']]
+            for ii in glob.glob(os.path.join(self.path, name, 'set.*')) :
+                if os.path.basename(ii) not in sets :
+                    shutil.rmtree(ii)
+
+    def reset(self, params = None) :
+        """
+        remove all data of the store
+        """
+        if params is None :
+            params = self.record['params']
+        if os.path.isdir(self.path) :
+            shutil.rmtree(self.path)
+        os.makedirs(self.path)
+        self.record = {'iters': 0, 'params': params, 'systems': {}}
+
+    def _find_system(self, sys_idx, type_raw) :
+        for name, ss in self.record['systems'].items() :
+            if ss['sys_idx'] == sys_idx and ss['type_raw'] == type_raw :
+                return name
+        count = len([ss for ss in self.record['systems'].values() if ss['sys_idx'] == sys_idx])
+        name = 'sys.%03d.%d' % (sys_idx, count)
+        self.record['systems'][name] = {'sys_idx': sys_idx, 'type_raw': type_raw, 'sets': [], 'next': 0, 'nframes': 0}
+        return name
+
+    def append(self, sys_path, sys_idx, keep, set_size) :
+        """
+        append the frames keep of the system sys_path to the store
+        """
+        name = self._find_system(sys_idx, _type_sha1(sys_path))
+        ss = self.record['systems'][name]
+        dst = os.path.join(self.path, name)
+        os.makedirs(dst, exist_ok = True)
+        for ii in ['type.raw', 'type_map.raw'] :
+            if os.path.isfile(os.path.join(sys_path, ii)) and not os.path.isfile(os.path.join(dst, ii)) :
+                shutil.copyfile(os.path.join(sys_path, ii), os.path.join(dst, ii))
+        keep = np.array(keep, dtype = int)
+        frames = {key : data[keep] for key, data in load_frames(sys_path).items()}
+        nframes = len(list(frames.values())[0]) if len(frames) > 0 else 0
+        for start in range(0, nframes, set_size) :
+            set_path = os.path.join(dst, set_name % ss['next'])
+            os.makedirs(set_path)
+            for key, data in frames.items() :
+                np.save(os.path.join(set_path, key), data[start:start+set_size])
+            ss['sets'].append([os.path.basename(set_path), min(set_size, nframes - start)])
+            ss['next'] += 1
+        ss['nframes'] += len(keep)
+
+    def commit(self, iters) :
+        """
+        record that the iterations [0, iters) are in the store
+        """
+        self.record['iters'] = iters
+        with open(self.fname + '.tmp', 'w') as fp :
+            json.dump(self.record, fp, indent = 4)
+        os.replace(self.fname + '.tmp', self.fname)
+
+    def snapshot(self, path) :
+        """
+        link the committed systems of the store into path, the files of the
+        sets are hardlinked (copied if not possible)
+        """
+        for name, ss in self.record['systems'].items() :
+            if ss['nframes'] == 0 :
+                continue
+            src = os.path.join(self.path, name)
+            dst = os.path.join(path, name)
+            os.makedirs(dst)
+            for ii in ['type.raw', 'type_map.raw'] :
+                if os.path.isfile(os.path.join(src, ii)) :
+                    shutil.copyfile(os.path.join(src, ii), os.path.join(dst, ii))
+            for sname, _ in ss['sets'] :
+                os.makedirs(os.path.join(dst, sname))
+                for ii in glob.glob(os.path.join(src, sname, '*.npy')) :
+                    fname = os.path.join(dst, sname, os.path.basename(ii))
+                    try :
+                        os.link(ii, fname)
+                    except OSError :
+                        shutil.copyfile(ii, fname)
+
+    def systems(self) :
+        """
+        the names and sys_idx of the systems of the store
+        """
+        return sorted([(name, ss['sys_idx']) for name, ss in self.record['systems'].items() if ss['nframes'] > 0])
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+"""
+Check of the compressed models against the frozen ones, before they are
+used by the exploration. Both models are evaluated by dp test on a test set
+kept in check/ of each train task, and run by a short LAMMPS benchmark. A
+compressed model is used only if its energies and forces agree with the
+frozen model. The frames of the test set are randomly perturbed, so the
+models are compared on configurations they are not trained on; only the
+predictions of the two models are compared, the labels are not used. The
+settings are given by the dp_compress_check dict of the parameters:
+
+systems(list):  systems of the test set, relative to init_data_prefix,
+                default init_data_sys
+nframes(int):   number of frames taken from the end of each system, default 10
+perturb(float): maximum displacement (A) of the atoms of the test frames,
+                default 0.05
+e_tol(float):   tolerance of the energy deviation per atom (eV), default 1e-3
+f_tol(float):   tolerance of the force deviation (eV/A), default 1e-2
+lmp_steps(int): steps of the LAMMPS benchmark, default 100, 0 to skip
+"""
+
+import os,re,glob,random
+import numpy as np
+import dpdata
+
+check_name = 'check'
+
+
+def check_params(params, jdata) :
+    ret = {'systems': jdata['init_data_sys'], 'nframes': 10, 'perturb': 0.05,
+           'e_tol': 1e-3, 'f_tol': 1e-2, 'lmp_steps': 100}
+    ret.update(params)
+    return ret
+
+def _lammps_input(masses, lmp_steps) :
+    ret = "units           metal\n"
+    ret+= "boundary        p p p\n"
+    ret+= "atom_style      atomic\n"
+    ret+= "\n"
+    ret+= "box          tilt large\n"
+    ret+= "read_data       %s\n" % os.path.join(check_name, 'conf.lmp')
+    ret+= "change_box   all triclinic\n"
+    for jj in range(len(masses)) :
+        ret+= "mass            %d %f\n" %(jj+1, masses[jj])
+    ret+= "pair_style      deepmd ${MODEL}\n"
+    ret+= "pair_coeff      \n"
+    ret+= "\n"
+    ret+= "velocity        all create 300 %d\n" % (random.randrange(999999)+1)
+    ret+= "fix             1 all nve\n"
+    ret+= "timestep        0.001\n"
+    ret+= "thermo          %d\n" % lmp_steps
+    ret+= "run             %d\n" % lmp_steps
+    return ret
+
+def make_check_data(check_path, sys_paths, params, type_map, mass_map) :
+    """
+    write the test set and the LAMMPS benchmark input to check_path. the
+    atom types of the test set follow type_map, as those of the models.
+    """
+    os.makedirs(check_path, exist_ok = True)
+    for idx, ii in enumerate(sys_paths) :
+        system = dpdata.LabeledSystem(ii, fmt = 'deepmd/npy', type_map = type_map)
+        if len(system['atom_names']) > len(type_map) :
+            raise RuntimeError('the atom names %s of the check system %s are not in the type_map' % (system['atom_names'], ii))
+        nframes = system.get_nframes()
+        system = system.sub_system(list(range(max(nframes - params['nframes'], 0), nframes)))
+        # not the configurations of the training data
+        system.data['coords'] += np.random.uniform(-params['perturb'], params['perturb'], system.data['coords'].shape)
+        system.to_deepmd_npy(os.path.join(check_path, 'sys.%03d' % idx), set_size = params['nframes'])
+        if idx == 0 :
+            system.sub_system([0]).to_lammps_lmp(os.path.join(check_path, 'conf.lmp'))
+            # the masses of the atom types of the conf
+            masses = mass_map[:len(system['atom_names'])]
+    with open(os.path.join(check_path, 'in.lammps'), 'w') as fp :
+        fp.write(_lammps_input(masses, params['lmp_steps']))
+
+def check_files(task_path) :
+    """
+    the files of the test set of the task, relative to the task path
+    """
+    files = glob.glob(os.path.join(task_path, check_name, '*'))
+    files += glob.glob(os.path.join(task_path, check_name, 'sys.*', '*.raw'))
+    files += glob.glob(os.path.join(task_path, check_name, 'sys.*', 'set.*', '*.npy'))
+    return sorted([os.path.relpath(ii, task_path) for ii in files if os.path.isfile(ii)])
+
+def _nsystems(task_path) :
+    return len(glob.glob(os.path.join(task_path, check_name, 'sys.*')))
+
+def check_commands(python_path, lmp_command, models, nsys, params) :
+    """
+    the commands of the check, and the files they make. models are the
+    names and files of the models, e.g. {'raw': 'frozen_model.pb'}. the
+    benchmark is skipped if lmp_command is None. a failed command does not
+    fail the job: its exit code is written to its log, and its outputs are
+    left empty, so the check of the model is not passed.
+    """
+    commands = []
+    files = []
+    for name, model in models.items() :
+        for ii in range(nsys) :
+            detail = 'check_%s.%03d' % (name, ii)
+            command = '%s -m deepmd test -m %s -s %s -n %d -d %s' % \
+                      (python_path, model, os.path.join(check_name, 'sys.%03d' % ii), params['nframes'], detail)
+            commands.append('{ %s 1> %s.log 2>&1 || echo "check failed with exit code $?" >> %s.log; touch %s.e.out %s.f.out; }' %
+                            (command, detail, detail, detail, detail))
+            files += [detail + '.e.out', detail + '.f.out', detail + '.log']
+        if lmp_command is not None and params['lmp_steps'] > 0 :
+            log = 'check_%s.lammps.log' % name
+            command = '%s -i %s -var MODEL %s -log %s -screen none' % \
+                      (lmp_command, os.path.join(check_name, 'in.lammps'), model, log)
+            commands.append('{ %s || echo "check failed with exit code $?" >> %s; touch %s; }' % (command, log, log))
+            files.append(log)
+    return commands, files
+
+def _check_error(fname) :
+    # the last lines of the log of a failed command
+    if not os.path.isfile(fname) :
+        return '%s is not found' % fname
+    with open(fname) as fp :
+        lines = [ii.strip() for ii in fp.read().split('\n') if ii.strip() != '']
+    if len(lines) == 0 :
+        return '%s is empty' % fname
+    return '%s: %s' % (fname, ' | '.join(lines[-5:]))
+
+def _loop_time(fname) :
+    if not os.path.isfile(fname) :
+        return None
+    with open(fname) as fp :
+        ret = re.findall(r'Loop time of ([0-9.eE+-]+) on', fp.read())
+    return float(ret[-1]) if len(ret) > 0 else None
+
+def _load_detail(fname) :
+    if not os.path.isfile(fname) or os.path.getsize(fname) == 0 :
+        return None
+    return np.loadtxt(fname, ndmin = 2)
+
+def check_models(task_path, params, ref = 'raw', test = 'compressed') :
+    """
+    compare the predictions of the model test to those of the model ref
+    on the test set. returns the max deviations of the energy per atom and
+    the forces, the benchmark loop times, if the deviations are within
+    the tolerances, and the errors of the failed commands. the check is not
+    passed if any output is missing or empty.
+    """
+    ret = {'e_dev': None, 'f_dev': None,
+           '%s_time' % ref: None,
+           '%s_time' % test: None,
+           'passed': False,
+           'errors': []}
+    for name in [ref, test] :
+        log = os.path.join(task_path, 'check_%s.lammps.log' % name)
+        ret['%s_time' % name] = _loop_time(log)
+        if params['lmp_steps'] > 0 and ret['%s_time' % name] is None and os.path.isfile(log) :
+            # the benchmark does not decide the check
+            ret['errors'].append(_check_error(log))
+    nsys = _nsystems(task_path)
+    if nsys == 0 :
+        ret['errors'].append('no test set in %s' % os.path.join(task_path, check_name))
+        return ret
+    e_dev = 0.
+    f_dev = 0.
+    for ii in range(nsys) :
+        natoms = np.loadtxt(os.path.join(task_path, check_name, 'sys.%03d' % ii, 'type.raw'), ndmin = 1).size
+        data = {}
+        for name in [ref, test] :
+            for kk in ['e', 'f'] :
+                data[(name, kk)] = _load_detail(os.path.join(task_path, 'check_%s.%03d.%s.out' % (name, ii, kk)))
+            if data[(name, 'e')] is None or data[(name, 'f')] is None :
+                ret['errors'].append(_check_error(os.path.join(task_path, 'check_%s.%03d.log' % (name, ii))))
+        if any([jj is None for jj in data.values()]) :
+            return ret
+        # the predictions are the last columns
+        e_dev = max(e_dev, np.max(np.abs(data[(test, 'e')][:, -1] - data[(ref, 'e')][:, -1])) / natoms)
+        f_dev = max(f_dev, np.max(np.abs(data[(test, 'f')][:, -3:] - data[(ref, 'f')][:, -3:])))
+    ret['e_dev'] = float(e_dev)
+    ret['f_dev'] = float(f_dev)
+    ret['passed'] = bool(e_dev <= params['e_tol'] and f_dev <= params['f_tol'])
+    return ret
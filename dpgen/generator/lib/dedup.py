@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+"""
+Local environments of the labeled frames, to prune the duplicate frames
+before training. The environment of an atom is the sorted distances to its
+neighbours of each type within rcut (all periodic images), padded by rcut.
+Two frames are duplicates if their atoms can be paired, each atom with one
+of the same type, such that the environments of all pairs agree within tol
+(in Angstrom). A frame that differs from all frames seen before in the
+environment of any atom is kept. The settings are given by the
+training_dedup dict of the parameters:
+
+rcut(float):    cutoff of the neighbours, default 6.0
+tol(float):     tolerance of the neighbour distances, default 0.01
+"""
+
+import os,glob,json
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import maximum_bipartite_matching
+
+
+def default_params(params) :
+    ret = {'rcut': 6.0, 'tol': 0.01}
+    ret.update({kk : params[kk] for kk in ret if kk in params})
+    return ret
+
+def _image_range(cell, rcut) :
+    """
+    the numbers of the periodic images along the cell vectors that may hold
+    a neighbour within rcut of an atom in the cell
+    """
+    volume = abs(np.linalg.det(cell))
+    ret = []
+    for ii in range(3) :
+        # the distance between the lattice planes spanned by the other vectors
+        dd = volume / np.linalg.norm(np.cross(cell[(ii + 1) % 3], cell[(ii + 2) % 3]))
+        ret.append(int(np.ceil(rcut / dd)))
+    return ret
+
+def frame_descriptors(coord, cell, atom_types, ntypes, rcut) :
+    """
+    the environments of the atoms of a frame, a list of arrays
+    [natoms, nnei] of the neighbours of each type, sorted and padded by rcut
+    """
+    natoms = coord.shape[0]
+    frac = np.dot(coord, np.linalg.inv(cell))
+    coord = np.dot(frac - np.floor(frac), cell)
+    diff = coord[None,:,:] - coord[:,None,:]
+    nx, ny, nz = _image_range(cell, rcut)
+    dists = []
+    for ix in range(-nx, nx + 1) :
+        for iy in range(-ny, ny + 1) :
+            for iz in range(-nz, nz + 1) :
+                shift = np.dot(np.array([ix, iy, iz]), cell)
+                dist = np.linalg.norm(diff + shift, axis = 2)
+                if ix == 0 and iy == 0 and iz == 0 :
+                    np.fill_diagonal(dist, rcut)
+                dists.append(np.minimum(dist, rcut))
+    dists = np.concatenate(dists, axis = 1)
+    neigh_types = np.tile(atom_types, len(dists[0]) // natoms)
+    ret = []
+    for tt in range(ntypes) :
+        dd = np.sort(dists[:, neigh_types == tt], axis = 1)
+        nnei = int(np.max(np.sum(dd < rcut, axis = 1))) if dd.size > 0 else 0
+        ret.append(dd[:, :nnei])
+    return ret
+
+def _pad(descs, widths, rcut) :
+    return [np.pad(dd, [(0, 0)] * (dd.ndim - 1) + [(0, ww - dd.shape[-1])], constant_values = rcut) \
+            for dd, ww in zip(descs, widths)]
+
+def system_descriptors(sys_path, rcut) :
+    """
+    the environments of the atoms of all frames of the deepmd/npy system, a
+    list of arrays [nframes, natoms, nnei] of the neighbours of each type
+    """
+    atom_types = np.loadtxt(os.path.join(sys_path, 'type.raw'), dtype = int, ndmin = 1)
+    ntypes = int(atom_types.max()) + 1
+    frames = []
+    for ii in sorted(glob.glob(os.path.join(sys_path, 'set.*'))) :
+        coords = np.load(os.path.join(ii, 'coord.npy')).reshape([-1, atom_types.size, 3])
+        cells = np.load(os.path.join(ii, 'box.npy')).reshape([-1, 3, 3])
+        for coord, cell in zip(coords, cells) :
+            frames.append(frame_descriptors(coord, cell, atom_types, ntypes, rcut))
+    widths = [max([ff[tt].shape[1] for ff in frames] + [0]) for tt in range(ntypes)]
+    frames = [_pad(ff, widths, rcut) for ff in frames]
+    return [np.array([ff[tt] for ff in frames]).reshape([len(frames), atom_types.size, widths[tt]]) \
+            for tt in range(ntypes)]
+
+def _match(desc0, desc1, tol) :
+    """
+    if the atoms of the same type of the two frames can be paired with the
+    environments agreeing within tol. the descriptors are lists of the
+    arrays [natoms, nnei] of the atoms of the type.
+    """
+    close = None
+    for d0, d1 in zip(desc0, desc1) :
+        cc = np.max(np.abs(d0[:,None,:] - d1[None,:,:]), axis = 2, initial = 0) <= tol
+        close = cc if close is None else close & cc
+    if not np.all(np.any(close, axis = 1)) or not np.all(np.any(close, axis = 0)) :
+        return False
+    matching = maximum_bipartite_matching(csr_matrix(close), perm_type = 'column')
+    return bool(np.all(matching >= 0))
+
+
+class FrameDedup(object):
+    """
+    The frames seen so far, grouped by the numbers of atoms of each type
+    """
+    def __init__ (self, params) :
+        self.params = default_params(params)
+        self.seen = {}
+        self.summary = {}
+
+    def _load(self, manifest, sys_path) :
+        """
+        the descriptors of the system, cached in the fp work path and
+        recorded in the manifest
+        """
+        record = manifest.info(sys_path)
+        fname = os.path.join(manifest.fp_path, 'dedup.%s.npz' % record['checksum'][:16])
+        if record.get('descriptor_params') == self.params and os.path.isfile(fname) :
+            with np.load(fname) as data :
+                return [data['type_%d' % ii] for ii in range(len(data.files))]
+        descs = system_descriptors(sys_path, self.params['rcut'])
+        np.savez(fname, **{'type_%d' % ii : dd for ii, dd in enumerate(descs)})
+        record['descriptor_params'] = self.params
+        # the hashes of the older versions
+        record.pop('fingerprints', None)
+        record.pop('fingerprint_params', None)
+        manifest.changed = True
+        return descs
+
+    def select(self, manifest, sys_path) :
+        """
+        the indexes of the frames of the system that duplicate no frame
+        seen before
+        """
+        rcut = self.params['rcut']
+        tol = self.params['tol']
+        record = manifest.info(sys_path)
+        descs = self._load(manifest, sys_path)
+        atom_types = np.loadtxt(os.path.join(sys_path, 'type.raw'), dtype = int, ndmin = 1)
+        group = self.seen.setdefault(json.dumps(record['type_counts']), {'widths': [0] * len(descs), 'frames': []})
+        # the same number of neighbours for the system and the seen frames
+        widths = [max(ii, dd.shape[2]) for ii, dd in zip(group['widths'], descs)]
+        descs = _pad(descs, widths, rcut)
+        if widths != group['widths'] :
+            for ff in group['frames'] :
+                ff['desc'] = [_pad(dd, widths, rcut) for dd in ff['desc']]
+                ff['mean'] = [_pad(mm, widths, rcut) for mm in ff['mean']]
+            group['widths'] = widths
+        types = sorted(set(atom_types.tolist()))
+        keep = []
+        for idx in range(record['nframes']) :
+            # the environments of the atoms of each type
+            desc = [[dd[idx][atom_types == tt] for dd in descs] for tt in types]
+            # paired environments within tol have their means within tol
+            mean = [[np.mean(dd, axis = 0) for dd in ff] for ff in desc]
+            dup = False
+            for ff in group['frames'] :
+                if any([np.max(np.abs(m0 - m1), initial = 0) > tol \
+                        for mm0, mm1 in zip(mean, ff['mean']) for m0, m1 in zip(mm0, mm1)]) :
+                    continue
+                if all([_match(d0, d1, tol) for d0, d1 in zip(desc, ff['desc'])]) :
+                    dup = True
+                    break
+            if not dup :
+                group['frames'].append({'desc': desc, 'mean': mean})
+                keep.append(idx)
+        self.summary[sys_path] = [len(keep), record['nframes']]
+        return keep
+
+    def pruned(self) :
+        """
+        the numbers of pruned frames and all frames
+        """
+        nkeep = sum([ii[0] for ii in self.summary.values()])
+        nall = sum([ii[1] for ii in self.summary.values()])
+        return nall - nkeep, nall
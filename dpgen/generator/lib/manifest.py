@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+"""
+Manifest of the deepmd systems data.* made by post_fp, kept in
+data_manifest.json of the fp work path. Each system is recorded by its
+path relative to the fp work path:
+
+nframes(int):           number of frames
+natoms(int):            number of atoms, None if type.raw is not found
+type_counts(list):      number of atoms of each type
+checksum(str):          sha1 of the contents of the data files
+stamp(str):             sha1 of the names, sizes and mtimes of the data files
+
+A record is reused as long as the stamp of the files is unchanged, so only
+the new or changed systems are read.
+"""
+
+import os,glob,json,hashlib
+import numpy as np
+
+manifest_name = 'data_manifest.json'
+
+
+def _system_files(sys_path) :
+    files = []
+    for ii in ['type.raw', 'box.raw'] :
+        if os.path.isfile(os.path.join(sys_path, ii)) :
+            files.append(os.path.join(sys_path, ii))
+    for ii in sorted(glob.glob(os.path.join(sys_path, 'set.*'))) :
+        files += sorted(glob.glob(os.path.join(ii, '*.npy')))
+    return files
+
+def _stamp(sys_path, files) :
+    ret = hashlib.sha1()
+    for ii in files :
+        st = os.stat(ii)
+        ret.update(('%s %d %d\n' % (os.path.relpath(ii, sys_path), st.st_size, st.st_mtime_ns)).encode('utf-8'))
+    return ret.hexdigest()
+
+def _checksum(files) :
+    ret = hashlib.sha1()
+    for ii in files :
+        with open(ii, 'rb') as fp :
+            for chunk in iter(lambda : fp.read(1 << 20), b'') :
+                ret.update(chunk)
+    return ret.hexdigest()
+
+def is_system(path) :
+    return os.path.isfile(os.path.join(path, 'box.raw')) or \
+        len(glob.glob(os.path.join(path, 'set.*'))) > 0
+
+def system_info(sys_path, checksum = False) :
+    """
+    the info of the deepmd system. the frames are counted by the headers of
+    set.*/box.npy, box.raw is read only if there is no set.
+    """
+    files = _system_files(sys_path)
+    type_file = os.path.join(sys_path, 'type.raw')
+    if os.path.isfile(type_file) :
+        atom_types = np.loadtxt(type_file, dtype = int, ndmin = 1)
+        natoms = int(atom_types.size)
+        type_counts = np.bincount(atom_types).tolist()
+    else :
+        natoms = None
+        type_counts = None
+    sets = sorted(glob.glob(os.path.join(sys_path, 'set.*')))
+    if len(sets) > 0 :
+        nframes = sum([np.load(os.path.join(ii, 'box.npy'), mmap_mode = 'r').shape[0] for ii in sets])
+    else :
+        nframes = np.reshape(np.loadtxt(os.path.join(sys_path, 'box.raw')), [-1, 9]).shape[0]
+    ret = {'nframes': int(nframes),
+           'natoms': natoms,
+           'type_counts': type_counts,
+           'stamp': _stamp(sys_path, files)}
+    if checksum :
+        ret['checksum'] = _checksum(files)
+    return ret
+
+
+class DataManifest(object):
+    """
+    The manifest of the systems in the fp work path
+    """
+    def __init__ (self, fp_path) :
+        self.fp_path = fp_path
+        self.fname = os.path.join(fp_path, manifest_name)
+        self.records = {}
+        if os.path.isfile(self.fname) :
+            with open(self.fname) as fp :
+                self.records = json.load(fp)
+        self.changed = False
+
+    def info(self, sys_path) :
+        """
+        the info of the system, read only if it is new or changed
+        """
+        key = os.path.relpath(sys_path, self.fp_path)
+        record = self.records.get(key)
+        if record is not None and record['stamp'] == _stamp(sys_path, _system_files(sys_path)) :
+            return record
+        self.records[key] = system_info(sys_path, checksum = True)
+        self.changed = True
+        return self.records[key]
+
+    def update(self) :
+        """
+        record all systems data.* (or data.*/*, for clusters) of the fp work path
+        """
+        systems = []
+        for ii in sorted(glob.glob(os.path.join(self.fp_path, 'data.*'))) :
+            if not os.path.isdir(ii) :
+                continue
+            if is_system(ii) :
+                systems.append(ii)
+            else :
+                systems += [jj for jj in sorted(glob.glob(os.path.join(ii, '*'))) if is_system(jj)]
+        keys = [os.path.relpath(ii, self.fp_path) for ii in systems]
+        for ii in list(self.records.keys()) :
+            if ii not in keys :
+                del self.records[ii]
+                self.changed = True
+        for ii in systems :
+            self.info(ii)
+        self.dump()
+
+    def dump(self) :
+        """
+        write the manifest if it is changed
+        """
+        if not self.changed :
+            return
+        with open(self.fname + '.tmp', 'w') as fp :
+            json.dump(self.records, fp, indent = 4)
+        os.replace(self.fname + '.tmp', self.fname)
+        self.changed = False
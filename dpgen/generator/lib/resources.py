@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+"""
+Size the fp resources of each job by the number of atoms and k-points of
+its tasks. The settings are given by the auto_size dict of fp_resources:
+
+cores_per_node(int):    cores of a node, default task_per_node
+atoms_per_core(float):  atoms handled by each MPI rank of a k-point group, default 4
+max_node(int):          maximum number of nodes of a job, default numb_node
+max_kpar(int):          maximum KPAR, default 4
+time_per_unit(float):   walltime (s) per natoms^3 x nkpts / ranks, calibrated
+                        by the finished jobs of the earlier iterations if not set
+time_factor(float):     safety factor of the walltime, default 2
+min_time(str):          minimum walltime, default 0:10:0
+max_time(str):          maximum walltime, default 24:0:0
+
+The resources of each chunk of tasks are recorded in chunk_resources.json of
+the fp work path, and used to calibrate time_per_unit later on.
+"""
+
+import os,copy,math,json,threading
+import numpy as np
+from dpgen.auto_test.lib.vasp import make_kspacing_kpoints
+from dpgen.dispatcher.JobRecord import JobRecord
+
+chunk_resources_name = 'chunk_resources.json'
+# the pipeline threads size their fp chunks at the same time
+_chunk_resources_lock = threading.Lock()
+
+
+def _parse_time(time_str) :
+    words = [int(ii) for ii in time_str.split(':')]
+    while len(words) < 3 :
+        words.append(0)
+    return words[0] * 3600 + words[1] * 60 + words[2]
+
+def _format_time(seconds) :
+    seconds = int(math.ceil(seconds))
+    return '%d:%02d:%02d' % (seconds // 3600, (seconds % 3600) // 60, seconds % 60)
+
+def _count_kpoints(lines) :
+    nkpts = int(lines[1].split()[0])
+    if nkpts > 0 :
+        # explicit list of k-points
+        return nkpts
+    return int(np.prod([int(ii) for ii in lines[3].split()[:3]]))
+
+def _read_incar(fname) :
+    ret = {}
+    with open(fname) as fp :
+        for line in fp :
+            line = line.split('#')[0].split('!')[0]
+            for item in line.split(';') :
+                if '=' in item :
+                    key, val = item.split('=', 1)
+                    ret[key.strip().upper()] = val.strip()
+    return ret
+
+def task_size(task_path) :
+    """
+    return the number of atoms and k-points of the fp task. the k-points
+    are read from KPOINTS, or made by the KSPACING of INCAR. 1 k-point if
+    neither is found.
+    """
+    poscar = os.path.join(task_path, 'POSCAR')
+    with open(poscar) as fp :
+        lines = fp.read().split('\n')
+    if lines[5].split()[0].isdigit() :
+        natoms = sum([int(ii) for ii in lines[5].split()])
+    else :
+        natoms = sum([int(ii) for ii in lines[6].split()])
+    nkpts = 1
+    kpoints = os.path.join(task_path, 'KPOINTS')
+    incar = os.path.join(task_path, 'INCAR')
+    if os.path.isfile(kpoints) :
+        with open(kpoints) as fp :
+            nkpts = _count_kpoints(fp.read().split('\n'))
+    elif os.path.isfile(incar) :
+        incar_dict = _read_incar(incar)
+        if 'KSPACING' in incar_dict :
+            kgamma = incar_dict.get('KGAMMA', 'T').lstrip('.').upper().startswith('T')
+            ret = make_kspacing_kpoints(poscar, float(incar_dict['KSPACING']), kgamma)
+            nkpts = _count_kpoints(ret.split('\n'))
+    return natoms, nkpts
+
+def size_task(auto_size, resources, natoms, nkpts) :
+    """
+    return the number of nodes, the MPI ranks per node, NPAR and KPAR of a task
+    """
+    cores_per_node = auto_size.get('cores_per_node', resources.get('task_per_node', 1))
+    atoms_per_core = auto_size.get('atoms_per_core', 4)
+    max_node = auto_size.get('max_node', resources.get('numb_node', 1))
+    max_kpar = auto_size.get('max_kpar', 4)
+    max_ranks = max_node * cores_per_node
+    ranks_per_kpt = min(max(int(math.ceil(natoms / atoms_per_core)), 1), max_ranks)
+    kpar = max(min(nkpts, max_kpar, max_ranks // ranks_per_kpt), 1)
+    ranks = ranks_per_kpt * kpar
+    numb_node = int(math.ceil(ranks / cores_per_node))
+    if numb_node > 1 :
+        # the nodes are not shared, use all their cores
+        task_per_node = cores_per_node
+        ranks = numb_node * cores_per_node
+        while ranks % kpar != 0 :
+            kpar -= 1
+    else :
+        task_per_node = ranks
+    # NPAR close to the square root of the ranks of a k-point group
+    ranks_per_kpt = ranks // kpar
+    npar = 1
+    for ii in range(1, int(math.sqrt(ranks_per_kpt)) + 1) :
+        if ranks_per_kpt % ii == 0 :
+            npar = ii
+    return numb_node, task_per_node, npar, kpar
+
+def _chunk_units(sizes, ranks) :
+    # the tasks run one after another
+    return sum([float(ii[0]) ** 3 * ii[1] for ii in sizes]) / ranks
+
+def _size_chunk(auto_size, resources, sizes) :
+    # sized by the largest task
+    natoms = max([ii[0] for ii in sizes])
+    nkpts = max([ii[1] for ii in sizes])
+    numb_node, task_per_node, npar, kpar = size_task(auto_size, resources, natoms, nkpts)
+    units = _chunk_units(sizes, numb_node * task_per_node)
+    return numb_node, task_per_node, npar, kpar, units
+
+def size_resources(resources, sizes, time_per_unit = None) :
+    """
+    return a copy of resources for a job running the tasks of sizes, a
+    list of (natoms, nkpts), one after another. the job is sized by the
+    largest task, the walltime is the sum of the tasks. the time_limit
+    is kept if time_per_unit is None.
+    """
+    auto_size = resources['auto_size']
+    res = copy.deepcopy(resources)
+    del res['auto_size']
+    numb_node, task_per_node, npar, kpar, units = _size_chunk(auto_size, resources, sizes)
+    res['numb_node'] = numb_node
+    res['task_per_node'] = task_per_node
+    if time_per_unit is not None :
+        seconds = units * time_per_unit * auto_size.get('time_factor', 2)
+        seconds = max(seconds, _parse_time(auto_size.get('min_time', '0:10:0')))
+        seconds = min(seconds, _parse_time(auto_size.get('max_time', '24:0:0')))
+        res['time_limit'] = _format_time(seconds)
+    return res, npar, kpar
+
+def load_chunk_resources(work_path) :
+    """
+    the resources of the chunks recorded in the work path, keyed by the
+    chunk, e.g. task.000.000000+task.000.000001
+    """
+    fname = os.path.join(work_path, chunk_resources_name)
+    if not os.path.isfile(fname) :
+        return {}
+    with open(fname) as fp :
+        return json.load(fp)
+
+def dump_chunk_resources(work_path, chunk_res) :
+    fname = os.path.join(work_path, chunk_resources_name)
+    with open(fname + '.tmp', 'w') as fp :
+        json.dump(chunk_res, fp, indent = 4)
+    os.replace(fname + '.tmp', fname)
+
+def update_chunk_resources(work_path, new_res) :
+    """
+    add the resources of the chunks to the record of the work path, return
+    all recorded resources
+    """
+    with _chunk_resources_lock :
+        chunk_res = load_chunk_resources(work_path)
+        chunk_res.update(new_res)
+        dump_chunk_resources(work_path, chunk_res)
+    return chunk_res
+
+def calibrate_time_per_unit(work_paths) :
+    """
+    the median walltime per unit of the finished jobs recorded in the work
+    paths, normalized by the ranks the jobs ran with. None if no job is found.
+    the value is approximate: the start time of a job is recorded by the
+    first poll that sees it running, so the walltime is overestimated by up
+    to max_poll_interval.
+    """
+    samples = []
+    for work_path in work_paths :
+        if not os.path.isfile(os.path.join(work_path, 'job_record.db')) :
+            continue
+        chunk_res = load_chunk_resources(work_path)
+        for record in JobRecord(work_path).load().values() :
+            if record['status'] != 'finished' or record['start_time'] is None or record['finish_time'] is None :
+                continue
+            res = chunk_res.get(record['chunk'], None)
+            if res is None :
+                # not sized by auto_size
+                continue
+            tasks = [os.path.join(work_path, ii) for ii in record['chunk'].split('+')]
+            if not all([os.path.isfile(os.path.join(ii, 'POSCAR')) for ii in tasks]) :
+                continue
+            units = _chunk_units([task_size(ii) for ii in tasks], res['numb_node'] * res['task_per_node'])
+            if units > 0 :
+                samples.append((record['finish_time'] - record['start_time']) / units)
+    if len(samples) == 0 :
+        return None
+    return float(np.median(samples))
+
+def set_incar_parallel(incar, npar, kpar) :
+    """
+    set NPAR and KPAR of the INCAR. a symlinked INCAR is replaced by a file.
+    """
+    with open(incar) as fp :
+        lines = fp.read().split('\n')
+    lines = [ii for ii in lines if ii.split('=')[0].strip().upper() not in ['NPAR', 'KPAR', 'NCORE']]
+    while len(lines) > 0 and lines[-1].strip() == '' :
+        lines.pop()
+    lines += ['NPAR=%d' % npar, 'KPAR=%d' % kpar, '']
+    if os.path.islink(incar) :
+        os.remove(incar)
+    with open(incar, 'w') as fp :
+        fp.write('\n'.join(lines))
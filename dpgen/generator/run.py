@@ -19,10 +19,12 @@ import logging
 import warnings
 import shutil
 import time
+import copy
 import dpdata
 import numpy as np
 import subprocess as sp
 from distutils.version import LooseVersion
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from dpgen import dlog
 from dpgen import SHORT_CMD
 from dpgen.generator.lib.utils import make_iter_name
@@ -39,12 +41,18 @@ from dpgen.generator.lib.pwscf import make_pwscf_input
 #from dpgen.generator.lib.pwscf import cvt_1frame
 from dpgen.generator.lib.gaussian import make_gaussian_input, take_cluster
 from dpgen.generator.lib.cp2k import make_cp2k_input, make_cp2k_xyz
+from dpgen.generator.lib.resources import task_size, size_resources, calibrate_time_per_unit, set_incar_parallel
+from dpgen.generator.lib.resources import load_chunk_resources, update_chunk_resources
+from dpgen.generator.lib.manifest import DataManifest, system_info
+from dpgen.generator.lib.dedup import FrameDedup
+from dpgen.generator.lib.compact import CompactStore
+from dpgen.generator.lib.compress import check_name, check_params, make_check_data, check_files, check_commands, check_models
 from dpgen.remote.RemoteJob import SSHSession, JobStatus, SlurmJob, PBSJob, LSFJob, CloudMachineJob, awsMachineJob
 from dpgen.remote.group_jobs import ucloud_submit_jobs, aws_submit_jobs
 from dpgen.remote.group_jobs import group_slurm_jobs
 from dpgen.remote.group_jobs import group_local_jobs
 from dpgen.remote.decide_machine import decide_train_machine, decide_fp_machine, decide_model_devi_machine
-from dpgen.dispatcher.Dispatcher import Dispatcher
+from dpgen.dispatcher.Dispatcher import Dispatcher, _split_tasks
 from dpgen.util import sepline
 from dpgen import ROOT_PATH
 from pymatgen.io.vasp import Incar,Kpoints,Potcar
@@ -54,14 +62,20 @@ template_name = 'template'
 train_name = '00.train'
 train_task_fmt = '%03d'
 train_tmpl_path = os.path.join(template_name, train_name)
+compact_name = 'data.compact'
 default_train_input_file = 'input.json'
+compressed_model_file = 'frozen_model_compressed.pb'
+train_ckpt_files = ['checkpoint', 'model.ckpt.index', 'model.ckpt.meta', 'model.ckpt.data-00000-of-00001']
 data_system_fmt = '%03d'
 model_devi_name = '01.model_devi'
 model_devi_task_fmt = data_system_fmt + '.%06d'
 model_devi_conf_fmt = data_system_fmt + '.%04d'
+traj_select_name = 'traj_select.json'
 fp_name = '02.fp'
 fp_task_fmt = data_system_fmt + '.%06d'
 cvasp_file=os.path.join(ROOT_PATH,'generator/lib/cvasp.py')
+# np.loadtxt is implemented in C since numpy 1.23
+_c_loadtxt = LooseVersion(np.__version__) >= LooseVersion('1.23')
 
 def get_job_names(jdata) :
     jobkeys = []
@@ -158,6 +172,68 @@ def _check_skip_train(job) :
     return skip
 
 
+def _training_reuse(iter_index, jdata) :
+    """
+    the settings to train the models of the iteration from the checkpoints
+    of the last iteration, None if they are trained from scratch. set from
+    training_reuse_iter, and the training_reuse (bool or dict of settings)
+    of the model devi job of the last iteration.
+    """
+    if iter_index == 0 :
+        return None
+    reuse_iter = jdata.get('training_reuse_iter')
+    reuse = reuse_iter is not None and iter_index >= reuse_iter
+    job_reuse = jdata['model_devi_jobs'][iter_index-1].get('training_reuse', reuse)
+    if job_reuse is False :
+        return None
+    settings = {'numb_steps': jdata.get('training_reuse_numb_steps'),
+                'start_lr': jdata.get('training_reuse_start_lr', 1e-4),
+                'decay_steps': jdata.get('training_reuse_decay_steps'),
+                'start_pref_e': jdata.get('training_reuse_start_pref_e', 0.1),
+                'start_pref_f': jdata.get('training_reuse_start_pref_f', 100)}
+    if isinstance(job_reuse, dict) :
+        settings.update(job_reuse)
+    return settings
+
+def _reuse_train_param(jinput, settings, deepmd_version = '1') :
+    """
+    the training param with the steps, learning rate and loss prefactors of
+    the reuse settings. the keys are at the top level of the 0.x param, and
+    in the training, learning_rate and loss sections of the 1.x param. the
+    steps and decay steps are 1/5 of the original ones if not set.
+    """
+    jinput = copy.deepcopy(jinput)
+    if LooseVersion(deepmd_version) < LooseVersion('1'):
+        # 0.x
+        training = learning_rate = loss = jinput
+    else:
+        # 1.x
+        training = jinput.setdefault('training', {})
+        learning_rate = jinput.setdefault('learning_rate', {})
+        loss = jinput.setdefault('loss', {})
+    steps_key = 'numb_steps' if 'numb_steps' in training else 'stop_batch'
+    numb_steps = settings['numb_steps']
+    if numb_steps is None :
+        if steps_key not in training :
+            raise RuntimeError('cannot find the training steps in default_training_param, set training_reuse_numb_steps')
+        numb_steps = max(training[steps_key] // 5, 1)
+    decay_steps = settings['decay_steps']
+    if decay_steps is None and 'decay_steps' in learning_rate :
+        decay_steps = max(learning_rate['decay_steps'] // 5, 1)
+    training[steps_key] = numb_steps
+    learning_rate['start_lr'] = settings['start_lr']
+    if decay_steps is not None :
+        # otherwise the default of deepmd-kit
+        learning_rate['decay_steps'] = decay_steps
+    loss['start_pref_e'] = settings['start_pref_e']
+    loss['start_pref_f'] = settings['start_pref_f']
+    return jinput
+
+def _reuse_configured(jdata) :
+    return jdata.get('training_reuse_iter') is not None or \
+        any(['training_reuse' in ii for ii in jdata['model_devi_jobs']])
+
+
 def poscar_to_conf(poscar, conf):
     sys = dpdata.System(poscar, fmt = 'vasp/poscar')
     sys.to_lammps_lmp(conf)
@@ -223,33 +299,63 @@ def make_train (iter_index,
         else:
             init_data_sys.append(os.path.join('..', 'data.init', ii))
             init_batch_size.append(detect_batch_size(ss, os.path.join(work_path, 'data.init', ii)))
+    dedup = None
+    if 'training_dedup' in jdata :
+        dedup = FrameDedup(jdata['training_dedup'])
+    # the iterations before the last multiple of interval are merged in the compact store
+    n_compact = 0
+    if 'training_compact' in jdata :
+        if jdata.get('use_clusters', False) :
+            raise RuntimeError('training_compact does not support use_clusters')
+        interval = jdata['training_compact'].get('interval', 10)
+        n_compact = (iter_index // interval) * interval
+    if n_compact > 0 :
+        store = _compact_train_data(jdata, n_compact, dedup)
+        # the training keeps its data as the store grows
+        store.snapshot(os.path.join(work_path, compact_name))
+        for name, sys_idx in store.systems() :
+            sys_path = os.path.join(compact_name, name)
+            init_data_sys.append(os.path.join('..', sys_path))
+            init_batch_size.append(detect_batch_size(sys_batch_size[sys_idx], os.path.join(work_path, sys_path)))
     if iter_index > 0 :
-        for ii in range(iter_index) :
+        for ii in range(n_compact, iter_index) :
             fp_path = os.path.join(make_iter_name(ii), fp_name)
+            # only the systems not in the manifest of post_fp are read
+            manifest = DataManifest(fp_path)
             fp_data_sys = glob.glob(os.path.join(fp_path, "data.*"))
             for jj in fp_data_sys :
                 sys_idx = int(jj.split('.')[-1])
                 if jdata.get('use_clusters', False):
                     nframes = 0
                     for sys_single in os.listdir(jj):
-                        tmp_box = np.loadtxt(os.path.join(jj, sys_single, 'box.raw'))
-                        tmp_box = np.reshape(tmp_box, [-1,9])
-                        nframes += tmp_box.shape[0]
+                        nframes += manifest.info(os.path.join(jj, sys_single))['nframes']
                     if nframes < fp_task_min :
                         log_task('nframes (%d) in data sys %s is too small, skip' % (nframes, jj))
                         continue
                     for sys_single in os.listdir(jj):
-                        init_data_sys.append(os.path.join('..', 'data.iters', jj, sys_single))
-                        init_batch_size.append(detect_batch_size(sys_batch_size[sys_idx], os.path.join(jj, sys_single)))
+                        sys_path = _select_train_system(dedup, manifest, os.path.join(jj, sys_single), work_path)
+                        if sys_path is None :
+                            continue
+                        init_data_sys.append(os.path.join('..', sys_path))
+                        init_batch_size.append(detect_batch_size(sys_batch_size[sys_idx], os.path.join(work_path, sys_path),
+                                                                 sys_info = manifest.info(os.path.join(jj, sys_single)) if dedup is None else None))
                 else:
-                    tmp_box = np.loadtxt(os.path.join(jj, 'box.raw'))
-                    tmp_box = np.reshape(tmp_box, [-1,9])
-                    nframes = tmp_box.shape[0]
+                    nframes = manifest.info(jj)['nframes']
                     if nframes < fp_task_min :
                         log_task('nframes (%d) in data sys %s is too small, skip' % (nframes, jj))
                         continue
-                    init_data_sys.append(os.path.join('..', 'data.iters', jj))
-                    init_batch_size.append(detect_batch_size(sys_batch_size[sys_idx], jj))
+                    sys_path = _select_train_system(dedup, manifest, jj, work_path)
+                    if sys_path is None :
+                        continue
+                    init_data_sys.append(os.path.join('..', sys_path))
+                    init_batch_size.append(detect_batch_size(sys_batch_size[sys_idx], os.path.join(work_path, sys_path),
+                                                             sys_info = manifest.info(jj) if dedup is None else None))
+            manifest.dump()
+    if dedup is not None :
+        npruned, nall = dedup.pruned()
+        log_task('pruned %d of %d frames of the iterations as near-duplicates' % (npruned, nall))
+        with open(os.path.join(work_path, 'dedup.json'), 'w') as fp :
+            json.dump(dedup.summary, fp, indent = 4)
     # establish tasks
     jinput = jdata['default_training_param']
     try:
@@ -264,6 +370,14 @@ def make_train (iter_index,
         # 1.x
         jinput['training']['systems'] = init_data_sys
         jinput['training']['batch_size'] = init_batch_size
+    reuse = _training_reuse(iter_index, jdata)
+    if reuse is not None :
+        # fine-tune the models of the last iteration
+        prev_task_path = os.path.join(make_iter_name(iter_index-1), train_name, train_task_fmt % 0)
+        if not os.path.isfile(os.path.join(prev_task_path, 'model.ckpt.index')) :
+            raise RuntimeError('cannot find the checkpoints in %s to reuse' % prev_task_path)
+        jinput = _reuse_train_param(jinput, reuse, mdata['deepmd_version'])
+        log_task('train from the models of %s, %s' % (make_iter_name(iter_index-1), json.dumps(reuse)))
     for ii in range(numb_models) :
         task_path = os.path.join(work_path, train_task_fmt % ii)
         create_path(task_path)
@@ -302,13 +416,86 @@ def make_train (iter_index,
                 os.symlink(os.path.relpath(absjj), basejj)
                 os.chdir(cwd)
 
-def detect_batch_size(batch_size, system=None):
+    # the test set of the compressed models
+    if jdata.get('dp_compress', False) and 'dp_compress_check' in jdata :
+        params = check_params(jdata['dp_compress_check'], jdata)
+        check_path = os.path.join(work_path, train_task_fmt % 0, check_name)
+        make_check_data(check_path,
+                        [os.path.join(init_data_prefix, ii) for ii in params['systems']],
+                        params,
+                        jdata['type_map'],
+                        jdata['mass_map'])
+        for ii in range(1, numb_models) :
+            shutil.copytree(check_path, os.path.join(work_path, train_task_fmt % ii, check_name))
+
+def _compact_train_data(jdata,
+                        n_iters,
+                        dedup) :
+    """
+    merge the fp data of the iterations [0, n_iters) into the compact store,
+    with the same selection of the systems and frames as make_train. only
+    the iterations not in the store are appended. returns the store.
+    """
+    compact = jdata['training_compact']
+    set_size = compact.get('set_size', 5000)
+    fp_task_min = jdata['fp_task_min']
+    params = {'set_size': set_size,
+              'fp_task_min': fp_task_min,
+              'dedup': dedup.params if dedup is not None else None}
+    store = CompactStore(compact_name, params)
+    if store.record['iters'] > n_iters :
+        store.reset()
+    for ii in range(n_iters) :
+        if dedup is None and ii < store.record['iters'] :
+            continue
+        fp_path = os.path.join(make_iter_name(ii), fp_name)
+        manifest = DataManifest(fp_path)
+        for jj in sorted(glob.glob(os.path.join(fp_path, "data.*"))) :
+            sys_idx = int(jj.split('.')[-1])
+            nframes = manifest.info(jj)['nframes']
+            if nframes < fp_task_min :
+                continue
+            # the frames seen by dedup include those in the store
+            keep = list(range(nframes)) if dedup is None else dedup.select(manifest, jj)
+            if ii >= store.record['iters'] and len(keep) > 0 :
+                store.append(jj, sys_idx, keep, set_size)
+        manifest.dump()
+        if ii >= store.record['iters'] :
+            store.commit(ii + 1)
+            log_task('merged the fp data of %s into %s' % (make_iter_name(ii), compact_name))
+    return store
+
+def _select_train_system(dedup,
+                         manifest,
+                         sys_path,
+                         work_path) :
+    """
+    the path of the system sys_path relative to the train work path. with
+    dedup, the frames seen before are pruned, the rest are copied to
+    data.dedup of the train work path. None if no frame is left.
+    """
+    if dedup is None :
+        return os.path.join('data.iters', sys_path)
+    keep = dedup.select(manifest, sys_path)
+    if len(keep) == manifest.info(sys_path)['nframes'] :
+        return os.path.join('data.iters', sys_path)
+    if len(keep) == 0 :
+        log_task('all frames in data sys %s are near-duplicates, skip' % sys_path)
+        return None
+    dedup_path = os.path.join('data.dedup', sys_path)
+    system = dpdata.LabeledSystem(sys_path, fmt = 'deepmd/npy')
+    system.sub_system(keep).to_deepmd_npy(os.path.join(work_path, dedup_path))
+    return dedup_path
+
+def detect_batch_size(batch_size, system=None, sys_info=None):
     if type(batch_size) == int:
         return batch_size
     elif batch_size == "auto":
         # automaticcaly set batch size, batch_size = 32 // atom_numb (>=1, <=fram_numb)
-        s = dpdata.LabeledSystem(system, fmt='deepmd/npy')
-        return min(max(32//(s["coords"].shape[1]), 1), s["coords"].shape[0])
+        # the numbers of atoms and frames are read from type.raw and the headers of box.npy
+        if sys_info is None:
+            sys_info = system_info(system)
+        return min(max(32//sys_info['natoms'], 1), sys_info['nframes'])
     else:
         raise RuntimeError("Unsupported batch size")
 
@@ -346,18 +533,54 @@ def run_train (iter_index,
         task_path = os.path.join(work_path, train_task_fmt % ii)
         all_task.append(task_path)
     commands = []
+    post_commands = []
+    check_forward_files = []
+    check_backward_files = []
+    reuse = _training_reuse(iter_index, jdata) is not None
     if LooseVersion(mdata["deepmd_version"]) < LooseVersion('1'):
         # 0.x
         command = os.path.join(deepmd_path, 'bin/dp_train %s' % train_input_file)
+        if reuse :
+            # a job restarted by the dispatcher continues from its own checkpoints
+            command = '{ if [ ! -f model.ckpt.index ]; then %s --init-model old/model.ckpt; else %s --restart model.ckpt; fi }' \
+                      % (command, command)
         commands.append(command)
         command = os.path.join(deepmd_path, 'bin/dp_frz')
-        commands.append(command)        
+        post_commands.append(command)        
+        if jdata.get('dp_compress', False) :
+            raise RuntimeError('dp_compress is not supported by deepmd-kit 0.x')
     else:
         # 1.x
         command =  '%s -m deepmd train %s' % (python_path, train_input_file)
+        if reuse :
+            # a job restarted by the dispatcher continues from its own checkpoints
+            command = '{ if [ ! -f model.ckpt.index ]; then %s --init-model old/model.ckpt; else %s --restart model.ckpt; fi }' \
+                      % (command, command)
         commands.append(command)
         command = '%s -m deepmd freeze' % python_path
-        commands.append(command)
+        post_commands.append(command)
+        if jdata.get('dp_compress', False) :
+            if LooseVersion(mdata["deepmd_version"]) < LooseVersion('2'):
+                command = '%s -m deepmd compress %s -i frozen_model.pb -o %s' % (python_path, train_input_file, compressed_model_file)
+            else:
+                command = '%s -m deepmd compress -i frozen_model.pb -o %s' % (python_path, compressed_model_file)
+            post_commands.append(command)
+            if 'dp_compress_check' in jdata :
+                # evaluate and benchmark both models, compared by post_train
+                lmp_command = mdata.get('lmp_command')
+                if lmp_command is None and 'model_devi' in mdata :
+                    lmp_command = mdata['model_devi'][0]['command']
+                check_forward_files = check_files(all_task[0])
+                nsys = len(set([ii.split(os.sep)[1] for ii in check_forward_files if ii.split(os.sep)[1].startswith('sys.')]))
+                command, check_backward_files = check_commands(python_path,
+                                                               lmp_command,
+                                                               {'raw': 'frozen_model.pb', 'compressed': compressed_model_file},
+                                                               nsys,
+                                                               check_params(jdata['dp_compress_check'], jdata))
+                post_commands += command
+    train_async_post = jdata.get('train_async_post', False)
+    if not train_async_post :
+        commands += post_commands
 
     #_tasks = [os.path.basename(ii) for ii in all_task]
     # run_tasks = []
@@ -371,7 +594,21 @@ def run_train (iter_index,
     run_tasks = [os.path.basename(ii) for ii in all_task]
 
     forward_files = [train_input_file]
-    backward_files = ['frozen_model.pb', 'lcurve.out', 'train.log']
+    if reuse :
+        forward_files += [os.path.join('old', ii) for ii in train_ckpt_files if ii != 'checkpoint']
+    post_backward_files = ['frozen_model.pb']
+    if jdata.get('dp_compress', False) :
+        post_backward_files.append(compressed_model_file)
+    post_backward_files += check_backward_files
+    if train_async_post :
+        # the models are frozen by the post jobs
+        backward_files = ['lcurve.out', 'train.log'] + train_ckpt_files
+    else :
+        forward_files += check_forward_files
+        backward_files = post_backward_files + ['lcurve.out', 'train.log']
+        if _reuse_configured(jdata) :
+            # the checkpoints are reused by the next iterations
+            backward_files += train_ckpt_files
     init_data_sys_ = jdata['init_data_sys']
     init_data_sys = []
     for ii in init_data_sys_ :
@@ -399,6 +636,17 @@ def run_train (iter_index,
         else:
             trans_comm_data += glob.glob(os.path.join(ii, 'set.*'))
             trans_comm_data += glob.glob(os.path.join(ii, 'type.raw'))
+    if os.path.isdir('data.dedup') or os.path.isdir(compact_name) :
+        # the systems pruned or merged by make_train replace the original ones
+        with open(os.path.join(run_tasks[0], train_input_file)) as fp :
+            jinput = json.load(fp)
+        train_systems = jinput['systems'] if 'systems' in jinput else jinput['training']['systems']
+        train_systems = [os.path.normpath(os.path.join(run_tasks[0], ii)) for ii in train_systems]
+        trans_comm_data = [ii for ii in trans_comm_data if os.path.dirname(ii) in train_systems]
+        for ii in train_systems :
+            if ii.split(os.sep)[0] in ['data.dedup', compact_name] :
+                trans_comm_data += glob.glob(os.path.join(ii, 'set.*'))
+                trans_comm_data += glob.glob(os.path.join(ii, 'type.raw'))
     os.chdir(cwd)
 
     try:
@@ -406,16 +654,70 @@ def run_train (iter_index,
     except:
         train_group_size = 1
 
-    dispatcher.run_jobs(mdata['train_resources'],
+    if not train_async_post :
+        dispatcher.run_jobs(mdata['train_resources'],
+                            commands,
+                            work_path,
+                            run_tasks,
+                            train_group_size,
+                            trans_comm_data,
+                            forward_files,
+                            backward_files,
+                            outlog = 'train.log',
+                            errlog = 'train.log')
+        return
+
+    # freeze (and compress) each model once its training is finished
+    abs_work_path = os.path.abspath(work_path)
+    nthreads = jdata.get('train_async_post_threads', numb_models)
+    with ThreadPoolExecutor(max_workers = nthreads) as executor :
+        futures = {}
+        def _callback(chunk) :
+            for ii in chunk :
+                if ii in futures :
+                    continue
+                dlog.info('submit the post job of model %s' % ii)
+                futures[ii] = executor.submit(_run_train_post, dispatcher, mdata['train_resources'], post_commands,
+                                              os.path.join(abs_work_path, ii),
+                                              [train_input_file] + train_ckpt_files + check_forward_files,
+                                              post_backward_files)
+        dispatcher.run_jobs(mdata['train_resources'],
+                            commands,
+                            work_path,
+                            run_tasks,
+                            train_group_size,
+                            trans_comm_data,
+                            forward_files,
+                            backward_files,
+                            outlog = 'train.log',
+                            errlog = 'train.log',
+                            callback = _callback)
+        # the models trained before the restart
+        _callback(run_tasks)
+        for ii in run_tasks :
+            futures[ii].result()
+
+
+def _run_train_post(dispatcher,
+                    resources,
+                    commands,
+                    task_path,
+                    forward_files,
+                    backward_files) :
+    """
+    run the post commands of a trained model as a job in its task path.
+    the job is recorded in the task path.
+    """
+    dispatcher.run_jobs(resources,
                         commands,
-                        work_path,
-                        run_tasks,
-                        train_group_size,
-                        trans_comm_data,
+                        task_path,
+                        ['.'],
+                        1,
+                        [],
                         forward_files,
                         backward_files,
-                        outlog = 'train.log',
-                        errlog = 'train.log')
+                        outlog = 'post.log',
+                        errlog = 'post.log')
 
 
 def post_train (iter_index,
@@ -431,13 +733,37 @@ def post_train (iter_index,
     if os.path.isfile(copy_flag) :
         log_task('copied model, do not post train')
         return
-    # symlink models
+    check = None
+    if jdata.get('dp_compress', False) and 'dp_compress_check' in jdata :
+        check = check_params(jdata['dp_compress_check'], jdata)
+    summary = {}
+    # symlink models, the compressed ones if any and checked
     for ii in range(numb_models) :
         task_file = os.path.join(train_task_fmt % ii, 'frozen_model.pb')
+        task_path = os.path.join(work_path, train_task_fmt % ii)
+        if os.path.isfile(os.path.join(task_path, compressed_model_file)) :
+            passed = True
+            if check is not None :
+                summary[train_task_fmt % ii] = check_models(task_path, check)
+                passed = summary[train_task_fmt % ii]['passed']
+            if passed :
+                task_file = os.path.join(train_task_fmt % ii, compressed_model_file)
+            else :
+                log_task('compressed model %s failed the check, use the frozen model' % task_path)
+            if check is not None :
+                for err in summary[train_task_fmt % ii]['errors'] :
+                    dlog.info('check of model %s: %s' % (task_path, err))
         ofile = os.path.join(work_path, 'graph.%03d.pb' % ii)
         if os.path.isfile(ofile) :
             os.remove(ofile)
         os.symlink(task_file, ofile)
+    if check is not None :
+        for name, result in summary.items() :
+            if result['raw_time'] is not None and result['compressed_time'] is not None :
+                log_task('model %s: the compressed model runs %.2fx as fast as the frozen model'
+                         % (name, result['raw_time'] / result['compressed_time']))
+        with open(os.path.join(work_path, 'compress.json'), 'w') as fp :
+            json.dump(summary, fp, indent = 4)
 
 def _get_param_alias(jdata,
                      names) :
@@ -612,10 +938,32 @@ def make_model_devi (iter_index,
 
     return True
 
+def _model_devi_task_cost (task_path) :
+    """
+    estimated cost of the lammps task: natoms x nsteps
+    """
+    natoms = 0
+    with open(os.path.join(task_path, 'conf.lmp')) as fp :
+        for line in fp :
+            words = line.split()
+            if len(words) == 2 and words[1] == 'atoms' :
+                natoms = int(words[0])
+                break
+    nsteps = 1
+    with open(os.path.join(task_path, 'input.lammps')) as fp :
+        for line in fp :
+            words = line.split()
+            if len(words) >= 4 and words[:3] == ['variable', 'NSTEPS', 'equal'] :
+                nsteps = int(words[3])
+            elif len(words) >= 2 and words[0] == 'run' and words[1].isdigit() :
+                nsteps = int(words[1])
+    return natoms * nsteps
+
 def run_model_devi (iter_index,
                     jdata,
                     mdata,
-                    dispatcher) :
+                    dispatcher,
+                    callback = None) :
     #rmdlog.info("This module has been run !")
     lmp_exec = mdata['lmp_command']
     model_devi_group_size = mdata['model_devi_group_size']
@@ -652,6 +1000,14 @@ def run_model_devi (iter_index,
     model_names = [os.path.basename(ii) for ii in all_models]
     forward_files = ['conf.lmp', 'input.lammps', 'traj']
     backward_files = ['model_devi.out', 'model_devi.log', 'traj']
+    task_costs = None
+    if jdata.get('balance_chunks', False) :
+        task_costs = [_model_devi_task_cost(ii) for ii in run_tasks_]
+    backward_select = None
+    if jdata.get('model_devi_select_traj', False) :
+        # only the traj of the candidate frames are downloaded
+        backward_files = ['model_devi.out', 'model_devi.log']
+        backward_select = lambda task_path : _select_model_devi_traj(task_path, jdata)
 
     dispatcher.run_jobs(mdata['model_devi_resources'],
                         commands,
@@ -662,13 +1018,231 @@ def run_model_devi (iter_index,
                         forward_files,
                         backward_files,
                         outlog = 'model_devi.log',
-                        errlog = 'model_devi.log')
+                        errlog = 'model_devi.log',
+                        callback = callback,
+                        backward_task_select = backward_select,
+                        task_costs = task_costs)
 
 
 def post_model_devi (iter_index,
                      jdata,
                      mdata) :
-    pass
+    """
+    gather the model_devi.out of all model devi tasks into the binary cache
+    read by make_fp
+    """
+    iter_name = make_iter_name(iter_index)
+    work_path = os.path.join(iter_name, model_devi_name)
+    _dump_model_devi_cache(work_path, jdata.get('model_devi_cache_workers', 4))
+
+def _model_devi_cache_name (ss) :
+    return 'model_devi.%s.npy' % ss
+
+def _dump_model_devi_cache (modd_path,
+                            nworkers = 4) :
+    """
+    write the model_devi.out of the tasks of each system ss as a 2d array in
+    model_devi.ss.npy, the columns are the task index followed by the columns
+    of model_devi.out. the tasks of each system are listed in
+    model_devi.cache.json. the files are parsed by nworkers processes.
+    """
+    modd_task = sorted(glob.glob(os.path.join(modd_path, 'task.*')))
+    system_index = sorted(set([os.path.basename(ii).split('.')[1] for ii in modd_task]))
+    fnames = [os.path.join(ii, 'model_devi.out') for ii in modd_task]
+    if not all([os.path.isfile(ii) for ii in fnames]) :
+        dlog.info('model_devi.out is missing, do not cache the model devi of %s' % modd_path)
+        return
+    with ProcessPoolExecutor(max_workers = nworkers) as executor :
+        all_conf = dict(zip(modd_task, executor.map(_load_model_devi, fnames)))
+    index = {}
+    for ss in system_index :
+        sys_task = [ii for ii in modd_task if os.path.basename(ii).split('.')[1] == ss]
+        ncol = max([all_conf[ii].shape[1] for ii in sys_task])
+        if not all([all_conf[ii].shape[1] == ncol or all_conf[ii].shape[0] == 0 for ii in sys_task]) :
+            dlog.info('the columns of model_devi.out of system %s differ, not cached' % ss)
+            continue
+        data = [np.concatenate([np.full([all_conf[tt].shape[0], 1], idx), all_conf[tt]], axis = 1) \
+                for idx, tt in enumerate(sys_task) if all_conf[tt].shape[0] > 0]
+        data = np.concatenate(data + [np.zeros([0, ncol + 1])])
+        fname = os.path.join(modd_path, _model_devi_cache_name(ss))
+        with open(fname + '.tmp', 'wb') as fp :
+            np.save(fp, data)
+        os.replace(fname + '.tmp', fname)
+        index[ss] = [os.path.basename(ii) for ii in sys_task]
+    index_file = os.path.join(modd_path, 'model_devi.cache.json')
+    with open(index_file + '.tmp', 'w') as fp :
+        json.dump(index, fp, indent = 4)
+    os.replace(index_file + '.tmp', index_file)
+
+def _load_model_devi_cache (modd_path,
+                            ss,
+                            sys_task) :
+    """
+    memory-map the cached model devi of system ss. None if it is not cached
+    for the tasks sys_task, or any model_devi.out is newer than the cache.
+    """
+    index_file = os.path.join(modd_path, 'model_devi.cache.json')
+    fname = os.path.join(modd_path, _model_devi_cache_name(ss))
+    if not os.path.isfile(index_file) or not os.path.isfile(fname) :
+        return None
+    try :
+        with open(index_file) as fp :
+            index = json.load(fp)
+    except ValueError :
+        # truncated by an older version
+        return None
+    if index.get(ss) != [os.path.basename(ii) for ii in sys_task] :
+        return None
+    mtime = os.path.getmtime(fname)
+    for ii in sys_task :
+        if os.path.getmtime(os.path.join(ii, 'model_devi.out')) > mtime :
+            return None
+    return np.load(fname, mmap_mode = 'r')
+
+def _load_model_devi (fname, usecols = None) :
+    """
+    load the columns of model_devi.out as a 2d array. np.loadtxt parses in
+    C since numpy 1.23, the older versions parse all numbers at once by
+    np.fromstring.
+    """
+    if _c_loadtxt :
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            all_conf = np.loadtxt(fname, usecols = usecols, ndmin = 2)
+    else :
+        with open(fname) as fp :
+            text = fp.read()
+        if '#' in text :
+            text = '\n'.join([ii for ii in text.split('\n') if not ii.lstrip().startswith('#')])
+        ncol = len(text.lstrip().split('\n', 1)[0].split())
+        all_conf = np.fromstring(text, sep = ' ')
+        if ncol > 0 and all_conf.size % ncol == 0 :
+            all_conf = np.reshape(all_conf, [-1, ncol])
+        else :
+            # irregular rows
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                all_conf = np.loadtxt(fname, ndmin = 2)
+        if usecols is not None and all_conf.size > 0 :
+            all_conf = all_conf[:,usecols]
+    if all_conf.size == 0 :
+        return np.zeros([0, 7 if usecols is None else len(usecols)])
+    return all_conf
+
+def _select_model_devi_frames (task_path,
+                                model_devi_skip,
+                                e_trust_lo,
+                                e_trust_hi,
+                                f_trust_lo,
+                                f_trust_hi,
+                                cluster_cutoff = None) :
+    """
+    classify the frames recorded in model_devi.out of the model devi task.
+    returns the candidate, rest accurate and rest failed frames as int
+    arrays, each row is [step] or [step, atom_idx] if cluster_cutoff is set.
+    """
+    if cluster_cutoff is None:
+        # step, max_devi_e, max_devi_f
+        all_conf = _load_model_devi(os.path.join(task_path, 'model_devi.out'), usecols = (0, 1, 4))
+    else:
+        all_conf = _load_model_devi(os.path.join(task_path, 'model_devi.out'))
+    all_conf = all_conf[all_conf[:,0] >= model_devi_skip]
+    steps = all_conf[:,0].astype(int)
+    if cluster_cutoff is None:
+        masks = _classify_frames(all_conf[:,1], all_conf[:,2],
+                                 e_trust_lo, e_trust_hi, f_trust_lo, f_trust_hi, task_path)
+        return tuple([steps[ii].reshape([-1, 1]) for ii in masks])
+    else:
+        atoms = _classify_atoms(all_conf[:,7:], f_trust_lo, f_trust_hi)
+        return tuple([np.stack([steps[ff], aa], axis = 1) for ff, aa in atoms])
+
+def _classify_frames (devi_e,
+                      devi_f,
+                      e_trust_lo,
+                      e_trust_hi,
+                      f_trust_lo,
+                      f_trust_hi,
+                      task_path) :
+    """
+    the masks of the candidate, rest accurate and rest failed frames
+    """
+    candidate = ((devi_e < e_trust_hi) & (devi_e >= e_trust_lo)) | \
+                ((devi_f < f_trust_hi) & (devi_f >= f_trust_lo))
+    rest_failed = ~candidate & ((devi_e >= e_trust_hi) | (devi_f >= f_trust_hi))
+    rest_accurate = ~candidate & ~rest_failed & (devi_e < e_trust_lo) & (devi_f < f_trust_lo)
+    unknown = ~(candidate | rest_failed | rest_accurate)
+    if np.any(unknown) :
+        ii = np.nonzero(unknown)[0][0]
+        raise RuntimeError('md traj %s frame %d with f devi %f does not belong to either accurate, candidiate and failed, it should not happen' % (task_path, ii, devi_f[ii]))
+    return candidate, rest_accurate, rest_failed
+
+def _classify_atoms (devi_f,
+                     f_trust_lo,
+                     f_trust_hi) :
+    """
+    the (frame, atom) indexes of the candidate, rest accurate and rest
+    failed atoms, in frame-major order and the atoms of a frame in
+    ascending order
+    """
+    return [np.nonzero(mask) for mask in [(devi_f < f_trust_hi) & (devi_f >= f_trust_lo),
+                                          devi_f < f_trust_lo,
+                                          devi_f >= f_trust_hi]]
+
+def _shuffle_frames (frames) :
+    """
+    shuffle the rows by random.shuffle, the order is the same as shuffling
+    a list of the rows
+    """
+    perm = list(range(len(frames)))
+    random.shuffle(perm)
+    return frames[np.array(perm, dtype = int)]
+
+def _write_frames (fname, task_names, task_idx, frames, mode = 'w') :
+    """
+    write the frames as lines of md task, step (and atom_idx)
+    """
+    with open(fname, mode) as fp:
+        for tt, ff in zip(task_idx.tolist(), frames.tolist()) :
+            fp.write(task_names[tt] + ' ' + ' '.join([str(nn) for nn in ff]) + "\n")
+
+def _select_model_devi_traj (task_path,
+                             jdata) :
+    """
+    the traj files of the candidate frames, with the same criteria as make_fp.
+    the criteria are recorded in the task, make_fp checks them if a traj
+    file is missing.
+    """
+    cluster_cutoff = jdata['cluster_cutoff'] if 'use_clusters' in jdata and jdata['use_clusters'] else None
+    criteria = {'model_devi_skip': jdata['model_devi_skip'],
+                'model_devi_f_trust_lo': jdata['model_devi_f_trust_lo'],
+                'model_devi_f_trust_hi': jdata['model_devi_f_trust_hi']}
+    with open(os.path.join(task_path, traj_select_name), 'w') as fp:
+        json.dump(criteria, fp, indent = 4)
+    candidate, _, _ = _select_model_devi_frames(task_path,
+                                                jdata['model_devi_skip'],
+                                                1e+10, 1e+10,
+                                                jdata['model_devi_f_trust_lo'],
+                                                jdata['model_devi_f_trust_hi'],
+                                                cluster_cutoff)
+    steps = np.unique(candidate[:,0]).tolist()
+    return [os.path.join('traj', '%d.lammpstrj' % ii) for ii in steps]
+
+def _check_model_devi_traj (task_path,
+                            conf_name) :
+    """
+    raise if the traj file of an fp candidate is not downloaded
+    """
+    if os.path.isfile(conf_name) :
+        return
+    msg = 'the traj file %s of the fp candidate is not found.' % conf_name
+    fselect = os.path.join(task_path, traj_select_name)
+    if os.path.isfile(fselect) :
+        with open(fselect) as fp:
+            criteria = json.load(fp)
+        msg += ' only the traj files of the candidates under %s were downloaded as model_devi_select_traj is set,' \
+               ' run_model_devi should be rerun without model_devi_select_traj to select with other trust levels.' \
+               % ', '.join(['%s = %s' % (kk, criteria[kk]) for kk in sorted(criteria)])
+    raise RuntimeError(msg)
 
 def _make_fp_vasp_inner (modd_path,
                          work_path,
@@ -702,90 +1276,54 @@ def _make_fp_vasp_inner (modd_path,
     fp_tasks = []
     cluster_cutoff = jdata['cluster_cutoff'] if 'use_clusters' in jdata and jdata['use_clusters'] else None
     for ss in system_index :
-        fp_candidate = []
-        fp_rest_accurate = []
-        fp_rest_failed = []
         modd_system_glob = os.path.join(modd_path, 'task.' + ss + '.*')
         modd_system_task = glob.glob(modd_system_glob)
         modd_system_task.sort()
-        cc = 0
-        for tt in modd_system_task :
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                all_conf = np.loadtxt(os.path.join(tt, 'model_devi.out'))
-                sel_conf = []
-                res_failed_conf = []
-                res_accurate_conf = []
-                for ii in range(all_conf.shape[0]) :
-                    if all_conf[ii][0] < model_devi_skip :
-                        continue
-                    cc = int(all_conf[ii][0])
-                    if cluster_cutoff is None:
-                        if (all_conf[ii][1] < e_trust_hi and all_conf[ii][1] >= e_trust_lo) or \
-                           (all_conf[ii][4] < f_trust_hi and all_conf[ii][4] >= f_trust_lo) :
-                            fp_candidate.append([tt, cc])
-                        elif (all_conf[ii][1] >= e_trust_hi ) or (all_conf[ii][4] >= f_trust_hi ):
-                            fp_rest_failed.append([tt, cc])
-                        elif (all_conf[ii][1] < e_trust_lo and all_conf[ii][4] < f_trust_lo ):
-                            fp_rest_accurate.append([tt, cc])
-                        else :
-                            raise RuntimeError('md traj %s frame %d with f devi %f does not belong to either accurate, candidiate and failed, it should not happen' % (tt, ii, all_conf[ii][4]))
-                    else:
-                        idx_candidate = np.where(np.logical_and(all_conf[ii][7:] < f_trust_hi, all_conf[ii][7:] >= f_trust_lo))[0]
-                        idx_rest_failed = np.where(all_conf[ii][7:] >= f_trust_hi)[0]
-                        idx_rest_accurate = np.where(all_conf[ii][7:] < f_trust_lo)[0]
-                        for jj in idx_candidate:
-                            fp_candidate.append([tt, cc, jj])
-                        for jj in idx_rest_accurate:
-                            fp_rest_accurate.append([tt, cc, jj])
-                        for jj in idx_rest_failed:
-                            fp_rest_failed.append([tt, cc, jj])
-        random.shuffle(fp_candidate)
-        random.shuffle(fp_rest_failed)
-        random.shuffle(fp_rest_accurate)
-        with open(os.path.join(work_path,'candidate.shuffled.%s.out'%ss), 'w') as fp:
-            for ii in fp_candidate:
-                fp.write(" ".join([str(nn) for nn in ii]) + "\n")
-        with open(os.path.join(work_path,'rest_accurate.shuffled.%s.out'%ss), 'w') as fp:
-            for ii in fp_rest_accurate:
-                fp.write(" ".join([str(nn) for nn in ii]) + "\n")
-        with open(os.path.join(work_path,'rest_failed.shuffled.%s.out'%ss), 'w') as fp:
-            for ii in fp_rest_failed:
-                fp.write(" ".join([str(nn) for nn in ii]) + "\n")
-        numb_task = min(fp_task_max, len(fp_candidate))
+        # the frames of all md tasks of the system, and the md task index of each frame
+        frames = {'candidate': [], 'rest_accurate': [], 'rest_failed': []}
+        task_idx = {'candidate': [], 'rest_accurate': [], 'rest_failed': []}
+        cache = _load_model_devi_cache(modd_path, ss, modd_system_task)
+        if cache is not None :
+            # the frames of the tasks in order, as the text files are read
+            cache = cache[cache[:,1] >= model_devi_skip]
+            cache_task = cache[:,0].astype(int)
+            steps = cache[:,1].astype(int)
+            if cluster_cutoff is None :
+                masks = _classify_frames(cache[:,2], cache[:,5],
+                                         e_trust_lo, e_trust_hi, f_trust_lo, f_trust_hi, modd_system_glob)
+                for name, mm in zip(['candidate', 'rest_accurate', 'rest_failed'], masks) :
+                    frames[name].append(steps[mm].reshape([-1, 1]))
+                    task_idx[name].append(cache_task[mm])
+            else :
+                atoms = _classify_atoms(cache[:,8:], f_trust_lo, f_trust_hi)
+                for name, (ff, aa) in zip(['candidate', 'rest_accurate', 'rest_failed'], atoms) :
+                    frames[name].append(np.stack([steps[ff], aa], axis = 1))
+                    task_idx[name].append(cache_task[ff])
+        else :
+            for idx, tt in enumerate(modd_system_task) :
+                selected = _select_model_devi_frames(tt,
+                                                     model_devi_skip,
+                                                     e_trust_lo, e_trust_hi,
+                                                     f_trust_lo, f_trust_hi,
+                                                     cluster_cutoff)
+                for name, ff in zip(['candidate', 'rest_accurate', 'rest_failed'], selected) :
+                    frames[name].append(ff)
+                    task_idx[name].append(np.full(len(ff), idx, dtype = int))
+        ncol = 1 if cluster_cutoff is None else 2
+        for name in ['candidate', 'rest_failed', 'rest_accurate'] :
+            frames[name] = np.concatenate(frames[name] + [np.zeros([0, ncol], dtype = int)])
+            task_idx[name] = np.concatenate(task_idx[name] + [np.zeros(0, dtype = int)])
+            # shuffle the frames together with their md tasks
+            perm = _shuffle_frames(np.arange(len(frames[name])))
+            frames[name] = frames[name][perm]
+            task_idx[name] = task_idx[name][perm]
+        for name in ['candidate', 'rest_accurate', 'rest_failed'] :
+            _write_frames(os.path.join(work_path, '%s.shuffled.%s.out' % (name, ss)),
+                          modd_system_task, task_idx[name], frames[name])
+        numb_task = min(fp_task_max, len(frames['candidate']))
         for cc in range(numb_task) :
-            tt = fp_candidate[cc][0]
-            ii = fp_candidate[cc][1]
-            ss = os.path.basename(tt).split('.')[1]
-            conf_name = os.path.join(tt, "traj")
-            conf_name = os.path.join(conf_name, str(ii) + '.lammpstrj')
-            conf_name = os.path.abspath(conf_name)
-
-            # link job.json
-            job_name = os.path.join(tt, "job.json")
-            job_name = os.path.abspath(job_name)
-
-            if cluster_cutoff is not None:
-                # take clusters
-                jj = fp_candidate[cc][2]
-                poscar_name = '{}.cluster.{}.POSCAR'.format(conf_name, jj)
-                new_system = take_cluster(conf_name, type_map, jj, jdata)
-                new_system.to_vasp_poscar(poscar_name)
-            fp_task_name = make_fp_task_name(int(ss), cc)
-            fp_task_path = os.path.join(work_path, fp_task_name)
-            create_path(fp_task_path)
-            fp_tasks.append(fp_task_path)
-            cwd = os.getcwd()
-            os.chdir(fp_task_path)
-            if cluster_cutoff is None:
-                os.symlink(os.path.relpath(conf_name), 'conf.dump')
-                os.symlink(os.path.relpath(job_name), 'job.json')
-            else:
-                os.symlink(os.path.relpath(poscar_name), 'POSCAR')
-                np.save("atom_pref", new_system.data["atom_pref"])
-            for pair in fp_link_files :
-                os.symlink(pair[0], pair[1])
-            os.chdir(cwd)
+            candidate = [modd_system_task[task_idx['candidate'][cc]]] + frames['candidate'][cc].tolist()
+            fp_tasks.append(_make_fp_vasp_task(work_path, candidate, cc, fp_link_files, type_map, jdata, cluster_cutoff))
     if cluster_cutoff is None:
         cwd = os.getcwd()
         for ii in fp_tasks:
@@ -794,24 +1332,72 @@ def _make_fp_vasp_inner (modd_path,
             os.chdir(cwd)
     return fp_tasks
 
+def _make_fp_vasp_task (work_path,
+                        candidate,
+                        cc,
+                        fp_link_files,
+                        type_map,
+                        jdata,
+                        cluster_cutoff = None) :
+    """
+    make the fp task cc of the candidate frame [md task, step] or
+    [md task, step, atom_idx]. the POSCAR is not made from conf.dump
+    if cluster_cutoff is None.
+    """
+    tt = candidate[0]
+    ii = candidate[1]
+    ss = os.path.basename(tt).split('.')[1]
+    conf_name = os.path.join(tt, "traj")
+    conf_name = os.path.join(conf_name, str(ii) + '.lammpstrj')
+    conf_name = os.path.abspath(conf_name)
+    _check_model_devi_traj(tt, conf_name)
+
+    # link job.json
+    job_name = os.path.join(tt, "job.json")
+    job_name = os.path.abspath(job_name)
+
+    if cluster_cutoff is not None:
+        # take clusters
+        jj = candidate[2]
+        poscar_name = '{}.cluster.{}.POSCAR'.format(conf_name, jj)
+        new_system = take_cluster(conf_name, type_map, jj, jdata)
+        new_system.to_vasp_poscar(poscar_name)
+    fp_task_name = make_fp_task_name(int(ss), cc)
+    fp_task_path = os.path.join(work_path, fp_task_name)
+    create_path(fp_task_path)
+    # no chdir, the fp tasks are made while the fp jobs of the pipeline run
+    if cluster_cutoff is None:
+        os.symlink(os.path.relpath(conf_name, fp_task_path), os.path.join(fp_task_path, 'conf.dump'))
+        os.symlink(os.path.relpath(job_name, fp_task_path), os.path.join(fp_task_path, 'job.json'))
+    else:
+        os.symlink(os.path.relpath(poscar_name, fp_task_path), os.path.join(fp_task_path, 'POSCAR'))
+        np.save(os.path.join(fp_task_path, "atom_pref"), new_system.data["atom_pref"])
+    for pair in fp_link_files :
+        os.symlink(pair[0], os.path.join(fp_task_path, pair[1]))
+    return fp_task_path
+
+def _get_fp_tasks (work_path, fp_tasks = None) :
+    # all the tasks in the work path if not given
+    if fp_tasks is None :
+        fp_tasks = glob.glob(os.path.join(work_path, 'task.*'))
+    fp_tasks = sorted(fp_tasks)
+    return fp_tasks
+
 def _link_fp_vasp_incar (iter_index,
                          jdata,
-                         incar = 'INCAR') :
+                         incar = 'INCAR',
+                         fp_tasks = None) :
     iter_name = make_iter_name(iter_index)
     work_path = os.path.join(iter_name, fp_name)
     incar_file = os.path.join(work_path, incar)
     incar_file = os.path.abspath(incar_file)
-    fp_tasks = glob.glob(os.path.join(work_path, 'task.*'))
-    fp_tasks.sort()
+    fp_tasks = _get_fp_tasks(work_path, fp_tasks)
     if len(fp_tasks) == 0 :
         return
-    cwd = os.getcwd()
     for ii in fp_tasks:
-        os.chdir(ii)
-        os.symlink(os.path.relpath(incar_file), incar)
-        os.chdir(cwd)
+        os.symlink(os.path.relpath(incar_file, ii), os.path.join(ii, incar))
 
-def _make_fp_vasp_kp (iter_index,jdata, incar):
+def _make_fp_vasp_kp (iter_index,jdata, incar, fp_tasks = None):
     dincar=Incar.from_string(incar)
     standard_incar={}
     for key,val in dincar.items():
@@ -836,21 +1422,18 @@ def _make_fp_vasp_kp (iter_index,jdata, incar):
     iter_name = make_iter_name(iter_index)
     work_path = os.path.join(iter_name, fp_name)
 
-    fp_tasks = glob.glob(os.path.join(work_path, 'task.*'))
-    fp_tasks.sort()
+    fp_tasks = _get_fp_tasks(work_path, fp_tasks)
     if len(fp_tasks) == 0 :
         return
-    cwd = os.getcwd()
     for ii in fp_tasks:
-        os.chdir(ii)
-        assert(os.path.exists('POSCAR'))
-        ret=make_kspacing_kpoints('POSCAR', kspacing, gamma)
+        assert(os.path.exists(os.path.join(ii, 'POSCAR')))
+        ret=make_kspacing_kpoints(os.path.join(ii, 'POSCAR'), kspacing, gamma)
         kp=Kpoints.from_string(ret)
-        kp.write_file("KPOINTS")
-        os.chdir(cwd)
+        kp.write_file(os.path.join(ii, "KPOINTS"))
 
 def _link_fp_vasp_pp (iter_index,
-                      jdata) :
+                      jdata,
+                      fp_tasks = None) :
     fp_pp_path = jdata['fp_pp_path']
     fp_pp_files = jdata['fp_pp_files']
     assert(os.path.exists(fp_pp_path))
@@ -859,20 +1442,17 @@ def _link_fp_vasp_pp (iter_index,
     iter_name = make_iter_name(iter_index)
     work_path = os.path.join(iter_name, fp_name)
 
-    fp_tasks = glob.glob(os.path.join(work_path, 'task.*'))
-    fp_tasks.sort()
+    fp_tasks = _get_fp_tasks(work_path, fp_tasks)
     if len(fp_tasks) == 0 :
         return
-    cwd = os.getcwd()
     for ii in fp_tasks:
-        os.chdir(ii)
         for jj in fp_pp_files:
             pp_file = os.path.join(fp_pp_path, jj)
-            os.symlink(pp_file, jj)
-        os.chdir(cwd)
+            os.symlink(pp_file, os.path.join(ii, jj))
 
 def sys_link_fp_vasp_pp (iter_index,
-                         jdata) :
+                         jdata,
+                         fp_tasks = None) :
     fp_pp_path = jdata['fp_pp_path']
     fp_pp_files = jdata['fp_pp_files']
     fp_pp_path = os.path.abspath(fp_pp_path)
@@ -883,8 +1463,7 @@ def sys_link_fp_vasp_pp (iter_index,
     iter_name = make_iter_name(iter_index)
     work_path = os.path.join(iter_name, fp_name)
 
-    fp_tasks = glob.glob(os.path.join(work_path, 'task.*'))
-    fp_tasks.sort()
+    fp_tasks = _get_fp_tasks(work_path, fp_tasks)
     if len(fp_tasks) == 0 :
         return
 
@@ -893,23 +1472,21 @@ def sys_link_fp_vasp_pp (iter_index,
     system_idx_str.sort()
     for ii in system_idx_str:
         potcars = []
-        sys_tasks = glob.glob(os.path.join(work_path, 'task.%s.*' % ii))
+        sys_tasks = [jj for jj in fp_tasks if os.path.basename(jj).split('.')[1] == ii]
         assert (len(sys_tasks) != 0)
         sys_poscar = os.path.join(sys_tasks[0], 'POSCAR')
         sys = dpdata.System(sys_poscar, fmt = 'vasp/poscar')
         for ele_name in sys['atom_names']:
             ele_idx = jdata['type_map'].index(ele_name)
             potcars.append(fp_pp_files[ele_idx])                
-        with open(os.path.join(work_path,'POTCAR.%s' % ii), 'w') as fp_pot:
+        potcar_file = os.path.join(work_path,'POTCAR.%s' % ii)
+        with open(potcar_file + '.tmp', 'w') as fp_pot:
             for jj in potcars:
                 with open(os.path.join(fp_pp_path, jj)) as fp:
                     fp_pot.write(fp.read())
-        sys_tasks = glob.glob(os.path.join(work_path, 'task.%s.*' % ii))
-        cwd = os.getcwd()
+        os.replace(potcar_file + '.tmp', potcar_file)
         for jj in sys_tasks:
-            os.chdir(jj)
-            os.symlink(os.path.join('..', 'POTCAR.%s' % ii), 'POTCAR')
-            os.chdir(cwd)
+            os.symlink(os.path.join('..', 'POTCAR.%s' % ii), os.path.join(jj, 'POTCAR'))
 
 def _make_fp_vasp_configs(iter_index,
                           jdata):
@@ -948,9 +1525,11 @@ def _make_fp_vasp_configs(iter_index,
 
 
 def make_fp_vasp (iter_index,
-                  jdata) :
-    # make config
-    fp_tasks = _make_fp_vasp_configs(iter_index, jdata)
+                  jdata,
+                  fp_tasks = None) :
+    # make config, unless the configs of the fp_tasks are made
+    if fp_tasks is None :
+        fp_tasks = _make_fp_vasp_configs(iter_index, jdata)
     if len(fp_tasks) == 0 :
         return
     # create incar
@@ -974,21 +1553,24 @@ def make_fp_vasp (iter_index,
     incar_file = os.path.join(work_path, 'INCAR')
     incar_file = os.path.abspath(incar_file)
 
-    with open(incar_file, 'w') as fp:
+    # replaced at once, the linked INCAR may be uploaded by the pipeline
+    with open(incar_file + '.tmp', 'w') as fp:
         fp.write(incar)
-    fp.close()
-    _link_fp_vasp_incar(iter_index, jdata)
+    os.replace(incar_file + '.tmp', incar_file)
+    _link_fp_vasp_incar(iter_index, jdata, fp_tasks = fp_tasks)
     # create potcar
-    sys_link_fp_vasp_pp(iter_index, jdata)
+    sys_link_fp_vasp_pp(iter_index, jdata, fp_tasks = fp_tasks)
     # create kpoints
-    _make_fp_vasp_kp(iter_index, jdata, incar)
+    _make_fp_vasp_kp(iter_index, jdata, incar, fp_tasks = fp_tasks)
     
 
 
 def make_fp_pwscf(iter_index,
-                  jdata) :
+                  jdata,
+                  fp_tasks = None) :
     # make config
-    fp_tasks = _make_fp_vasp_configs(iter_index, jdata)
+    if fp_tasks is None :
+        fp_tasks = _make_fp_vasp_configs(iter_index, jdata)
     if len(fp_tasks) == 0 :
         return
     # make pwscf input
@@ -1001,23 +1583,22 @@ def make_fp_pwscf(iter_index,
     else:
         fp_params = jdata['fp_params']
         user_input = False
-    cwd = os.getcwd()
     for ii in fp_tasks:
-        os.chdir(ii)
-        sys_data = dpdata.System('POSCAR').data
+        sys_data = dpdata.System(os.path.join(ii, 'POSCAR'), fmt = 'vasp/poscar').data
         sys_data['atom_masses'] = jdata['mass_map']
         ret = make_pwscf_input(sys_data, fp_pp_files, fp_params, user_input = user_input)
-        with open('input', 'w') as fp:
+        with open(os.path.join(ii, 'input'), 'w') as fp:
             fp.write(ret)
-        os.chdir(cwd)
     # link pp files
-    _link_fp_vasp_pp(iter_index, jdata)
+    _link_fp_vasp_pp(iter_index, jdata, fp_tasks = fp_tasks)
 
 
 def make_fp_gaussian(iter_index,
-                     jdata):
+                     jdata,
+                     fp_tasks = None):
     # make config
-    fp_tasks = _make_fp_vasp_configs(iter_index, jdata)
+    if fp_tasks is None :
+        fp_tasks = _make_fp_vasp_configs(iter_index, jdata)
     if len(fp_tasks) == 0 :
         return
     # make gaussian gjf file
@@ -1027,21 +1608,20 @@ def make_fp_gaussian(iter_index,
         fp_params = jdata['user_fp_params']
     else:
         fp_params = jdata['fp_params']
-    cwd = os.getcwd()
     for ii in fp_tasks:
-        os.chdir(ii)
-        sys_data = dpdata.System('POSCAR').data
+        sys_data = dpdata.System(os.path.join(ii, 'POSCAR'), fmt = 'vasp/poscar').data
         ret = make_gaussian_input(sys_data, fp_params)
-        with open('input', 'w') as fp:
+        with open(os.path.join(ii, 'input'), 'w') as fp:
             fp.write(ret)
-        os.chdir(cwd)
     # link pp files
-    _link_fp_vasp_pp(iter_index, jdata)
+    _link_fp_vasp_pp(iter_index, jdata, fp_tasks = fp_tasks)
 
 def make_fp_cp2k (iter_index,
-                  jdata):
+                  jdata,
+                  fp_tasks = None):
     # make config
-    fp_tasks = _make_fp_vasp_configs(iter_index, jdata)
+    if fp_tasks is None :
+        fp_tasks = _make_fp_vasp_configs(iter_index, jdata)
     if len(fp_tasks) == 0 :
         return
     # make cp2k input
@@ -1051,41 +1631,53 @@ def make_fp_cp2k (iter_index,
         fp_params = jdata['user_fp_params']
     else:
         fp_params = jdata['fp_params']
-    cwd = os.getcwd()
     for ii in fp_tasks:
-        os.chdir(ii)
-        sys_data = dpdata.System('POSCAR').data
+        sys_data = dpdata.System(os.path.join(ii, 'POSCAR'), fmt = 'vasp/poscar').data
         # make input for every task
         cp2k_input = make_cp2k_input(sys_data, fp_params)
-        with open('input.inp', 'w') as fp:
+        with open(os.path.join(ii, 'input.inp'), 'w') as fp:
             fp.write(cp2k_input)
             fp.close()
         # make coord.xyz used by cp2k for every task
         cp2k_coord = make_cp2k_xyz(sys_data)
-        with open('coord.xyz', 'w') as fp:
+        with open(os.path.join(ii, 'coord.xyz'), 'w') as fp:
             fp.write(cp2k_coord)
             fp.close()
-        os.chdir(cwd)
 
     # link pp files
-    _link_fp_vasp_pp(iter_index, jdata)
+    _link_fp_vasp_pp(iter_index, jdata, fp_tasks = fp_tasks)
 
 def make_fp (iter_index,
              jdata,
-             mdata) :
+             mdata,
+             fp_tasks = None) :
+    """
+    make the fp tasks. if fp_tasks is given, their configs are already
+    made, only the inputs of these tasks are made. if the fp_resources of
+    mdata has auto_size, the tasks are split into the chunks of run_fp, the
+    resources of each chunk are sized, and NPAR and KPAR of the INCARs are
+    set to fit them (a linked INCAR is replaced by a file).
+    """
     fp_style = jdata['fp_style']
 
     if fp_style == "vasp" :
-        make_fp_vasp(iter_index, jdata)
+        make_fp_vasp(iter_index, jdata, fp_tasks = fp_tasks)
     elif fp_style == "pwscf" :
-        make_fp_pwscf(iter_index, jdata)
+        make_fp_pwscf(iter_index, jdata, fp_tasks = fp_tasks)
     elif fp_style == "gaussian" :
-        make_fp_gaussian(iter_index, jdata)
+        make_fp_gaussian(iter_index, jdata, fp_tasks = fp_tasks)
     elif fp_style == "cp2k" :
-        make_fp_cp2k(iter_index, jdata)
+        make_fp_cp2k(iter_index, jdata, fp_tasks = fp_tasks)
     else :
         raise RuntimeError ("unsupported fp style")
 
+    fp_resources = mdata.get('fp_resources', {})
+    if 'auto_size' in fp_resources and 'fp_group_size' in mdata :
+        work_path = os.path.join(make_iter_name(iter_index), fp_name)
+        fp_tasks = _get_fp_tasks(work_path, fp_tasks)
+        if len(fp_tasks) > 0 :
+            _size_fp_chunks(iter_index, work_path, fp_resources, _fp_chunks(jdata, mdata, fp_tasks))
+
 def _vasp_check_fin (ii) :
     if os.path.isfile(os.path.join(ii, 'OUTCAR')) :
         with open(os.path.join(ii, 'OUTCAR'), 'r') as fp :
@@ -1130,6 +1722,53 @@ def _cp2k_check_fin(ii):
         return False
     return True
 
+def _fp_task_cost (task_path) :
+    """
+    estimated cost of the fp task: natoms^3
+    """
+    with open(os.path.join(task_path, 'POSCAR')) as fp :
+        natoms = poscar_natoms(fp.read().split('\n'))
+    return natoms ** 3
+
+def _fp_task_costs (jdata, fp_tasks) :
+    if jdata.get('balance_chunks', False) :
+        return [_fp_task_cost(ii) for ii in fp_tasks]
+    return None
+
+def _fp_chunks (jdata, mdata, fp_tasks) :
+    """
+    the chunks of the fp tasks, split in the same way as by the dispatcher
+    in run_fp
+    """
+    return _split_tasks([os.path.basename(ii) for ii in fp_tasks],
+                        mdata['fp_group_size'],
+                        _fp_task_costs(jdata, fp_tasks))
+
+def _size_fp_chunks (iter_index, work_path, fp_resources, chunks) :
+    """
+    size the resources of the chunks of fp tasks by auto_size, and set NPAR
+    and KPAR of the INCARs of their tasks to fit the resources. the resources
+    are recorded in the work path and used by run_fp. the walltime is
+    calibrated by the fp jobs of the earlier iterations if time_per_unit is
+    not given.
+    """
+    time_per_unit = fp_resources['auto_size'].get('time_per_unit', None)
+    if time_per_unit is None :
+        root_path = os.path.dirname(os.path.dirname(os.path.abspath(work_path)))
+        prev_paths = [os.path.join(root_path, make_iter_name(ii), fp_name) for ii in range(iter_index)]
+        time_per_unit = calibrate_time_per_unit(prev_paths)
+        if time_per_unit is not None :
+            dlog.info('calibrated fp walltime: %g s per unit' % time_per_unit)
+    chunk_res = {}
+    for chunk in chunks :
+        task_paths = [os.path.join(work_path, ii) for ii in chunk]
+        res, npar, kpar = size_resources(fp_resources, [task_size(ii) for ii in task_paths], time_per_unit)
+        for ii in task_paths :
+            if os.path.isfile(os.path.join(ii, 'INCAR')) :
+                set_incar_parallel(os.path.join(ii, 'INCAR'), npar, kpar)
+        chunk_res['+'.join(chunk)] = res
+    return update_chunk_resources(work_path, chunk_res)
+
 def run_fp_inner (iter_index,
                   jdata,
                   mdata,
@@ -1138,16 +1777,20 @@ def run_fp_inner (iter_index,
                   backward_files,
                   check_fin,
                   log_file = "log",
-                  forward_common_files=[]) :
+                  forward_common_files=[],
+                  fp_tasks = None) :
     fp_command = mdata['fp_command']
     fp_group_size = mdata['fp_group_size']
     fp_resources = mdata['fp_resources']
 
     iter_name = make_iter_name(iter_index)
     work_path = os.path.join(iter_name, fp_name)
+    if fp_tasks is not None and len(fp_tasks) > 0 :
+        # the tasks are given by absolute paths by the pipeline, see
+        # run_model_devi_fp
+        work_path = os.path.dirname(fp_tasks[0])
 
-    fp_tasks = glob.glob(os.path.join(work_path, 'task.*'))
-    fp_tasks.sort()
+    fp_tasks = _get_fp_tasks(work_path, fp_tasks)
     if len(fp_tasks) == 0 :
         return
 
@@ -1156,6 +1799,16 @@ def run_fp_inner (iter_index,
     #     if not check_fin(ii) :
     #         fp_run_tasks.append(ii)
     run_tasks = [os.path.basename(ii) for ii in fp_run_tasks]
+    task_costs = _fp_task_costs(jdata, fp_run_tasks)
+    chunk_resources = None
+    if 'auto_size' in fp_resources :
+        # the chunks are sized by make_fp, unless the machine is decided
+        # afterwards or its group size is changed
+        chunk_res = load_chunk_resources(work_path)
+        chunks = [ii for ii in _fp_chunks(jdata, mdata, fp_run_tasks) if '+'.join(ii) not in chunk_res]
+        if len(chunks) > 0 :
+            chunk_res = _size_fp_chunks(iter_index, work_path, fp_resources, chunks)
+        chunk_resources = lambda chunk : chunk_res['+'.join(chunk)]
 
     dispatcher.run_jobs(mdata['fp_resources'],
                         [fp_command],
@@ -1166,13 +1819,16 @@ def run_fp_inner (iter_index,
                         forward_files,
                         backward_files,
                         outlog = log_file,
-                        errlog = log_file)
+                        errlog = log_file,
+                        task_costs = task_costs,
+                        chunk_resources = chunk_resources)
 
 
 def run_fp (iter_index,
             jdata,
             mdata,
-            dispatcher) :
+            dispatcher,
+            fp_tasks = None) :
     fp_style = jdata['fp_style']
     fp_pp_files = jdata['fp_pp_files']
 
@@ -1189,19 +1845,19 @@ def run_fp (iter_index,
         else:
             forward_common_files=[]
         run_fp_inner(iter_index, jdata, mdata, dispatcher, forward_files, backward_files, _vasp_check_fin,
-                     forward_common_files=forward_common_files)
+                     forward_common_files=forward_common_files, fp_tasks = fp_tasks)
     elif fp_style == "pwscf" :
         forward_files = ['input'] + fp_pp_files
         backward_files = ['output']
-        run_fp_inner(iter_index, jdata, mdata, dispatcher, forward_files, backward_files, _qe_check_fin, log_file = 'output')
+        run_fp_inner(iter_index, jdata, mdata, dispatcher, forward_files, backward_files, _qe_check_fin, log_file = 'output', fp_tasks = fp_tasks)
     elif fp_style == "gaussian":
         forward_files = ['input']
         backward_files = ['output']
-        run_fp_inner(iter_index, jdata, mdata, dispatcher, forward_files, backward_files, _gaussian_check_fin, log_file = 'output')
+        run_fp_inner(iter_index, jdata, mdata, dispatcher, forward_files, backward_files, _gaussian_check_fin, log_file = 'output', fp_tasks = fp_tasks)
     elif fp_style == "cp2k":
         forward_files = ['input.inp', 'coord.xyz']
         backward_files = ['output']
-        run_fp_inner(iter_index, jdata, mdata, dispatcher, forward_files, backward_files, _cp2k_check_fin, log_file = 'output')
+        run_fp_inner(iter_index, jdata, mdata, dispatcher, forward_files, backward_files, _cp2k_check_fin, log_file = 'output', fp_tasks = fp_tasks)
     else :
         raise RuntimeError ("unsupported fp style")
 
@@ -1413,8 +2069,10 @@ def post_fp (iter_index,
         post_fp_cp2k(iter_index, jdata)
     else :
         raise RuntimeError ("unsupported fp style")
-    # clean traj
+    # record the new systems for make_train
     iter_name = make_iter_name(iter_index)
+    DataManifest(os.path.join(iter_name, fp_name)).update()
+    # clean traj
     clean_traj = True
     if 'model_devi_clean_traj' in jdata :
         clean_traj = jdata['model_devi_clean_traj']
@@ -1424,6 +2082,138 @@ def post_fp (iter_index,
         for ii in md_trajs :
             shutil.rmtree(ii)
 
+def _load_fp_pipeline (work_path,
+                       modd_path,
+                       jdata) :
+    """
+    the state of the model devi / fp pipeline in the fp work path, a new
+    fp work path is made if there is no state.
+    """
+    state_file = os.path.join(work_path, 'pipeline.json')
+    if os.path.isfile(state_file) :
+        with open(state_file) as fp :
+            return json.load(fp)
+    create_path(work_path)
+    # Move cvasp interface to jdata
+    if ('cvasp' in jdata) and (jdata['cvasp'] == True):
+        shutil.copyfile(cvasp_file, os.path.join(work_path,'cvasp.py'))
+    state = {'quota': {}, 'pending': {}, 'counter': {}, 'processed': [], 'batches': [], 'shuffled': {}}
+    for ii in sorted(glob.glob(os.path.join(modd_path, 'task.*'))) :
+        ss = os.path.basename(ii).split('.')[1]
+        state['quota'][ss] = jdata['fp_task_max']
+        state['pending'][ss] = state['pending'].get(ss, 0) + 1
+        state['counter'][ss] = 0
+    _dump_fp_pipeline(work_path, state)
+    return state
+
+def _dump_fp_pipeline (work_path, state) :
+    state_file = os.path.join(work_path, 'pipeline.json')
+    with open(state_file + '.tmp', 'w') as fp :
+        json.dump(state, fp, indent = 4)
+    os.replace(state_file + '.tmp', state_file)
+
+def _make_fp_pipeline_tasks (iter_index,
+                             jdata,
+                             mdata,
+                             modd_tasks,
+                             state) :
+    """
+    make the fp tasks of the candidate frames of the finished model devi
+    tasks. each model devi task takes its share of the fp_task_max of its
+    system, the unused share is left to the tasks finished later.
+    return the names of the new fp tasks.
+    """
+    iter_name = make_iter_name(iter_index)
+    work_path = os.path.join(iter_name, fp_name)
+    type_map = jdata['type_map']
+    cluster_cutoff = jdata['cluster_cutoff'] if 'use_clusters' in jdata and jdata['use_clusters'] else None
+    if 'shuffled' in state :
+        # cut off the frames appended after the last dump of the state, the
+        # model devi tasks of an interrupted call are processed again
+        for fname in glob.glob(os.path.join(work_path, '*.shuffled.*.out')) :
+            size = state['shuffled'].get(os.path.basename(fname), 0)
+            if os.path.getsize(fname) > size :
+                with open(fname, 'r+') as fp :
+                    fp.truncate(size)
+    else :
+        state['shuffled'] = {}
+    fp_tasks = []
+    for tt in sorted(modd_tasks) :
+        if os.path.basename(tt) in state['processed'] :
+            continue
+        ss = os.path.basename(tt).split('.')[1]
+        candidate, rest_accurate, rest_failed \
+            = _select_model_devi_frames(tt,
+                                        jdata['model_devi_skip'],
+                                        1e+10, 1e+10,
+                                        jdata['model_devi_f_trust_lo'],
+                                        jdata['model_devi_f_trust_hi'],
+                                        cluster_cutoff)
+        candidate = _shuffle_frames(candidate)
+        numb_task = min(len(candidate), -(-state['quota'][ss] // state['pending'][ss]))
+        for name, frames in [('candidate', candidate), ('rest_accurate', rest_accurate), ('rest_failed', rest_failed)] :
+            fname = os.path.join(work_path, '%s.shuffled.%s.out' % (name, ss))
+            _write_frames(fname, [tt], np.zeros(len(frames), dtype = int), frames, mode = 'a')
+            state['shuffled'][os.path.basename(fname)] = os.path.getsize(fname)
+        for cc in range(numb_task) :
+            fp_task_path = os.path.join(work_path, make_fp_task_name(int(ss), state['counter'][ss] + cc))
+            if os.path.isdir(fp_task_path) :
+                # left by an interrupted run
+                shutil.rmtree(fp_task_path)
+            fp_tasks.append(_make_fp_vasp_task(work_path, [tt] + candidate[cc].tolist(), state['counter'][ss] + cc,
+                                               [], type_map, jdata, cluster_cutoff))
+            if cluster_cutoff is None :
+                dump_to_poscar(os.path.join(fp_tasks[-1], 'conf.dump'), os.path.join(fp_tasks[-1], 'POSCAR'), type_map)
+        state['quota'][ss] -= numb_task
+        state['pending'][ss] -= 1
+        state['counter'][ss] += numb_task
+        state['processed'].append(os.path.basename(tt))
+    if len(fp_tasks) > 0 :
+        make_fp(iter_index, jdata, mdata, fp_tasks = fp_tasks)
+    fp_tasks = [os.path.basename(ii) for ii in fp_tasks]
+    if len(fp_tasks) > 0 :
+        state['batches'].append(fp_tasks)
+    _dump_fp_pipeline(work_path, state)
+    return fp_tasks
+
+def run_model_devi_fp (iter_index,
+                       jdata,
+                       mdata,
+                       md_dispatcher,
+                       fp_dispatcher) :
+    """
+    run the model devi tasks, and make and run the fp tasks of a chunk of
+    model devi tasks as soon as it is finished (model_devi_fp_pipeline).
+    the progress is recorded in pipeline.json of the fp work path, the
+    pipeline is recovered at restart.
+    """
+    iter_name = make_iter_name(iter_index)
+    modd_path = os.path.join(iter_name, model_devi_name)
+    work_path = os.path.join(iter_name, fp_name)
+    state = _load_fp_pipeline(work_path, modd_path, jdata)
+    # the fp tasks are made without chdir, the fp threads use absolute paths anyway
+    abs_work_path = os.path.abspath(work_path)
+    nthreads = jdata.get('model_devi_fp_pipeline_threads', 4)
+    with ThreadPoolExecutor(max_workers = nthreads) as executor :
+        futures = []
+        def _submit_fp(fp_tasks) :
+            futures.append(executor.submit(run_fp, iter_index, jdata, mdata, fp_dispatcher,
+                                           fp_tasks = [os.path.join(abs_work_path, ii) for ii in fp_tasks]))
+        # the fp tasks made before the restart
+        for batch in state['batches'] :
+            _submit_fp(batch)
+        def _callback(chunk) :
+            fp_tasks = _make_fp_pipeline_tasks(iter_index, jdata, mdata,
+                                               [os.path.join(modd_path, ii) for ii in chunk], state)
+            if len(fp_tasks) > 0 :
+                dlog.info('submit %d fp tasks of %d model devi tasks' % (len(fp_tasks), len(chunk)))
+                _submit_fp(fp_tasks)
+        run_model_devi(iter_index, jdata, mdata, md_dispatcher, callback = _callback)
+        # the model devi tasks finished before the restart
+        _callback([os.path.basename(ii) for ii in glob.glob(os.path.join(modd_path, 'task.*'))])
+        for ff in futures :
+            ff.result()
+
 def set_version(mdata):
     if 'deepmd_path' in mdata:
         deepmd_version = '0.1'
@@ -1520,18 +2310,26 @@ def run_iter (param_file, machine_file) :
                 log_iter ("run_model_devi", ii, jj)
                 mdata = decide_model_devi_machine(mdata)
                 disp = make_dispatcher(mdata['model_devi_machine'])
-                run_model_devi (ii, jdata, mdata, disp)
+                if jdata.get('model_devi_fp_pipeline', False) :
+                    # make_fp and run_fp are done together with run_model_devi
+                    mdata = decide_fp_machine(mdata)
+                    fp_disp = make_dispatcher(mdata['fp_machine'])
+                    run_model_devi_fp (ii, jdata, mdata, disp, fp_disp)
+                else :
+                    run_model_devi (ii, jdata, mdata, disp)
             elif jj == 5 :
                 log_iter ("post_model_devi", ii, jj)
                 post_model_devi (ii, jdata, mdata)
             elif jj == 6 :
                 log_iter ("make_fp", ii, jj)
-                make_fp (ii, jdata, mdata)
+                if not jdata.get('model_devi_fp_pipeline', False) :
+                    make_fp (ii, jdata, mdata)
             elif jj == 7 :
                 log_iter ("run_fp", ii, jj)
-                mdata = decide_fp_machine(mdata)
-                disp = make_dispatcher(mdata['fp_machine'])
-                run_fp (ii, jdata, mdata, disp)
+                if not jdata.get('model_devi_fp_pipeline', False) :
+                    mdata = decide_fp_machine(mdata)
+                    disp = make_dispatcher(mdata['fp_machine'])
+                    run_fp (ii, jdata, mdata, disp)
             elif jj == 8 :
                 log_iter ("post_fp", ii, jj)
                 post_fp (ii, jdata)
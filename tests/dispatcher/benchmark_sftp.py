@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+compare the transfer throughput of the single sftp channel and the pool of
+sftp channels. the chunks are uploaded and downloaded by concurrent threads
+as the Dispatcher does with submit_threads.
+
+python benchmark_sftp.py HOSTNAME WORK_PATH -u USER -c 1 4 8
+"""
+import os,sys,time,shutil,getpass,argparse,tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from dpgen.dispatcher.SSHContext import SSHSession, SSHContext
+
+
+def _make_chunks(local_root, nchunks, size) :
+    chunks = []
+    for ii in range(nchunks) :
+        chunk = 'task.%03d' % ii
+        os.makedirs(os.path.join(local_root, chunk))
+        with open(os.path.join(local_root, chunk, 'data'), 'wb') as fp:
+            fp.write(os.urandom(size))
+        chunks.append(chunk)
+    return chunks
+
+
+def _run(profile, local_root, chunks, threads) :
+    session = SSHSession(profile)
+    contexts = [SSHContext(local_root, session) for ii in chunks]
+    with ThreadPoolExecutor(max_workers = threads) as executor :
+        start = time.time()
+        list(executor.map(lambda cc : cc[0].upload([cc[1]], ['data']), zip(contexts, chunks)))
+        t_up = time.time() - start
+        start = time.time()
+        list(executor.map(lambda cc : cc[0].download([cc[1]], ['data']), zip(contexts, chunks)))
+        t_down = time.time() - start
+    for ii in contexts :
+        ii.clean()
+    session.close()
+    return t_up, t_down
+
+
+def _main() :
+    parser = argparse.ArgumentParser(description = 'benchmark of the sftp channel pool')
+    parser.add_argument('hostname', type = str)
+    parser.add_argument('work_path', type = str, help = 'existing remote work path')
+    parser.add_argument('-p', '--port', type = int, default = 22)
+    parser.add_argument('-u', '--username', type = str, default = getpass.getuser())
+    parser.add_argument('-n', '--nchunks', type = int, default = 8, help = 'number of chunks')
+    parser.add_argument('-s', '--size', type = float, default = 16, help = 'size of each chunk in MB')
+    parser.add_argument('-c', '--channels', type = int, nargs = '+', default = [1, 4, 8], help = 'sizes of the sftp pool')
+    parser.add_argument('-t', '--connections', type = int, default = 1, help = 'number of ssh connections')
+    args = parser.parse_args()
+
+    local_root = tempfile.mkdtemp()
+    chunks = _make_chunks(local_root, args.nchunks, int(args.size * (1 << 20)))
+    tot_size = args.nchunks * args.size
+    print('%8s %12s %12s' % ('channels', 'up MB/s', 'down MB/s'))
+    for nchannels in args.channels :
+        profile = {'hostname': args.hostname,
+                   'port': args.port,
+                   'username': args.username,
+                   'work_path': args.work_path,
+                   'sftp_channels': nchannels,
+                   'ssh_connections': min(args.connections, nchannels)}
+        # a single channel is the transfer without the pool
+        t_up, t_down = _run(profile, local_root, chunks, max(nchannels, 1))
+        print('%8d %12.2f %12.2f' % (nchannels, tot_size / t_up, tot_size / t_down))
+    shutil.rmtree(local_root)
+
+
+if __name__ == '__main__' :
+    _main()
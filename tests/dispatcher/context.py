@@ -7,10 +7,22 @@ from dpgen.dispatcher.LocalContext import LocalContext
 from dpgen.dispatcher.LazyLocalContext import LazyLocalContext
 from dpgen.dispatcher.SSHContext import SSHSession
 from dpgen.dispatcher.SSHContext import SSHContext
+from dpgen.dispatcher.SSHContext import SFTPPool
+from dpgen.dispatcher.SSHContext import get_ssh_clients
+from dpgen.dispatcher.FileCache import FileCache
+from dpgen.dispatcher.LocalContext import SPRetObj
+from dpgen.dispatcher.Slurm import Slurm
+from dpgen.dispatcher.LSF import LSF
+from dpgen.dispatcher.PBS import PBS
+from dpgen.dispatcher.JobStatus import JobStatus
 from dpgen.dispatcher.Dispatcher import FinRecord
+from dpgen.dispatcher.JobRecord import JobRecord
 from dpgen.dispatcher.Dispatcher import _split_tasks
+from dpgen.dispatcher.Dispatcher import PollTimer
+from dpgen.dispatcher.Dispatcher import PMap
 
 from dpgen.dispatcher.LocalContext import _identical_files
+from dpgen.dispatcher.LocalContext import _copy_file
 
 def setUpModule():
     os.chdir(os.path.abspath(os.path.dirname(__file__)))
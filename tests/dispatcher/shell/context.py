@@ -9,6 +9,7 @@ from dpgen.dispatcher.LocalContext import LocalContext
 from dpgen.dispatcher.Shell import Shell
 from dpgen.dispatcher.JobStatus import JobStatus
 from dpgen.dispatcher.Dispatcher import Dispatcher
+from dpgen.dispatcher.JobRecord import JobRecord
 
 def my_file_cmp(test, f0, f1):
     with open(f0) as fp0 :
@@ -8,6 +8,7 @@ from .context import LocalContext
 from .context import Shell
 from .context import JobStatus
 from .context import Dispatcher
+from .context import JobRecord
 from .context import my_file_cmp
 from .context import setUpModule
 
@@ -42,4 +43,133 @@ class TestDispatcher(unittest.TestCase) :
                       os.path.join('loc', ii, 'test1'))
             self.assertTrue(os.path.isfile(os.path.join('loc', ii, 'hereout.log')))
             self.assertTrue(os.path.isfile(os.path.join('loc', ii, 'hereerr.log')))
-            
+
+
+class TestDispatcherJobs(unittest.TestCase) :
+    """
+    each test starts from clean work paths, the job records are not shared
+    """
+    def setUp(self) :
+        for ii in ['loc', 'rmt'] :
+            if os.path.isdir(ii) :
+                shutil.rmtree(ii)
+        for ii in ['loc/task0', 'loc/task1', 'loc/task2']:
+            os.makedirs(ii)
+            with open(os.path.join(ii, 'test0'),'w') as fp:
+                fp.write('this is test0 from ' + ii + '\n')
+        os.makedirs('rmt')
+
+    def tearDown(self) :
+        shutil.rmtree('loc')
+        shutil.rmtree('rmt')
+
+    def test_sub_callback(self):
+        tasks = ['task0', 'task1', 'task2']
+        disp = Dispatcher({'work_path':'rmt', 'poll_interval':1}, context_type = 'local', batch_type = 'shell')
+        fin_chunks = []
+        disp.run_jobs(None,
+                      'cp test0 test1',
+                      'loc',
+                      tasks,
+                      2,
+                      [],
+                      ['test0'],
+                      ['test1'],
+                      callback = fin_chunks.append)
+        self.assertEqual(sorted(sum(fin_chunks, [])), tasks)
+        for ii in tasks:
+            my_file_cmp(self, 
+                      os.path.join('loc', ii, 'test0'),
+                      os.path.join('loc', ii, 'test1'))
+
+    def test_sub_threads(self):
+        tasks = ['task0', 'task1', 'task2']
+        disp = Dispatcher({'work_path':'rmt', 'poll_interval':1, 'submit_threads':3}, context_type = 'local', batch_type = 'shell')
+        cwd = os.getcwd()
+        disp.run_jobs(None,
+                      'cp test0 test1',
+                      'loc',
+                      tasks,
+                      1,
+                      [],
+                      ['test0'],
+                      ['test1'])
+        self.assertEqual(os.getcwd(), cwd)
+        for ii in tasks:
+            my_file_cmp(self, 
+                      os.path.join('loc', ii, 'test0'),
+                      os.path.join('loc', ii, 'test1'))
+
+    def test_sub_select(self):
+        tasks = ['task0', 'task1', 'task2']
+        disp = Dispatcher({'work_path':'rmt', 'poll_interval':1}, context_type = 'local', batch_type = 'shell')
+        selected = []
+        def _select(task_path):
+            selected.append(os.path.basename(task_path))
+            # the backward files are already there
+            self.assertTrue(os.path.isfile(os.path.join(task_path, 'test1')))
+            return ['test2']
+        disp.run_jobs(None,
+                      'cp test0 test1; cp test0 test2; cp test0 test3',
+                      'loc',
+                      tasks,
+                      2,
+                      [],
+                      ['test0'],
+                      ['test1'],
+                      backward_task_select = _select)
+        self.assertEqual(sorted(selected), tasks)
+        for ii in tasks:
+            my_file_cmp(self, 
+                      os.path.join('loc', ii, 'test0'),
+                      os.path.join('loc', ii, 'test2'))
+            self.assertFalse(os.path.isfile(os.path.join('loc', ii, 'test3')))
+
+    def test_sub_chunk_resources(self):
+        tasks = ['task0', 'task1', 'task2']
+        disp = Dispatcher({'work_path':'rmt', 'poll_interval':1}, context_type = 'local', batch_type = 'shell')
+        chunks = []
+        def _resources(chunk):
+            chunks.append(chunk)
+            return {'envs': {'DPGEN_NTASKS': len(chunk)}}
+        disp.run_jobs(None,
+                      "bash -c 'echo $DPGEN_NTASKS > test1'",
+                      'loc',
+                      tasks,
+                      2,
+                      [],
+                      ['test0'],
+                      ['test1'],
+                      chunk_resources = _resources)
+        self.assertEqual(sorted(sum(chunks, [])), tasks)
+        for chunk in chunks:
+            for ii in chunk:
+                with open(os.path.join('loc', ii, 'test1')) as fp:
+                    self.assertEqual(fp.read().strip(), str(len(chunk)))
+
+    def test_sub_restart(self):
+        tasks = ['task0', 'task1', 'task2']
+        disp = Dispatcher({'work_path':'rmt', 'poll_interval':1}, context_type = 'local', batch_type = 'shell')
+        disp.run_jobs(None,
+                      'cp test0 test1',
+                      'loc',
+                      tasks,
+                      2,
+                      [],
+                      ['test0'],
+                      ['test1'])
+        self.assertEqual(JobRecord('loc').progress(), {'finished': 2})
+        # the finished chunks are not submitted again
+        fin_chunks = []
+        disp.run_jobs(None,
+                      'cp test0 test2',
+                      'loc',
+                      tasks,
+                      2,
+                      [],
+                      ['test0'],
+                      ['test2'],
+                      callback = fin_chunks.append)
+        self.assertEqual(fin_chunks, [])
+        for ii in tasks:
+            self.assertFalse(os.path.isfile(os.path.join('loc', ii, 'test2')))
@@ -9,6 +9,7 @@ from .context import Shell
 from .context import JobStatus
 from .context import my_file_cmp
 from .context import setUpModule
+from dpgen.dispatcher.LocalPool import _pools
 
 class TestShell(unittest.TestCase) :
     def setUp(self) :
@@ -116,3 +117,98 @@ class TestShell(unittest.TestCase) :
         self.assertTrue (os.path.isfile(os.path.join('rmt', self.shell.context.remote_root, 'task0/test2')))
         self.assertTrue (os.path.isfile(os.path.join('rmt', self.shell.context.remote_root, 'task1/test2')))
         
+
+    def test_sub_manual_gpu(self) :
+        job_dirs = ['task0', 'task1']
+        self.shell.context.upload(job_dirs, ['test0'])
+        # task0 of the first command is finished in the last run
+        with open(os.path.join(self.shell.context.remote_root, 'task0', 'tag_0_finished'), 'w') as fp:
+            fp.write('')
+        res = {'manual_cuda_devices': 2}
+        self.shell.submit(job_dirs, ["bash -c 'echo $CUDA_VISIBLE_DEVICES > test1'", 'touch test2'], res = res)
+        while True:
+            ret = self.shell.check_status()
+            if ret == JobStatus.finished  :
+                break
+            self.assertEqual(ret, JobStatus.running)
+            time.sleep(1)
+        self.assertTrue(os.path.isfile(os.path.join(self.shell.context.remote_root, 'tag_finished')))
+        self.assertFalse(os.path.isfile(os.path.join(self.shell.context.remote_root, 'task0', 'test1')))
+        with open(os.path.join(self.shell.context.remote_root, 'task1', 'test1')) as fp:
+            self.assertTrue(fp.read().strip() in ['0', '1'])
+        for ii in job_dirs :
+            self.assertTrue(os.path.isfile(os.path.join(self.shell.context.remote_root, ii, 'tag_1_finished')))
+            self.assertTrue(os.path.isfile(os.path.join(self.shell.context.remote_root, ii, 'test2')))
+
+    def test_sub_manual_gpu_fail(self) :
+        job_dirs = ['task0', 'task1']
+        self.shell.context.upload(job_dirs, ['test0'])
+        os.remove(os.path.join(self.shell.context.remote_root, 'task1', 'test0'))
+        res = {'manual_cuda_devices': 2}
+        self.shell.submit(job_dirs, ['cat test0', 'touch test2'], res = res)
+        while True:
+            ret = self.shell.check_status()
+            if ret != JobStatus.running  :
+                break
+            time.sleep(1)
+        self.assertEqual(ret, JobStatus.terminated)
+        self.assertTrue(os.path.isfile(os.path.join(self.shell.context.remote_root, 'task0', 'tag_0_finished')))
+        self.assertFalse(os.path.isfile(os.path.join(self.shell.context.remote_root, 'task1', 'tag_0_finished')))
+        self.assertFalse(os.path.isfile(os.path.join(self.shell.context.remote_root, 'task0', 'test2')))
+
+    def test_sub_pool(self) :
+        job_dirs = ['task0', 'task1']
+        self.shell.context.upload(job_dirs, ['test0'])
+        res = {'local_pool': True, 'pool_size': 2, 'manual_cuda_devices': 2}
+        self.shell.submit(job_dirs, ["bash -c 'echo $CUDA_VISIBLE_DEVICES > test1'", 'touch test2'], res = res)
+        while True:
+            ret = self.shell.check_status()
+            if ret == JobStatus.finished  :
+                break
+            self.assertEqual(ret, JobStatus.running)
+            time.sleep(1)
+        self.assertEqual(self.shell.task_codes, {'task0': 0, 'task1': 0})
+        self.assertTrue(os.path.isfile(os.path.join(self.shell.context.remote_root, 'tag_finished')))
+        gpus = []
+        for ii in job_dirs :
+            self.assertTrue(os.path.isfile(os.path.join(self.shell.context.remote_root, ii, 'tag_1_finished')))
+            self.assertTrue(os.path.isfile(os.path.join(self.shell.context.remote_root, ii, 'test2')))
+            with open(os.path.join(self.shell.context.remote_root, ii, 'test1')) as fp:
+                gpus.append(fp.read().strip())
+        self.assertTrue(set(gpus) <= set(['0', '1']))
+        # the pool is shut down once the job is done
+        self.assertIsNone(self.shell.pool)
+        self.assertEqual(_pools, {})
+
+    def test_sub_pool_affinity(self) :
+        job_dirs = ['task0', 'task1']
+        self.shell.context.upload(job_dirs, ['test0'])
+        res = {'local_pool': True, 'pool_size': 2, 'task_per_node': 1}
+        self.shell.submit(job_dirs, ["bash -c 'nproc > test1'"], res = res)
+        while True:
+            ret = self.shell.check_status()
+            if ret != JobStatus.running :
+                break
+            time.sleep(1)
+        self.assertEqual(ret, JobStatus.finished)
+        for ii in job_dirs :
+            with open(os.path.join(self.shell.context.remote_root, ii, 'test1')) as fp:
+                self.assertEqual(fp.read().strip(), '1')
+
+    def test_sub_pool_fail(self) :
+        job_dirs = ['task0', 'task1']
+        self.shell.context.upload(job_dirs, ['test0'])
+        os.remove(os.path.join(self.shell.context.remote_root, 'task1', 'test0'))
+        res = {'local_pool': True, 'pool_size': 2}
+        self.shell.submit(job_dirs, ['cat test0 > test1', 'touch test2'], res = res)
+        while True:
+            ret = self.shell.check_status()
+            if ret != JobStatus.running :
+                break
+            time.sleep(1)
+        self.assertEqual(ret, JobStatus.terminated)
+        self.assertEqual(self.shell.task_codes['task0'], 0)
+        self.assertNotEqual(self.shell.task_codes['task1'], 0)
+        self.assertTrue (os.path.isfile(os.path.join(self.shell.context.remote_root, 'task0/tag_1_finished')))
+        self.assertFalse(os.path.isfile(os.path.join(self.shell.context.remote_root, 'task1/tag_0_finished')))
+        self.assertFalse(os.path.isfile(os.path.join(self.shell.context.remote_root, 'tag_finished')))
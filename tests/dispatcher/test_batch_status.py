@@ -0,0 +1,180 @@
+import os,sys,json,glob,shutil,uuid,time
+import subprocess as sp
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+__package__ = 'dispatcher'
+from .context import Slurm, LSF, PBS, JobStatus
+from .context import SPRetObj
+from .context import setUpModule
+
+class FakeContext(object):
+    """
+    record the commands and return canned outputs
+    """
+    def __init__ (self, job_id, finished, outputs):
+        self.job_id = job_id
+        self.finished = finished
+        self.outputs = outputs
+        self.remote_root = 'rmt'
+        self.job_uuid = str(uuid.uuid4())
+        self.commands = []
+
+    def block_call(self, cmd):
+        self.commands.append(cmd)
+        code, out, err = self.outputs
+        return code, None, SPRetObj(out.encode('utf-8')), SPRetObj(err.encode('utf-8'))
+
+    def check_file_exists(self, fname):
+        if fname == 'job_id':
+            return True
+        return self.finished
+
+    def read_file(self, fname):
+        return self.job_id
+
+    def block_checkcall(self, cmd):
+        self.commands.append(cmd)
+        code, out, err = self.outputs
+        return None, SPRetObj(out.encode('utf-8')), SPRetObj(err.encode('utf-8'))
+
+    def write_file(self, fname, write_str):
+        with open(os.path.join(self.remote_root, fname), 'w') as fp:
+            fp.write(write_str)
+
+
+class TestStatusAll(unittest.TestCase):
+    def _make_batches(self, cls, outputs):
+        job_ids = ['101', '102', '103']
+        finished = [False, True, False]
+        batches = [cls(FakeContext(ii, jj, outputs)) for ii,jj in zip(job_ids, finished)]
+        return batches
+
+    def test_slurm(self):
+        outputs = (0, '101 R\n', '')
+        batches = self._make_batches(Slurm, outputs)
+        stat = Slurm.check_status_all(batches)
+        self.assertEqual(stat, [JobStatus.running, JobStatus.finished, JobStatus.terminated])
+        # only one squeue call for all jobs
+        self.assertEqual(len(batches[0].context.commands), 1)
+        self.assertEqual(len(batches[1].context.commands), 0)
+        self.assertIn('101,102,103', batches[0].context.commands[0])
+
+    def test_slurm_max_query(self):
+        outputs = (0, '101 PD\n102 CG\n', '')
+        batches = self._make_batches(Slurm, outputs)
+        stat = Slurm.check_status_all(batches, max_query = 2)
+        self.assertEqual(stat, [JobStatus.waiting, JobStatus.running, JobStatus.terminated])
+        self.assertEqual(len(batches[0].context.commands), 1)
+        self.assertEqual(len(batches[2].context.commands), 1)
+
+    def test_pbs(self):
+        outputs = (153,
+                   'Job ID  Name  User  Time Use S Queue\n' +
+                   '------- ----- ----- -------- - -----\n' +
+                   '101.ser run.sub user 00:00:01 R batch\n',
+                   'qstat: Unknown Job Id 102.server\nqstat: Unknown Job Id 103.server\n')
+        batches = self._make_batches(PBS, outputs)
+        stat = PBS.check_status_all(batches)
+        self.assertEqual(stat, [JobStatus.running, JobStatus.finished, JobStatus.terminated])
+        self.assertEqual(len(batches[0].context.commands), 1)
+
+    def test_lsf(self):
+        outputs = (255,
+                   'JOBID USER STAT QUEUE FROM_HOST EXEC_HOST JOB_NAME SUBMIT_TIME\n' +
+                   '101 user PEND normal host - dpgen Jan 1 00:00\n',
+                   'Job <102> is not found\nJob <103> is not found\n')
+        batches = self._make_batches(LSF, outputs)
+        stat = LSF.check_status_all(batches)
+        self.assertEqual(stat, [JobStatus.waiting, JobStatus.finished, JobStatus.terminated])
+        self.assertEqual(len(batches[0].context.commands), 1)
+
+    def test_lsf_array(self):
+        outputs = (0,
+                   'JOBID USER STAT QUEUE FROM_HOST EXEC_HOST JOB_NAME SUBMIT_TIME\n' +
+                   '101 user RUN normal host host dpgen[1] Jan 1 00:00\n' +
+                   '101 user PEND normal host dpgen[3] Jan 1 00:00\n',
+                   '')
+        batches = [LSF(FakeContext(ii, False, outputs)) for ii in ['101[1]', '101[2]', '101[3]']]
+        stat = LSF.check_status_all(batches)
+        self.assertEqual(stat, [JobStatus.running, JobStatus.unknown, JobStatus.waiting])
+        # the indexes are not globbed by the shell
+        self.assertEqual(batches[0].context.commands[0], "bjobs '101[1]' '101[2]' '101[3]'")
+        # an element checked alone
+        self.assertEqual(batches[2].check_status(), JobStatus.running)
+        self.assertEqual(batches[2].context.commands[0], "bjobs '101[3]'")
+
+    def test_pbs_array(self):
+        outputs = (0,
+                   'Job ID  Name  User  Time Use S Queue\n' +
+                   '------- ----- ----- -------- - -----\n' +
+                   '101[0].ser run.sub user 00:00:01 R batch\n',
+                   '')
+        batches = [PBS(FakeContext(ii, False, outputs)) for ii in ['101[0].server', '101[1].server']]
+        stat = PBS.check_status_all(batches)
+        self.assertEqual(stat[0], JobStatus.running)
+        self.assertEqual(batches[0].context.commands[0], "qstat '101[0].server' '101[1].server'")
+
+
+class TestSubmitArray(unittest.TestCase):
+    def setUp(self):
+        self.roots = ['rmt%d' % ii for ii in range(3)] + ['rmt_array']
+        for ii in self.roots:
+            os.makedirs(ii, exist_ok = True)
+
+    def tearDown(self):
+        for ii in self.roots:
+            shutil.rmtree(ii)
+
+    def _submit(self, cls, output, max_array_size = 1000):
+        batches = []
+        for ii in range(3):
+            context = FakeContext('', False, None)
+            context.remote_root = os.path.abspath(self.roots[ii])
+            batch = cls(context)
+            # each element runs the sub script in its own root
+            context.write_file(batch.sub_script_name, 'echo %d > array_out\n' % ii)
+            batches.append(batch)
+        array_context = FakeContext('', False, (0, output, ''))
+        array_context.remote_root = 'rmt_array'
+        cls.submit_array(batches, array_context, max_array_size = max_array_size)
+        return batches, array_context
+
+    def test_slurm(self):
+        batches, array_context = self._submit(Slurm, 'Submitted batch job 123\n')
+        self.assertEqual([bb.job_id for bb in batches], ['123_0', '123_1', '123_2'])
+        with open(os.path.join(self.roots[1], 'job_id')) as fp:
+            self.assertEqual(fp.read(), '123_1')
+        # one sbatch for all jobs
+        self.assertEqual(len(array_context.commands), 1)
+        self.assertIn('--array=0-2', array_context.commands[0])
+        script = glob.glob(os.path.join('rmt_array', '*.array.0.sub'))
+        self.assertEqual(len(script), 1)
+        env = os.environ.copy()
+        env['SLURM_ARRAY_TASK_ID'] = '1'
+        sp.check_call(['bash', os.path.abspath(script[0])], env = env, cwd = 'rmt_array')
+        self.assertFalse(os.path.isfile(os.path.join(self.roots[0], 'array_out')))
+        with open(os.path.join(self.roots[1], 'array_out')) as fp:
+            self.assertEqual(fp.read().strip(), '1')
+
+    def test_slurm_max_array_size(self):
+        batches, array_context = self._submit(Slurm, 'Submitted batch job 123\n', max_array_size = 2)
+        self.assertEqual(len(array_context.commands), 2)
+        self.assertIn('--array=0-1', array_context.commands[0])
+        self.assertIn('--array=0-0', array_context.commands[1])
+
+    def test_pbs(self):
+        batches, array_context = self._submit(PBS, '123[].server\n')
+        self.assertEqual([bb.job_id for bb in batches], ['123[0].server', '123[1].server', '123[2].server'])
+        self.assertIn('-t 0-2', array_context.commands[0])
+
+    def test_lsf(self):
+        batches, array_context = self._submit(LSF, 'Job <123> is submitted to queue <normal>.\n')
+        self.assertEqual([bb.job_id for bb in batches], ['123[1]', '123[2]', '123[3]'])
+        self.assertIn("-J 'dpgen[1-3]'", array_context.commands[0])
+        script = glob.glob(os.path.join('rmt_array', '*.array.0.sub'))
+        env = os.environ.copy()
+        env['LSB_JOBINDEX'] = '3'
+        sp.check_call(['bash', os.path.abspath(script[0])], env = env, cwd = 'rmt_array')
+        with open(os.path.join(self.roots[2], 'array_out')) as fp:
+            self.assertEqual(fp.read().strip(), '2')
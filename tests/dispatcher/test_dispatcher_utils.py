@@ -5,6 +5,8 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 __package__ = 'dispatcher'
 from .context import FinRecord
 from .context import _split_tasks
+from .context import PollTimer
+from .context import PMap
 from .context import setUpModule
 
 class TestFinRecord(unittest.TestCase):
@@ -38,4 +40,51 @@ class TestDispatchSplit(unittest.TestCase):
         chunks = _split_tasks(tasks, 5)
         self.assertEqual(chunks, [[0,3,6,9,12],[1,4,7,10],[2,5,8,11]])
 
-        
+    def test_split_cost(self):
+        tasks = ['t%d' % ii for ii in range(6)]
+        costs = [8, 1, 1, 1, 4, 3]
+        chunks = _split_tasks(tasks, 2, costs)
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(sorted(sum(chunks, [])), tasks)
+        # the most expensive task runs alone
+        self.assertIn(['t0'], chunks)
+        tot = [sum([costs[tasks.index(jj)] for jj in ii]) for ii in chunks]
+        self.assertEqual(sorted(tot), [5, 5, 8])
+
+    def test_split_cost_deterministic(self):
+        tasks = ['t%d' % ii for ii in range(13)]
+        costs = [1] * 13
+        self.assertEqual(_split_tasks(tasks, 5, costs), _split_tasks(tasks, 5, costs))
+        self.assertEqual(sorted(sum(_split_tasks(tasks, 5, costs), [])), sorted(tasks))
+
+class TestPollTimer(unittest.TestCase):
+    def test_backoff(self):
+        timer = PollTimer(2, 5, backoff = 2)
+        self.assertTrue(timer.is_due())
+        timer.update('running')
+        self.assertEqual(timer.cur_interval, 2)
+        self.assertFalse(timer.is_due())
+        timer.update('running')
+        self.assertEqual(timer.cur_interval, 4)
+        timer.update('running')
+        self.assertEqual(timer.cur_interval, 5)
+        self.assertLessEqual(timer.time_to_due(), 5)
+
+    def test_reset(self):
+        timer = PollTimer(2, 10, backoff = 2)
+        timer.update('waiting')
+        timer.update('waiting')
+        self.assertEqual(timer.cur_interval, 4)
+        timer.update('running')
+        self.assertEqual(timer.cur_interval, 2)
+
+class TestPMap(unittest.TestCase):
+    def test_dump_atomic(self):
+        pmap = PMap('.', fname = 'pmap.test.json')
+        self.addCleanup(pmap.delete)
+        pmap.dump({'task0': 'job0'})
+        self.assertEqual(pmap.load(), {'task0': 'job0'})
+        # written through a temporary file that does not survive the dump
+        pmap.dump({'task0': 'job0', 'task1': 'job1'})
+        self.assertFalse(os.path.exists('pmap.test.json.tmp'))
+        self.assertEqual(pmap.load(), {'task0': 'job0', 'task1': 'job1'})
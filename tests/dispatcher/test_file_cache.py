@@ -0,0 +1,136 @@
+import os,sys,json,glob,shutil,uuid,time
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+__package__ = 'dispatcher'
+from .context import LocalContext, LocalSession
+from .context import FileCache
+from .context import setUpModule
+
+class TestFileCache(unittest.TestCase):
+    def setUp(self) :
+        os.makedirs('loc/task0/dir0', exist_ok = True)
+        os.makedirs('loc/task0/empty', exist_ok = True)
+        with open('loc/task0/small', 'w') as fp:
+            fp.write('foo')
+        with open('loc/task0/big', 'w') as fp:
+            fp.write('a' * 2048)
+        with open('loc/task0/dir0/big', 'w') as fp:
+            fp.write('b' * 2048)
+        os.makedirs('rmt', exist_ok = True)
+        self.cache_path = os.path.abspath('rmt/cache')
+        self.work_profile = LocalSession({'work_path':'rmt'})
+
+    def tearDown(self):
+        shutil.rmtree('loc')
+        shutil.rmtree('rmt')
+        if os.path.isfile('cache.json') :
+            os.remove('cache.json')
+
+    def _put(self, cache, context, files) :
+        # mimic the upload of SSHContext
+        hits, misses, rest = cache.split_files(context.local_root, files)
+        misses += cache.link(context, hits)
+        for ii in rest + [jj[0] for jj in misses] :
+            src = os.path.join(context.local_root, ii)
+            dst = os.path.join(context.remote_root, ii)
+            if os.path.isdir(src) :
+                os.makedirs(dst, exist_ok = True)
+            else :
+                os.makedirs(os.path.dirname(dst), exist_ok = True)
+                shutil.copyfile(src, dst)
+        cache.register(context, misses)
+        return hits, misses, rest
+
+    def test_split(self) :
+        cache = FileCache(self.cache_path, 'cache.json', min_size = 1)
+        hits, misses, rest = cache.split_files(os.path.abspath('loc'), ['task0'])
+        self.assertEqual(hits, [])
+        self.assertEqual(sorted([ii[0] for ii in misses]), ['task0/big', 'task0/dir0/big'])
+        self.assertEqual(sorted(rest), ['task0/empty', 'task0/small'])
+
+    def test_reuse(self) :
+        cache = FileCache(self.cache_path, 'cache.json', min_size = 1)
+        ctx0 = LocalContext('loc', self.work_profile)
+        hits, misses, rest = self._put(cache, ctx0, ['task0'])
+        self.assertEqual(len(misses), 2)
+        self.assertEqual(len(os.listdir(self.cache_path)), 2)
+        # the manifest is reloaded, the second upload links the cached files
+        cache = FileCache(self.cache_path, 'cache.json', min_size = 1)
+        ctx1 = LocalContext('loc', self.work_profile)
+        hits, misses, rest = self._put(cache, ctx1, ['task0'])
+        self.assertEqual(len(hits), 2)
+        self.assertEqual(len(misses), 0)
+        for ii in ['task0/big', 'task0/dir0/big'] :
+            self.assertTrue(os.path.samefile(os.path.join(ctx0.remote_root, ii),
+                                             os.path.join(ctx1.remote_root, ii)))
+        self.assertTrue(os.path.isdir(os.path.join(ctx1.remote_root, 'task0/empty')))
+
+    def test_missing(self) :
+        cache = FileCache(self.cache_path, 'cache.json', min_size = 1)
+        ctx0 = LocalContext('loc', self.work_profile)
+        self._put(cache, ctx0, ['task0'])
+        shutil.rmtree(self.cache_path)
+        ctx1 = LocalContext('loc', self.work_profile)
+        hits, misses, rest = self._put(cache, ctx1, ['task0'])
+        # the lost files are uploaded again and cached
+        self.assertEqual(len(misses), 2)
+        self.assertEqual(len(os.listdir(self.cache_path)), 2)
+        with open(os.path.join(ctx1.remote_root, 'task0/big')) as fp:
+            self.assertEqual(fp.read(), 'a' * 2048)
+
+    def test_evict(self) :
+        cache = FileCache(self.cache_path, 'cache.json', size_limit = 3000. / (1 << 30), min_size = 1)
+        ctx0 = LocalContext('loc', self.work_profile)
+        self._put(cache, ctx0, ['task0/big'])
+        ctx1 = LocalContext('loc', self.work_profile)
+        self._put(cache, ctx1, ['task0/dir0/big'])
+        self.assertEqual(len(cache.objects), 1)
+        self.assertEqual(len(os.listdir(self.cache_path)), 1)
+        # the job files are not touched by the eviction
+        self.assertTrue(os.path.isfile(os.path.join(ctx0.remote_root, 'task0/big')))
+
+    def test_verify(self) :
+        cache = FileCache(self.cache_path, 'cache.json', min_size = 1)
+        ctx0 = LocalContext('loc', self.work_profile)
+        self._put(cache, ctx0, ['task0'])
+        self.assertEqual(cache.verify(ctx0), 0)
+        broken = os.path.join(self.cache_path, os.listdir(self.cache_path)[0])
+        with open(broken, 'w') as fp:
+            fp.write('c')
+        self.assertEqual(cache.verify(ctx0), 1)
+        self.assertEqual(len(cache.objects), 1)
+        self.assertEqual(len(os.listdir(self.cache_path)), 1)
+
+    def test_rewrite(self) :
+        cache = FileCache(self.cache_path, 'cache.json', min_size = 1)
+        ctx0 = LocalContext('loc', self.work_profile)
+        self._put(cache, ctx0, ['task0'])
+        # the job can rewrite its input, changing the cached file it shares
+        job_file = os.path.join(ctx0.remote_root, 'task0/big')
+        self.assertTrue(os.access(job_file, os.W_OK))
+        with open(job_file, 'w') as fp:
+            fp.write('c' * 2048)
+        # the next process finds the change and uploads the file again
+        cache = FileCache(self.cache_path, 'cache.json', min_size = 1)
+        ctx1 = LocalContext('loc', self.work_profile)
+        hits, misses, rest = self._put(cache, ctx1, ['task0'])
+        self.assertEqual([ii[0] for ii in misses], ['task0/big'])
+        with open(os.path.join(ctx1.remote_root, 'task0/big')) as fp:
+            self.assertEqual(fp.read(), 'a' * 2048)
+        self.assertEqual(cache.verify(ctx1), 0)
+
+    def test_rewrite_same_process(self) :
+        cache = FileCache(self.cache_path, 'cache.json', min_size = 1)
+        ctx0 = LocalContext('loc', self.work_profile)
+        self._put(cache, ctx0, ['task0'])
+        ctx1 = LocalContext('loc', self.work_profile)
+        self._put(cache, ctx1, ['task0'])
+        with open(os.path.join(ctx1.remote_root, 'task0/big'), 'w') as fp:
+            fp.write('c' * 2048)
+        # the changed file is not linked into the next job of the process
+        ctx2 = LocalContext('loc', self.work_profile)
+        hits, misses, rest = self._put(cache, ctx2, ['task0'])
+        self.assertEqual([ii[0] for ii in misses], ['task0/big'])
+        with open(os.path.join(ctx2.remote_root, 'task0/big')) as fp:
+            self.assertEqual(fp.read(), 'a' * 2048)
@@ -0,0 +1,76 @@
+import os,sys,json,glob,shutil,time,sqlite3
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+__package__ = 'dispatcher'
+from .context import JobRecord
+from .context import setUpModule
+
+class TestJobRecord(unittest.TestCase):
+    def setUp(self):
+        os.makedirs('jr', exist_ok = True)
+        self.jr = JobRecord('jr')
+
+    def tearDown(self):
+        shutil.rmtree('jr')
+
+    def test_submit(self):
+        self.jr.submit('aaa', 0, 'task0', '/loc', '/rmt/uuid0', '101')
+        self.jr.submit('bbb', 1, 'task1', '/loc', '/rmt/uuid1', '102')
+        records = JobRecord('jr').load()
+        self.assertEqual(records['aaa']['remote_root'], '/rmt/uuid0')
+        self.assertEqual(records['aaa']['job_id'], '101')
+        self.assertEqual(records['bbb']['status'], 'submitted')
+        self.assertEqual(self.jr.get_record(['aaa', 'bbb', 'ccc']), [False, False, False])
+
+    def test_submit_again(self):
+        self.jr.submit('aaa', 0, 'task0', '/loc', '/rmt/uuid0', '101')
+        self.jr.set_status('aaa', 'terminated')
+        submit_time = self.jr.load()['aaa']['submit_time']
+        self.jr.submit('aaa', 0, 'task0', '/loc', '/rmt/uuid1', '103')
+        records = self.jr.load()
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records['aaa']['remote_root'], '/rmt/uuid1')
+        self.assertEqual(records['aaa']['job_id'], '103')
+        self.assertEqual(records['aaa']['status'], 'submitted')
+        # the first submission is kept
+        self.assertEqual(records['aaa']['submit_time'], submit_time)
+
+    def test_status(self):
+        self.jr.submit('aaa', 0, 'task0', '/loc', '/rmt/uuid0', '101')
+        self.jr.set_status('aaa', 'running')
+        start_time = self.jr.load()['aaa']['start_time']
+        self.assertIsNotNone(start_time)
+        self.jr.resubmit('aaa', '103')
+        record = self.jr.load()['aaa']
+        self.assertEqual(record['retries'], 1)
+        self.assertEqual(record['job_id'], '103')
+        self.assertIsNone(record['start_time'])
+        self.jr.set_status('aaa', 'running')
+        self.jr.set_status('aaa', 'finished')
+        record = self.jr.load()['aaa']
+        self.assertIsNotNone(record['finish_time'])
+        self.assertTrue(record['finish_time'] >= record['start_time'])
+        self.assertEqual(self.jr.get_record(['aaa']), [True])
+
+    def test_threads(self):
+        def _submit(ii):
+            self.jr.submit('chunk%d' % ii, ii, 'task%d' % ii, '/loc', '/rmt/uuid%d' % ii)
+            self.jr.set_status('chunk%d' % ii, 'finished')
+        with ThreadPoolExecutor(max_workers = 8) as executor:
+            list(executor.map(_submit, range(32)))
+        records = self.jr.load()
+        self.assertEqual(len(records), 32)
+        self.assertTrue(all([ii['status'] == 'finished' for ii in records.values()]))
+        with sqlite3.connect(self.jr.fname) as conn:
+            self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+
+    def test_import_legacy(self):
+        path_map = {'bbb': ['/loc', '/rmt/uuid1']}
+        self.jr.import_legacy(['aaa', 'bbb', 'ccc'], ['task0', 'task1', 'task2'], [True, False, False], path_map)
+        records = self.jr.load()
+        self.assertEqual(sorted(records.keys()), ['aaa', 'bbb'])
+        self.assertEqual(records['aaa']['status'], 'finished')
+        self.assertEqual(records['bbb']['remote_root'], '/rmt/uuid1')
+        self.assertEqual(self.jr.get_record(['aaa', 'bbb', 'ccc']), [True, False, False])
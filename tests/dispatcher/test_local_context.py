@@ -7,6 +7,7 @@ __package__ = 'dispatcher'
 from .context import LocalContext, LocalSession
 from .context import setUpModule
 from .context import _identical_files
+from .context import _copy_file
 
 class TestIdFile(unittest.TestCase) :
     def test_id(self) :
@@ -92,6 +93,56 @@ class TestLocalContext(unittest.TestCase):
                     rmts = fp.read()
                 self.assertEqual(locs, rmts)
 
+    def test_upload_link_mode(self) :
+        tasks = ['task0', 'task1']
+        files = ['test0', 'dir2']
+        for link_mode in ['hardlink', 'copy'] :
+            work_profile = LocalSession({'work_path':'rmt', 'link_mode': link_mode})
+            self.job = LocalContext('loc', work_profile)
+            self.job.upload(tasks, files)
+            for ii in tasks :
+                for jj in ['test0', 'dir2/dtest0'] :
+                    locf = os.path.join('loc', ii, jj)
+                    rmtf = os.path.join('rmt', self.job.job_uuid, ii, jj)
+                    self.assertFalse(os.path.islink(rmtf))
+                    self.assertTrue(_identical_files(locf, rmtf))
+                    self.assertEqual(os.path.samefile(locf, rmtf), link_mode == 'hardlink')
+            # upload again replaces the files
+            self.job.upload(tasks, files)
+
+    def test_unknown_link_mode(self) :
+        with self.assertRaises(RuntimeError):
+            LocalSession({'work_path':'rmt', 'link_mode': 'foo'})
+
+    def test_copy_file(self) :
+        with open('f0', 'wb') as fp:
+            fp.write(os.urandom(3 << 20))
+        _copy_file('f0', 'f1')
+        with open('f0', 'rb') as fp:
+            data0 = fp.read()
+        with open('f1', 'rb') as fp:
+            data1 = fp.read()
+        self.assertEqual(data0, data1)
+        os.remove('f0')
+        os.remove('f1')
+
+    def test_dl_replace_file(self) :
+        work_profile = LocalSession({'work_path':'rmt', 'link_mode': 'copy'})
+        self.job  = LocalContext('loc', work_profile)
+        tasks = ['task0', 'task1']
+        self.job.upload(tasks, ['test0'])
+        record_uuid = []
+        for ii in tasks :
+            # an existing local file is replaced by the remote one
+            with open(os.path.join('rmt', self.job.job_uuid, ii, 'test1'), 'w') as fp:
+                tmp = str(uuid.uuid4())
+                fp.write(tmp)
+                record_uuid.append(tmp)
+        self.job.download(tasks, ['test0', 'test1'])
+        for ii, tmp in zip(tasks, record_uuid) :
+            with open(os.path.join('loc', ii, 'test1')) as fp:
+                self.assertEqual(fp.read(), tmp)
+
     def test_dl_f_f(self):
         # no local, no remote
         self.test_download_non_exist()
@@ -1,10 +1,14 @@
 import os,sys,json,glob,shutil,uuid,getpass
+import subprocess as sp
+import threading
 import unittest
 from pathlib import Path
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 __package__ = 'dispatcher'
 from .context import SSHContext, SSHSession
+from .context import SFTPPool
+from .context import get_ssh_clients
 from .context import setUpModule
 
 class TestSSHContext(unittest.TestCase):
@@ -147,3 +151,226 @@ class TestSSHContext(unittest.TestCase):
         tmp1 = self.job.read_file('aaa')
         self.assertEqual(tmp, tmp1)
 
+
+
+class LocalChannel(object):
+    """
+    mimic the paramiko channel by a local process
+    """
+    def exec_command(self, cmd):
+        self.proc = sp.Popen(cmd, shell = True, stdin = sp.PIPE, stdout = sp.PIPE, stderr = sp.PIPE)
+
+    def makefile(self, mode):
+        if 'w' in mode:
+            return self.proc.stdin
+        return self.proc.stdout
+
+    def makefile_stderr(self, mode):
+        return self.proc.stderr
+
+    def shutdown_write(self):
+        self.proc.stdin.close()
+
+    def recv_exit_status(self):
+        return self.proc.wait()
+
+    def close(self):
+        for ii in [self.proc.stdin, self.proc.stdout, self.proc.stderr]:
+            ii.close()
+
+
+class LocalClient(object):
+    def get_transport(self):
+        return self
+
+    def open_session(self):
+        return LocalChannel()
+
+    def open_sftp(self):
+        raise IOError('no sftp')
+
+
+class LocalSSHSession(object):
+    def __init__(self, work_path, compress_level):
+        self.work_path = work_path
+        self.transfer_mode = 'stream'
+        self.compress_level = compress_level
+        self.file_cache = None
+
+    def get_session_root(self):
+        return self.work_path
+
+    def get_ssh_client(self):
+        return LocalClient()
+
+    def ensure_alive(self):
+        pass
+
+
+class TestSSHStream(unittest.TestCase):
+    def setUp(self) :
+        for ii in ['loc/task0', 'loc/task1']:
+            os.makedirs(os.path.join(ii, 'dir0'), exist_ok = True)
+            for jj in ['test0', 'dir0/test1']:
+                with open(os.path.join(ii, jj),'w') as fp:
+                    fp.write(str(uuid.uuid4()))
+        os.makedirs('rmt', exist_ok = True)
+
+    def tearDown(self):
+        shutil.rmtree('loc')
+        shutil.rmtree('rmt')
+
+    def _test_round_trip(self, compress_level) :
+        session = LocalSSHSession(os.path.abspath('rmt'), compress_level)
+        job = SSHContext('loc', session)
+        os.makedirs(job.remote_root)
+        tasks = ['task0', 'task1']
+        job.upload(tasks, ['test0', 'dir0'])
+        for ii in tasks :
+            for jj in ['test0', 'dir0/test1'] :
+                with open(os.path.join('loc', ii, jj)) as fp:
+                    locs = fp.read()
+                with open(os.path.join(job.remote_root, ii, jj)) as fp:
+                    rmts = fp.read()
+                self.assertEqual(locs, rmts)
+        record = {}
+        for ii in tasks :
+            record[ii] = str(uuid.uuid4())
+            with open(os.path.join(job.remote_root, ii, 'test2'), 'w') as fp:
+                fp.write(record[ii])
+        job.download(tasks, ['test2'])
+        for ii in tasks :
+            with open(os.path.join('loc', ii, 'test2')) as fp:
+                self.assertEqual(fp.read(), record[ii])
+        with self.assertRaises(RuntimeError):
+            job.download(tasks, ['foo'])
+
+    def test_gzip(self) :
+        self._test_round_trip(6)
+
+    def test_missing_root(self) :
+        session = LocalSSHSession(os.path.abspath('rmt'), 0)
+        job = SSHContext('loc', session)
+        # the remote root is not made, nothing is unpacked elsewhere
+        with self.assertRaises(RuntimeError):
+            job.upload(['task0'], ['test0'])
+        self.assertFalse(os.path.exists(os.path.join('task0', 'test0')))
+
+    def test_chatty_stderr(self) :
+        session = LocalSSHSession(os.path.abspath('rmt'), 0)
+        job = SSHContext('loc', session)
+        os.makedirs(os.path.join(job.remote_root, 'task0'))
+        # the errors of tar are more than a pipe holds
+        missing = ['missing_file_with_a_long_name.%05d' % ii for ii in range(3000)]
+        with self.assertRaises(RuntimeError):
+            job.download(['task0'], missing)
+
+    def test_no_compress(self) :
+        self._test_round_trip(0)
+
+
+class FakeSFTP(object):
+    def __init__(self, client):
+        self.client = client
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeClient(object):
+    def open_sftp(self):
+        return FakeSFTP(self)
+
+
+class TestSFTPPool(unittest.TestCase):
+    def test_round_robin(self):
+        clients = [FakeClient(), FakeClient()]
+        pool = SFTPPool(clients, 3)
+        sftps = [pool.get() for ii in range(3)]
+        self.assertEqual([ii.client for ii in sftps], [clients[0], clients[1], clients[0]])
+        # the released channel is reused
+        pool.put(sftps[2])
+        self.assertIs(pool.get(), sftps[2])
+
+    def test_wait(self):
+        pool = SFTPPool([FakeClient()], 1)
+        sftp = pool.get()
+        ret = []
+        thread = threading.Thread(target = lambda : ret.append(pool.get()))
+        thread.start()
+        thread.join(0.1)
+        # no more than one channel is opened
+        self.assertTrue(thread.is_alive())
+        pool.put(sftp)
+        thread.join()
+        self.assertIs(ret[0], sftp)
+
+    def test_discard(self):
+        pool = SFTPPool([FakeClient()], 1)
+        sftp = pool.get()
+        pool.discard(sftp)
+        self.assertTrue(sftp.closed)
+        self.assertIsNot(pool.get(), sftp)
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+    def send_ignore(self):
+        pass
+
+
+class FakeSSHClient(object):
+    def __init__(self):
+        self.transport = FakeTransport()
+
+    def get_transport(self):
+        return self.transport
+
+    def close(self):
+        self.transport.active = False
+
+
+class TestSSHClients(unittest.TestCase):
+    def setUp(self):
+        self.module = sys.modules[SSHContext.__module__]
+        self.connect = self.module._connect
+        self.nconnect = 0
+        def _connect(hostname, port, username = None, password = None):
+            self.nconnect += 1
+            return FakeSSHClient()
+        self.module._connect = _connect
+
+    def tearDown(self):
+        self.module._connect = self.connect
+        self.module._ssh_clients.clear()
+
+    def test_reuse(self):
+        c0 = get_ssh_clients('host', 22, username = 'user')
+        c1 = get_ssh_clients('host', 22, username = 'user')
+        self.assertIs(c0[0], c1[0])
+        self.assertEqual(self.nconnect, 1)
+        # another user does not share the connection
+        c2 = get_ssh_clients('host', 22, username = 'other')
+        self.assertIsNot(c0[0], c2[0])
+        self.assertEqual(self.nconnect, 2)
+
+    def test_number(self):
+        c0 = get_ssh_clients('host', 22, number = 2)
+        c1 = get_ssh_clients('host', 22, number = 1)
+        self.assertEqual(len(c0), 2)
+        self.assertIs(c0[0], c1[0])
+        self.assertEqual(self.nconnect, 2)
+
+    def test_reconnect(self):
+        c0 = get_ssh_clients('host', 22)
+        c0[0].get_transport().active = False
+        c1 = get_ssh_clients('host', 22)
+        self.assertIsNot(c0[0], c1[0])
+        self.assertTrue(c1[0].get_transport().is_active())
+        self.assertEqual(self.nconnect, 2)
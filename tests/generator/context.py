@@ -2,6 +2,13 @@ import sys,os
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
 from dpgen.generator.run import *
+from dpgen.generator.run import _select_model_devi_traj
+from dpgen.generator.run import _select_model_devi_frames
+from dpgen.generator.run import _load_model_devi_cache
+from dpgen.generator.run import _model_devi_task_cost
+from dpgen.generator.run import _fp_task_cost
+from dpgen.generator.run import _size_fp_chunks
+from dpgen.generator.run import _fp_chunks
 from dpgen.generator.lib.gaussian import detect_multiplicity
 
 param_file = 'param-mg-vasp.json'
@@ -0,0 +1,134 @@
+import os,sys,json,glob,shutil
+import dpdata
+import numpy as np
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+__package__ = 'generator'
+from .context import make_train
+from .context import run_train
+from .context import param_file
+from .context import machine_file
+from .context import setUpModule
+from dpgen.generator.lib.compact import CompactStore
+from dpgen.generator.lib.manifest import DataManifest
+
+
+class FakeDispatcher(object):
+    def run_jobs(self, resources, command, work_path, tasks, group_size,
+                 forward_common_files, *args, **kwargs):
+        self.forward_common_files = forward_common_files
+
+
+def _make_fp_data(iter_idx, system) :
+    fp_path = os.path.join('iter.%06d' % iter_idx, '02.fp')
+    os.makedirs(os.path.join(fp_path, 'task.000.000000'), exist_ok = True)
+    system.to_deepmd_raw(os.path.join(fp_path, 'data.000'))
+    system.to_deepmd_npy(os.path.join(fp_path, 'data.000'))
+    DataManifest(fp_path).update()
+
+
+class TestCompact(unittest.TestCase):
+    def setUp(self) :
+        self.system = dpdata.LabeledSystem(os.path.join('data', 'deepmd'), fmt = 'deepmd/npy')
+        self.params = {'set_size': 2}
+
+    def tearDown(self) :
+        for ii in glob.glob('iter.*') + ['data.compact'] :
+            if os.path.isdir(ii) :
+                shutil.rmtree(ii)
+
+    def _sets(self, name) :
+        return sorted([os.path.basename(ii) for ii in glob.glob(os.path.join('data.compact', name, 'set.*'))])
+
+    def test_store(self) :
+        _make_fp_data(0, self.system)
+        sys_path = os.path.join('iter.000000', '02.fp', 'data.000')
+        store = CompactStore('data.compact', self.params)
+        store.append(sys_path, 0, [0, 2], 2)
+        store.commit(1)
+        self.assertEqual(store.systems(), [('sys.000.0', 0)])
+        # interrupted append, not committed
+        store.append(sys_path, 0, [0, 1, 2], 2)
+        store.append(sys_path, 3, [1], 2)
+        self.assertEqual(len(self._sets('sys.000.0')), 3)
+        store = CompactStore('data.compact', self.params)
+        self.assertEqual(store.record['iters'], 1)
+        self.assertEqual(self._sets('sys.000.0'), ['set.000000'])
+        self.assertFalse(os.path.isdir(os.path.join('data.compact', 'sys.003.0')))
+        store.append(sys_path, 0, [0, 1, 2], 2)
+        store.commit(2)
+        self.assertEqual(self._sets('sys.000.0'), ['set.000000', 'set.000001', 'set.000002'])
+        merged = dpdata.LabeledSystem(os.path.join('data.compact', 'sys.000.0'), fmt = 'deepmd/npy')
+        np.testing.assert_allclose(merged['coords'], self.system['coords'][[0, 2, 0, 1, 2]])
+        np.testing.assert_allclose(merged['energies'], self.system['energies'][[0, 2, 0, 1, 2]])
+        # the committed sets are not changed by the later appends
+        sets = [list(ii) for ii in store.record['systems']['sys.000.0']['sets']]
+        store.append(sys_path, 0, [1, 0, 2], 2)
+        self.assertEqual(len(self._sets('sys.000.0')), 5)
+        store = CompactStore('data.compact', self.params)
+        self.assertEqual(self._sets('sys.000.0'), ['set.000000', 'set.000001', 'set.000002'])
+        store.append(sys_path, 0, [1, 0, 2], 2)
+        store.commit(3)
+        self.assertEqual(store.record['systems']['sys.000.0']['sets'][:3], sets)
+        self.assertEqual(store.record['systems']['sys.000.0']['sets'][3:], [['set.000003', 2], ['set.000004', 1]])
+        self.assertEqual(np.load(os.path.join('data.compact', 'sys.000.0', 'set.000002', 'coord.npy')).shape[0], 1)
+        merged = dpdata.LabeledSystem(os.path.join('data.compact', 'sys.000.0'), fmt = 'deepmd/npy')
+        np.testing.assert_allclose(merged['coords'], self.system['coords'][[0, 2, 0, 1, 2, 1, 0, 2]])
+        # made again with other settings
+        store = CompactStore('data.compact', {'set_size': 3})
+        self.assertEqual(store.record['iters'], 0)
+        self.assertEqual(store.systems(), [])
+
+    def test_make_train(self) :
+        with open (param_file, 'r') as fp :
+            jdata = json.load (fp)
+        with open (machine_file, 'r') as fp:
+            mdata = json.load (fp)
+        jdata['fp_task_min'] = 1
+        jdata['model_devi_jobs'] = [jdata['model_devi_jobs'][0]] * 6
+        jdata['training_compact'] = {'interval': 2, 'set_size': 4}
+        make_train(0, jdata, mdata)
+        shutil.rmtree('iter.000000/00.train')
+        for ii in range(3) :
+            _make_fp_data(ii, self.system)
+        make_train(3, jdata, mdata)
+        train_path = os.path.join('iter.000003', '00.train')
+        with open(os.path.join(train_path, '000', 'input.json')) as fp :
+            jinput = json.load(fp)
+        systems = jinput['systems'] if 'systems' in jinput else jinput['training']['systems']
+        # iters 0 and 1 are merged, iter 2 is not
+        self.assertTrue(os.path.join('..', 'data.compact', 'sys.000.0') in systems)
+        self.assertFalse(any(['iter.000000' in ii or 'iter.000001' in ii for ii in systems]))
+        self.assertTrue(os.path.join('..', 'data.iters', 'iter.000002', '02.fp', 'data.000') in systems)
+        merged = dpdata.LabeledSystem(os.path.join(train_path, 'data.compact', 'sys.000.0'), fmt = 'deepmd/npy')
+        self.assertEqual(merged.get_nframes(), 2 * self.system.get_nframes())
+        # a new set for each iteration
+        self.assertEqual(self._sets('sys.000.0'), ['set.000000', 'set.000001'])
+        # the training has a snapshot of the store
+        snapshot = os.path.join(train_path, 'data.compact', 'sys.000.0')
+        self.assertFalse(os.path.islink(os.path.join(train_path, 'data.compact')))
+        self.assertTrue(os.path.samefile(os.path.join(snapshot, 'set.000000', 'coord.npy'),
+                                         os.path.join('data.compact', 'sys.000.0', 'set.000000', 'coord.npy')))
+        # the merged systems are uploaded
+        disp = FakeDispatcher()
+        mdata['deepmd_version'] = '1.2'
+        mdata['python_path'] = 'python3'
+        mdata['train_resources'] = {}
+        run_train(3, jdata, mdata, disp)
+        data_sys = sorted(set([os.path.dirname(ii) for ii in disp.forward_common_files]))
+        self.assertTrue(os.path.join('data.compact', 'sys.000.0') in data_sys)
+        self.assertFalse(any(['iter.000000' in ii for ii in data_sys]))
+        # iters 2 and 3 are merged later, the snapshot of iter 3 is kept
+        for ii in range(3, 5) :
+            _make_fp_data(ii, self.system)
+        with open (machine_file, 'r') as fp:
+            mdata = json.load (fp)
+        make_train(5, jdata, mdata)
+        self.assertEqual(self._sets('sys.000.0'), ['set.000000', 'set.000001', 'set.000002', 'set.000003'])
+        merged = dpdata.LabeledSystem(snapshot, fmt = 'deepmd/npy')
+        self.assertEqual(merged.get_nframes(), 2 * self.system.get_nframes())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import os,sys,json,glob,shutil,time
+import dpdata
+import numpy as np
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+__package__ = 'generator'
+from .context import detect_batch_size
+from .context import setUpModule
+from dpgen.generator.lib.manifest import DataManifest, system_info, manifest_name
+
+
+class TestDataManifest(unittest.TestCase):
+    def setUp(self) :
+        self.fp_path = os.path.join('manifest', '02.fp')
+        os.makedirs(self.fp_path)
+        shutil.copytree(os.path.join('data', 'deepmd'), os.path.join(self.fp_path, 'data.000'))
+        # clusters
+        for ii in ['sys0', 'sys1'] :
+            shutil.copytree(os.path.join('data', 'deepmd'), os.path.join(self.fp_path, 'data.001', ii))
+        self.system = dpdata.LabeledSystem(os.path.join('data', 'deepmd'), fmt = 'deepmd/npy')
+
+    def tearDown(self) :
+        shutil.rmtree('manifest')
+
+    def test_system_info(self) :
+        info = system_info(os.path.join(self.fp_path, 'data.000'), checksum = True)
+        self.assertEqual(info['nframes'], self.system.get_nframes())
+        self.assertEqual(info['natoms'], self.system.get_natoms())
+        self.assertEqual(info['type_counts'], [int(ii) for ii in self.system['atom_numbs']])
+        self.assertEqual(len(info['checksum']), 40)
+        self.assertEqual(detect_batch_size('auto', os.path.join(self.fp_path, 'data.000')),
+                         min(max(32 // self.system.get_natoms(), 1), self.system.get_nframes()))
+
+    def test_update(self) :
+        DataManifest(self.fp_path).update()
+        with open(os.path.join(self.fp_path, manifest_name)) as fp :
+            records = json.load(fp)
+        self.assertEqual(sorted(records.keys()), ['data.000', os.path.join('data.001', 'sys0'), os.path.join('data.001', 'sys1')])
+        self.assertEqual(records['data.000'], system_info(os.path.join(self.fp_path, 'data.000'), checksum = True))
+        # unchanged systems are not read again
+        manifest = DataManifest(self.fp_path)
+        self.assertEqual(manifest.info(os.path.join(self.fp_path, 'data.000')), records['data.000'])
+        self.assertFalse(manifest.changed)
+        # a changed system is read again
+        box_file = os.path.join(self.fp_path, 'data.000', 'set.000', 'box.npy')
+        box = np.load(box_file)
+        np.save(box_file, box[:1])
+        info = manifest.info(os.path.join(self.fp_path, 'data.000'))
+        self.assertTrue(manifest.changed)
+        self.assertEqual(info['nframes'], self.system.get_nframes() - box.shape[0] + 1)
+        self.assertNotEqual(info['checksum'], records['data.000']['checksum'])
+        # removed systems are dropped
+        shutil.rmtree(os.path.join(self.fp_path, 'data.001'))
+        manifest.update()
+        self.assertEqual(list(DataManifest(self.fp_path).records.keys()), ['data.000'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+import os,sys,json,glob,shutil
+import dpdata
+import numpy as np
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+__package__ = 'generator'
+from .context import make_train
+from .context import run_train
+from .context import param_file
+from .context import machine_file
+from .context import setUpModule
+from dpgen.generator.lib.dedup import frame_descriptors, system_descriptors, FrameDedup
+from dpgen.generator.lib.manifest import DataManifest
+
+
+class FakeDispatcher(object):
+    def run_jobs(self, resources, command, work_path, tasks, group_size,
+                 forward_common_files, *args, **kwargs):
+        self.forward_common_files = forward_common_files
+
+
+def _make_fp_data(iter_idx, system) :
+    fp_path = os.path.join('iter.%06d' % iter_idx, '02.fp')
+    os.makedirs(os.path.join(fp_path, 'task.000.000000'), exist_ok = True)
+    system.to_deepmd_raw(os.path.join(fp_path, 'data.000'))
+    system.to_deepmd_npy(os.path.join(fp_path, 'data.000'))
+    DataManifest(fp_path).update()
+
+
+class TestDedup(unittest.TestCase):
+    def setUp(self) :
+        self.system = dpdata.LabeledSystem(os.path.join('data', 'deepmd'), fmt = 'deepmd/npy')
+        # the same frames translated by a vector
+        self.shifted = self.system.copy()
+        self.shifted.data['coords'] += np.array([0.3, -0.1, 2.2])
+        self.params = {'rcut': 4.0, 'tol': 0.01}
+
+    def tearDown(self) :
+        for ii in glob.glob('iter.*') :
+            shutil.rmtree(ii)
+
+    def test_descriptor(self) :
+        atom_types = np.array([0, 1, 0, 1])
+        coord = self.system['coords'][0]
+        cell = self.system['cells'][0]
+        desc = frame_descriptors(coord, cell, atom_types, 2, 4.0)
+        self.assertEqual([dd.shape[0] for dd in desc], [4, 4])
+        # invariant to the translation, the atoms of a type are permuted
+        for dd, ref in zip(frame_descriptors(coord + np.array([3., 4., -5.]), cell, atom_types, 2, 4.0), desc) :
+            np.testing.assert_allclose(dd, ref, atol = 1e-5)
+        for dd, ref in zip(frame_descriptors(coord[[2, 1, 0, 3]], cell, atom_types, 2, 4.0), desc) :
+            np.testing.assert_allclose(dd, ref[[2, 1, 0, 3]], atol = 1e-5)
+
+    def test_descriptor_images(self) :
+        # a skewed cell smaller than rcut, all images are counted
+        cell = np.array([[2.0, 0.0, 0.0], [1.9, 1.0, 0.0], [0.3, 0.2, 1.5]])
+        coord = np.array([[0.1, 0.2, 0.3], [1.5, 0.7, 1.0]])
+        atom_types = np.array([0, 0])
+        rcut = 3.5
+        desc = frame_descriptors(coord, cell, atom_types, 1, rcut)[0]
+        for ii in range(2) :
+            ref = []
+            for jj in range(2) :
+                for shift in np.array(np.meshgrid(*[np.arange(-8, 9)] * 3)).reshape([3, -1]).T :
+                    dist = np.linalg.norm(coord[jj] + np.dot(shift, cell) - coord[ii])
+                    if dist < rcut and not (ii == jj and np.all(shift == 0)) :
+                        ref.append(dist)
+            ref = np.sort(ref)
+            np.testing.assert_allclose(desc[ii][:len(ref)], ref)
+            np.testing.assert_allclose(desc[ii][len(ref):], rcut)
+
+    def test_select(self) :
+        self.system.append(self.shifted)
+        _make_fp_data(0, self.system)
+        sys_path = os.path.join('iter.000000', '02.fp', 'data.000')
+        descs = system_descriptors(sys_path, self.params['rcut'])
+        np.testing.assert_allclose(descs[0][:3], descs[0][3:], atol = 1e-5)
+        dedup = FrameDedup(self.params)
+        manifest = DataManifest(os.path.join('iter.000000', '02.fp'))
+        self.assertEqual(dedup.select(manifest, sys_path), [0, 1, 2])
+        self.assertEqual(dedup.pruned(), (3, 6))
+        # the descriptors are cached in the fp work path
+        self.assertEqual(manifest.info(sys_path)['descriptor_params'], self.params)
+        self.assertEqual(len(glob.glob(os.path.join('iter.000000', '02.fp', 'dedup.*.npz'))), 1)
+        dedup = FrameDedup(self.params)
+        self.assertEqual(dedup.select(manifest, sys_path), [0, 1, 2])
+
+    def test_select_local(self) :
+        # the frames differ in the neighbourhood of one atom
+        moved = self.system.sub_system([0])
+        moved.data['coords'][0, 1] += np.array([0.05, 0., 0.])
+        system = self.system.sub_system([0])
+        system.append(moved)
+        system.append(self.shifted.sub_system([0]))
+        _make_fp_data(0, system)
+        sys_path = os.path.join('iter.000000', '02.fp', 'data.000')
+        dedup = FrameDedup(self.params)
+        manifest = DataManifest(os.path.join('iter.000000', '02.fp'))
+        self.assertEqual(dedup.select(manifest, sys_path), [0, 1])
+
+    def test_make_train(self) :
+        with open (param_file, 'r') as fp :
+            jdata = json.load (fp)
+        with open (machine_file, 'r') as fp:
+            mdata = json.load (fp)
+        jdata['fp_task_min'] = 1
+        jdata['model_devi_jobs'] = [jdata['model_devi_jobs'][0]] * 3
+        jdata['training_dedup'] = self.params
+        make_train(0, jdata, mdata)
+        # iter 0 has duplicates in its data, iter 1 has no new frame
+        dup = self.system.copy()
+        dup.append(self.shifted)
+        _make_fp_data(0, dup)
+        _make_fp_data(1, self.system)
+        shutil.rmtree('iter.000000/00.train')
+        make_train(2, jdata, mdata)
+        train_path = os.path.join('iter.000002', '00.train')
+        with open(os.path.join(train_path, '000', 'input.json')) as fp :
+            jinput = json.load(fp)
+        systems = jinput['systems'] if 'systems' in jinput else jinput['training']['systems']
+        self.assertTrue(os.path.join('..', 'data.dedup', 'iter.000000', '02.fp', 'data.000') in systems)
+        self.assertFalse(any(['iter.000001' in ii for ii in systems]))
+        pruned = dpdata.LabeledSystem(os.path.join(train_path, 'data.dedup', 'iter.000000', '02.fp', 'data.000'), fmt = 'deepmd/npy')
+        np.testing.assert_allclose(pruned['coords'], self.system['coords'])
+        with open(os.path.join(train_path, 'dedup.json')) as fp :
+            summary = json.load(fp)
+        self.assertEqual(summary[os.path.join('iter.000000', '02.fp', 'data.000')], [3, 6])
+        self.assertEqual(summary[os.path.join('iter.000001', '02.fp', 'data.000')], [0, 3])
+        # only the pruned copy is uploaded
+        disp = FakeDispatcher()
+        mdata['deepmd_version'] = '1.2'
+        mdata['python_path'] = 'python3'
+        mdata['train_resources'] = {}
+        run_train(2, jdata, mdata, disp)
+        data_sys = sorted(set([os.path.dirname(ii) for ii in disp.forward_common_files]))
+        self.assertTrue(os.path.join('data.dedup', 'iter.000000', '02.fp', 'data.000') in data_sys)
+        self.assertFalse(any([ii.startswith('data.iters') for ii in data_sys]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+import os,sys,json,glob,shutil,time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+__package__ = 'generator'
+from .context import task_size
+from .context import size_resources
+from .context import calibrate_time_per_unit
+from .context import set_incar_parallel
+from .context import _size_fp_chunks
+from .context import _fp_chunks
+from .context import setUpModule
+from dpgen.generator.lib.resources import size_task, load_chunk_resources, dump_chunk_resources, update_chunk_resources
+from dpgen.dispatcher.JobRecord import JobRecord
+
+def _write_task(task_path, natoms, kpoints = None, kspacing = None) :
+    os.makedirs(task_path, exist_ok = True)
+    with open(os.path.join(task_path, 'POSCAR'), 'w') as fp :
+        fp.write('Mg\n1.0\n4 0 0\n0 4 0\n0 0 4\nMg\n%d\nCartesian\n' % natoms)
+    if kpoints is not None :
+        with open(os.path.join(task_path, 'KPOINTS'), 'w') as fp :
+            fp.write('Automatic mesh\n0\nGamma\n%d %d %d\n0 0 0\n' % tuple(kpoints))
+    incar = 'PREC=A\nNPAR=4\nKPAR=1\n'
+    if kspacing is not None :
+        incar += 'KSPACING=%f\nKGAMMA=T\n' % kspacing
+    with open(os.path.join(task_path, 'INCAR'), 'w') as fp :
+        fp.write(incar)
+
+
+class TestFpResources(unittest.TestCase):
+    def setUp(self) :
+        self.resources = {'numb_node': 1, 'task_per_node': 4, 'time_limit': '1:0:0',
+                          'auto_size': {'cores_per_node': 32, 'max_node': 4, 'atoms_per_core': 4}}
+        os.makedirs('fp_resources', exist_ok = True)
+
+    def tearDown(self) :
+        shutil.rmtree('fp_resources')
+
+    def test_task_size(self) :
+        _write_task(os.path.join('fp_resources', 'task.000'), 10, kpoints = [2, 2, 3])
+        self.assertEqual(task_size(os.path.join('fp_resources', 'task.000')), (10, 12))
+        # k-points from KSPACING: 2 pi / 4 / 0.5 -> 4 along each direction
+        _write_task(os.path.join('fp_resources', 'task.001'), 10, kspacing = 0.5)
+        self.assertEqual(task_size(os.path.join('fp_resources', 'task.001')), (10, 64))
+        _write_task(os.path.join('fp_resources', 'task.002'), 10)
+        self.assertEqual(task_size(os.path.join('fp_resources', 'task.002')), (10, 1))
+
+    def test_size_task(self) :
+        auto_size = self.resources['auto_size']
+        # a small system shares a node
+        self.assertEqual(size_task(auto_size, self.resources, 8, 1), (1, 2, 1, 1))
+        # 100 atoms, 25 ranks per k-point group, 4 groups, whole nodes
+        numb_node, task_per_node, npar, kpar = size_task(auto_size, self.resources, 100, 8)
+        self.assertEqual((numb_node, task_per_node, kpar), (4, 32, 4))
+        self.assertEqual((numb_node * task_per_node // kpar) % npar, 0)
+        # never exceeds max_node
+        numb_node, task_per_node, npar, kpar = size_task(auto_size, self.resources, 10000, 64)
+        self.assertEqual((numb_node, task_per_node, kpar), (4, 32, 1))
+
+    def test_size_resources(self) :
+        res, npar, kpar = size_resources(self.resources, [(8, 1), (4, 1)])
+        self.assertEqual(res['numb_node'], 1)
+        self.assertEqual(res['task_per_node'], 2)
+        self.assertEqual(res['time_limit'], '1:0:0')
+        self.assertFalse('auto_size' in res)
+        self.assertTrue('auto_size' in self.resources)
+        # (8^3 + 4^3) / 2 ranks * 100 s * 2
+        res, npar, kpar = size_resources(self.resources, [(8, 1), (4, 1)], time_per_unit = 100)
+        self.assertEqual(res['time_limit'], '16:00:00')
+        res, npar, kpar = size_resources(self.resources, [(8, 1)], time_per_unit = 1e-3)
+        self.assertEqual(res['time_limit'], '0:10:00')
+
+    def test_calibrate(self) :
+        work_path = os.path.join('fp_resources', 'iter.000000', '02.fp')
+        _write_task(os.path.join(work_path, 'task.000'), 8)
+        _write_task(os.path.join(work_path, 'task.001'), 8)
+        self.assertEqual(calibrate_time_per_unit([work_path]), None)
+        jr = JobRecord(work_path)
+        jr.submit('sha1', 0, 'task.000+task.001', '', '')
+        jr.set_status('sha1', 'running')
+        time.sleep(0.1)
+        jr.set_status('sha1', 'finished')
+        record = jr.load()['sha1']
+        elapsed = record['finish_time'] - record['start_time']
+        # the resources of the job are not recorded
+        self.assertEqual(calibrate_time_per_unit([work_path]), None)
+        # 2 tasks of 8^3 on the 1 x 4 ranks the job ran with
+        dump_chunk_resources(work_path, {'task.000+task.001': {'numb_node': 1, 'task_per_node': 4}})
+        self.assertAlmostEqual(calibrate_time_per_unit([work_path, 'foo']), elapsed / 256)
+
+    def test_set_incar_parallel(self) :
+        _write_task(os.path.join('fp_resources', 'task.000'), 8)
+        with open(os.path.join('fp_resources', 'INCAR'), 'w') as fp :
+            fp.write('PREC=A\nNPAR=4\n')
+        incar = os.path.join('fp_resources', 'task.000', 'INCAR')
+        os.remove(incar)
+        os.symlink('../INCAR', incar)
+        set_incar_parallel(incar, 2, 3)
+        self.assertFalse(os.path.islink(incar))
+        with open(incar) as fp :
+            self.assertEqual(fp.read(), 'PREC=A\nNPAR=2\nKPAR=3\n')
+        # the shared INCAR is not changed
+        with open(os.path.join('fp_resources', 'INCAR')) as fp :
+            self.assertEqual(fp.read(), 'PREC=A\nNPAR=4\n')
+
+    def test_chunk_resources(self) :
+        work_path = os.path.join('fp_resources', '02.fp')
+        _write_task(os.path.join(work_path, 'task.000'), 40, kpoints = [1, 1, 2])
+        _write_task(os.path.join(work_path, 'task.001'), 8)
+        tasks = [os.path.join(work_path, ii) for ii in ['task.000', 'task.001']]
+        chunks = _fp_chunks({}, {'fp_group_size': 1}, tasks)
+        self.assertEqual(chunks, [['task.000'], ['task.001']])
+        chunk_res = _size_fp_chunks(0, work_path, self.resources, chunks)
+        self.assertEqual(chunk_res, load_chunk_resources(work_path))
+        res = chunk_res['task.000']
+        self.assertEqual((res['numb_node'], res['task_per_node']), (1, 20))
+        with open(os.path.join(work_path, 'task.000', 'INCAR')) as fp :
+            incar = fp.read()
+        self.assertTrue('NPAR=2\n' in incar)
+        self.assertTrue('KPAR=2\n' in incar)
+        # the recorded chunks are kept
+        chunk_res = _size_fp_chunks(0, work_path, self.resources, [['task.000', 'task.001']])
+        self.assertEqual(set(chunk_res.keys()), set(['task.000', 'task.001', 'task.000+task.001']))
+
+    def test_update_chunk_resources(self) :
+        work_path = os.path.join('fp_resources', '02.fp')
+        os.makedirs(work_path, exist_ok = True)
+        # the pipeline threads record their chunks at the same time
+        with ThreadPoolExecutor(max_workers = 8) as executor :
+            list(executor.map(lambda ii : update_chunk_resources(work_path, {'task.%03d' % ii : {'numb_node': 1}}),
+                              range(64)))
+        self.assertEqual(len(load_chunk_resources(work_path)), 64)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,4 @@
-import os,sys,json,glob,shutil
+import os,sys,json,glob,shutil,random
 import dpdata
 import numpy as np
 import unittest
@@ -9,6 +9,13 @@ from .context import make_fp_vasp
 from .context import make_fp_pwscf
 from .context import make_fp_gaussian
 from .context import make_fp_cp2k
+from .context import _select_model_devi_traj
+from .context import run_model_devi_fp
+from .context import _select_model_devi_frames
+from .context import post_model_devi
+from .context import _load_model_devi_cache
+import dpgen.generator.run
+from dpgen.generator.run import _load_fp_pipeline, _make_fp_pipeline_tasks
 from .context import detect_multiplicity
 from .context import parse_cur_job
 from .context import param_file
@@ -628,6 +635,244 @@ class TestMakeFPCP2K(unittest.TestCase):
         shutil.rmtree('iter.000000')
 
 
+class TestSelectTraj(unittest.TestCase):
+    def test_select_traj(self):
+        if os.path.isdir('iter.000000') :
+            shutil.rmtree('iter.000000')
+        with open (param_pwscf_file, 'r') as fp :
+            jdata = json.load (fp)
+        md_descript = []
+        for ii in range(2) :
+            md_descript.append([np.arange(0, 0.29, 0.29/10) for jj in range(3)])
+        atom_types = [0, 1, 2, 2, 0, 1]
+        type_map = jdata['type_map']
+        _make_fake_md(0, md_descript, atom_types, type_map)
+        f_trust_lo = jdata['model_devi_f_trust_lo']
+        f_trust_hi = jdata['model_devi_f_trust_hi']
+        md_tasks = glob.glob(os.path.join('iter.000000', '01.model_devi', 'task.*'))
+        for tt in md_tasks :
+            traj = _select_model_devi_traj(tt, jdata)
+            md_out = np.loadtxt(os.path.join(tt, 'model_devi.out'))
+            ref = [os.path.join('traj', '%d.lammpstrj' % int(ii[0])) for ii in md_out \
+                   if ii[0] >= jdata['model_devi_skip'] and ii[4] >= f_trust_lo and ii[4] < f_trust_hi]
+            self.assertEqual(traj, sorted(ref, key = lambda ff : int(os.path.basename(ff).split('.')[0])))
+            self.assertTrue(len(traj) < len(md_out))
+            # drop the frames not selected, make_fp should not need them
+            for ff in glob.glob(os.path.join(tt, 'traj', '*.lammpstrj')) :
+                if os.path.relpath(ff, tt) not in traj :
+                    os.remove(ff)
+        make_fp_pwscf(0, jdata)
+        _check_sel(self, 0, jdata['fp_task_max'], f_trust_lo, f_trust_hi)
+        _check_poscars(self, 0, jdata['fp_task_max'], jdata['type_map'])
+        # wider trust levels need the frames that are not downloaded
+        shutil.rmtree(os.path.join('iter.000000', '02.fp'))
+        jdata['model_devi_f_trust_lo'] = 0
+        jdata['fp_task_max'] = 100
+        with self.assertRaisesRegex(RuntimeError, 'model_devi_select_traj'):
+            make_fp_pwscf(0, jdata)
+        shutil.rmtree('iter.000000')
+
+
+class TestSelectFrames(unittest.TestCase):
+    def setUp(self):
+        os.makedirs('select_frames', exist_ok = True)
+        np.random.seed(0)
+        self.md_out = np.random.uniform(0, 0.3, [20, 7 + 4])
+        self.md_out[:,0] = np.arange(20) * 10
+        np.savetxt(os.path.join('select_frames', 'model_devi.out'), self.md_out, header = 'step max_devi_e')
+
+    def tearDown(self):
+        shutil.rmtree('select_frames')
+        dpgen.generator.run._c_loadtxt = self.c_loadtxt
+
+    def _ref(self, skip, elo, ehi, flo, fhi) :
+        ret = ([], [], [])
+        for ii in self.md_out :
+            if ii[0] < skip :
+                continue
+            if (ii[1] >= elo and ii[1] < ehi) or (ii[4] >= flo and ii[4] < fhi) :
+                ret[0].append([int(ii[0])])
+            elif ii[1] >= ehi or ii[4] >= fhi :
+                ret[2].append([int(ii[0])])
+            else :
+                ret[1].append([int(ii[0])])
+        return ret
+
+    def test_select(self):
+        self.c_loadtxt = dpgen.generator.run._c_loadtxt
+        for c_loadtxt in [True, False] :
+            dpgen.generator.run._c_loadtxt = c_loadtxt
+            for args in [(0, 1e10, 1e10, 0.05, 0.15), (50, 0.1, 0.2, 0.05, 0.15)] :
+                ret = _select_model_devi_frames('select_frames', *args)
+                for ii, jj in zip(ret, self._ref(*args)) :
+                    self.assertEqual(ii.tolist(), jj)
+            # frame-major, atoms in ascending order
+            candidate, accurate, failed = _select_model_devi_frames('select_frames', 0, 1e10, 1e10, 0.05, 0.15, cluster_cutoff = 1.0)
+            ref = [[int(ii[0]), jj] for ii in self.md_out for jj in range(4) if ii[7+jj] >= 0.05 and ii[7+jj] < 0.15]
+            self.assertEqual(candidate.tolist(), ref)
+            self.assertEqual(len(candidate) + len(accurate) + len(failed), 20 * 4)
+
+    def test_empty(self):
+        self.c_loadtxt = dpgen.generator.run._c_loadtxt
+        for c_loadtxt in [True, False] :
+            dpgen.generator.run._c_loadtxt = c_loadtxt
+            with open(os.path.join('select_frames', 'model_devi.out'), 'w') as fp :
+                fp.write('# step max_devi_e\n')
+            for ii in _select_model_devi_frames('select_frames', 0, 1e10, 1e10, 0.05, 0.15) :
+                self.assertEqual(ii.shape, (0, 1))
+            # a single frame
+            np.savetxt(os.path.join('select_frames', 'model_devi.out'), self.md_out[:1])
+            candidate, _, _ = _select_model_devi_frames('select_frames', 0, 1e10, 1e10, 0.0, 1.0)
+            self.assertEqual(candidate.tolist(), [[0]])
+
+
+class TestModelDeviCache(unittest.TestCase):
+    def setUp(self):
+        if os.path.isdir('iter.000000') :
+            shutil.rmtree('iter.000000')
+        with open (param_pwscf_file, 'r') as fp :
+            self.jdata = json.load (fp)
+        md_descript = []
+        for ii in range(2) :
+            md_descript.append([np.random.uniform(0, 0.29, 10) for jj in range(3)])
+        _make_fake_md(0, md_descript, [0, 1, 2, 2, 0, 1], self.jdata['type_map'])
+        self.fp_path = os.path.join('iter.000000', '02.fp')
+        self.modd_path = os.path.join('iter.000000', '01.model_devi')
+
+    def tearDown(self):
+        shutil.rmtree('iter.000000')
+
+    def _make_fp(self):
+        if os.path.isdir(self.fp_path) :
+            shutil.rmtree(self.fp_path)
+        random.seed(1)
+        make_fp_pwscf(0, self.jdata)
+        ret = {}
+        for ii in glob.glob(os.path.join(self.fp_path, '*.shuffled.*.out')) :
+            with open(ii) as fp :
+                ret[os.path.basename(ii)] = fp.read()
+        for ii in glob.glob(os.path.join(self.fp_path, 'task.*')) :
+            ret[os.path.basename(ii)] = os.readlink(os.path.join(ii, 'conf.dump'))
+        return ret
+
+    def test_cache(self):
+        ref = self._make_fp()
+        post_model_devi(0, self.jdata, {})
+        sys_task = sorted(glob.glob(os.path.join(self.modd_path, 'task.000.*')))
+        cache = _load_model_devi_cache(self.modd_path, '000', sys_task)
+        self.assertEqual(cache.shape[0], 30)
+        self.assertEqual(cache[:,0].tolist(), [ii // 10 for ii in range(30)])
+        md_out = np.loadtxt(os.path.join(sys_task[1], 'model_devi.out'))
+        np.testing.assert_equal(cache[10:20,1:], md_out)
+        # same fp tasks and the same shuffled frames
+        self.assertEqual(self._make_fp(), ref)
+
+    def test_stale(self):
+        post_model_devi(0, self.jdata, {})
+        sys_task = sorted(glob.glob(os.path.join(self.modd_path, 'task.001.*')))
+        self.assertTrue(_load_model_devi_cache(self.modd_path, '001', sys_task) is not None)
+        # the tasks differ
+        self.assertTrue(_load_model_devi_cache(self.modd_path, '001', sys_task[:2]) is None)
+        # a model_devi.out newer than the cache
+        fname = os.path.join(sys_task[0], 'model_devi.out')
+        mtime = os.path.getmtime(os.path.join(self.modd_path, 'model_devi.001.npy'))
+        os.utime(fname, (mtime + 10, mtime + 10))
+        self.assertTrue(_load_model_devi_cache(self.modd_path, '001', sys_task) is None)
+
+    def test_truncated_index(self):
+        post_model_devi(0, self.jdata, {})
+        index_file = os.path.join(self.modd_path, 'model_devi.cache.json')
+        # written at once, no temporary file is left
+        self.assertFalse(os.path.isfile(index_file + '.tmp'))
+        with open(index_file) as fp:
+            content = fp.read()
+        with open(index_file, 'w') as fp:
+            fp.write(content[:len(content) // 2])
+        sys_task = sorted(glob.glob(os.path.join(self.modd_path, 'task.001.*')))
+        self.assertTrue(_load_model_devi_cache(self.modd_path, '001', sys_task) is None)
+
+
+class FakeDispatcher(object):
+    """
+    calls the callback for each chunk at once, records the tasks of each run
+    """
+    def __init__ (self):
+        self.runs = []
+
+    def run_jobs(self, resources, command, work_path, tasks, group_size, *args, callback = None, **kwargs):
+        self.runs.append(list(tasks))
+        if callback is not None:
+            for ii in range(0, len(tasks), group_size):
+                callback(tasks[ii:ii+group_size])
+
+
+class TestModelDeviFpPipeline(unittest.TestCase):
+    def setUp(self):
+        if os.path.isdir('iter.000000') :
+            shutil.rmtree('iter.000000')
+        with open (param_pwscf_file, 'r') as fp :
+            self.jdata = json.load (fp)
+        self.jdata['fp_task_max'] = 5
+        md_descript = []
+        for ii in range(2) :
+            md_descript.append([np.arange(0, 0.29, 0.29/10) for jj in range(3)])
+        _make_fake_md(0, md_descript, [0, 1, 2, 2, 0, 1], self.jdata['type_map'])
+        with open(os.path.join('iter.000000', '01.model_devi', 'cur_job.json'), 'w') as fp:
+            json.dump({'ens': 'nvt', 'nsteps': 90, 'trj_freq': 10, 'temps': [100]}, fp)
+        self.mdata = {'lmp_command': 'lmp', 'model_devi_group_size': 2, 'model_devi_resources': {},
+                      'fp_command': 'pw.x', 'fp_group_size': 1, 'fp_resources': {}}
+
+    def tearDown(self):
+        shutil.rmtree('iter.000000')
+
+    def test_pipeline(self):
+        md_disp = FakeDispatcher()
+        fp_disp = FakeDispatcher()
+        run_model_devi_fp(0, self.jdata, self.mdata, md_disp, fp_disp)
+        fp_path = os.path.join('iter.000000', '02.fp')
+        fp_tasks = sorted([os.path.basename(ii) for ii in glob.glob(os.path.join(fp_path, 'task.*'))])
+        # fp_task_max of each system is shared by its model devi tasks
+        self.assertEqual(fp_tasks, ['task.%03d.%06d' % (ii, jj) for ii in range(2) for jj in range(5)])
+        # the fp tasks of each model devi chunk are run once
+        self.assertEqual(len(fp_disp.runs), 3)
+        self.assertEqual(sorted(sum(fp_disp.runs, [])), fp_tasks)
+        for ii in fp_tasks:
+            self.assertTrue(os.path.isfile(os.path.join(fp_path, ii, 'input')))
+        _check_sel(self, 0, self.jdata['fp_task_max'], self.jdata['model_devi_f_trust_lo'], self.jdata['model_devi_f_trust_hi'])
+        _check_poscars(self, 0, self.jdata['fp_task_max'], self.jdata['type_map'])
+        # restart: no new fp task, the recorded ones are recovered
+        run_model_devi_fp(0, self.jdata, self.mdata, md_disp, FakeDispatcher())
+        self.assertEqual(sorted([os.path.basename(ii) for ii in glob.glob(os.path.join(fp_path, 'task.*'))]), fp_tasks)
+        with open(os.path.join(fp_path, 'pipeline.json')) as fp:
+            state = json.load(fp)
+        self.assertEqual(len(state['processed']), 6)
+        self.assertEqual(state['quota'], {'000': 0, '001': 0})
+
+    def test_pipeline_interrupted(self):
+        fp_path = os.path.join('iter.000000', '02.fp')
+        modd_path = os.path.join('iter.000000', '01.model_devi')
+        modd_tasks = sorted(glob.glob(os.path.join(modd_path, 'task.*')))
+        state = _load_fp_pipeline(fp_path, modd_path, self.jdata)
+        with open(os.path.join(fp_path, 'pipeline.json')) as fp:
+            saved = fp.read()
+        _make_fp_pipeline_tasks(0, self.jdata, self.mdata, modd_tasks[:1], state)
+        shuffled = {}
+        for ii in glob.glob(os.path.join(fp_path, '*.shuffled.*.out')):
+            with open(ii) as fp:
+                shuffled[ii] = sorted(fp.read().split('\n'))
+        self.assertTrue(len(shuffled) > 0)
+        # interrupted before the state is dumped
+        with open(os.path.join(fp_path, 'pipeline.json'), 'w') as fp:
+            fp.write(saved)
+        state = _load_fp_pipeline(fp_path, modd_path, self.jdata)
+        _make_fp_pipeline_tasks(0, self.jdata, self.mdata, modd_tasks[:1], state)
+        # the frames are not appended twice
+        for ii in shuffled:
+            with open(ii) as fp:
+                self.assertEqual(sorted(fp.read().split('\n')), shuffled[ii])
+        self.assertEqual(state['processed'], [os.path.basename(modd_tasks[0])])
+
+
 if __name__ == '__main__':
     unittest.main()
 
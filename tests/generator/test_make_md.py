@@ -6,6 +6,9 @@ import unittest
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 __package__ = 'generator'
 from .context import make_model_devi
+from .context import _model_devi_task_cost
+from .context import _fp_task_cost
+from .context import make_lammps_input
 from .context import parse_cur_job
 from .context import param_file
 from .context import machine_file
@@ -139,5 +142,26 @@ class TestMakeModelDevi(unittest.TestCase):
         shutil.rmtree('iter.000000')
 
 
+class TestTaskCost(unittest.TestCase):
+    def setUp(self) :
+        os.makedirs('task_cost', exist_ok = True)
+
+    def tearDown(self) :
+        shutil.rmtree('task_cost')
+
+    def test_model_devi_task_cost (self) :
+        with open(os.path.join('task_cost', 'conf.lmp'), 'w') as fp :
+            fp.write('\n6 atoms\n2 atom types\n')
+        file_c = make_lammps_input('npt', 'conf.lmp', ['../graph.000.pb'], 1000, 0.002, None, 10, [27, 24], 300, {},
+                                   pres = 1.0, deepmd_version = '1')
+        with open(os.path.join('task_cost', 'input.lammps'), 'w') as fp :
+            fp.write(file_c)
+        self.assertEqual(_model_devi_task_cost('task_cost'), 6 * 1000)
+
+    def test_fp_task_cost (self) :
+        with open(os.path.join('task_cost', 'POSCAR'), 'w') as fp :
+            fp.write('Mg Al\n1.0\n1 0 0\n0 1 0\n0 0 1\nMg Al\n2 3\nCartesian\n')
+        self.assertEqual(_fp_task_cost('task_cost'), 5 ** 3)
+
 if __name__ == '__main__':
     unittest.main()
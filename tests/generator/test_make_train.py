@@ -1,15 +1,19 @@
 #!/usr/bin/env python3
 
 import os,sys,json,glob,shutil
+import dpdata
 import numpy as np
 import unittest
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 __package__ = 'generator'
 from .context import make_train
+from .context import run_train
+from .context import post_train
 from .context import param_file
 from .context import machine_file
 from .context import setUpModule
+from dpgen.generator.run import _training_reuse, _reuse_train_param
 
 def _comp_sys_files (sys0, sys1) :
     pwd = os.getcwd()
@@ -161,5 +165,237 @@ class TestMakeTrain(unittest.TestCase):
         shutil.rmtree('iter.000000')
         
 
+class FakeTrainDispatcher(object):
+    """
+    makes the backward files of the tasks, calls the callback for each chunk
+    """
+    def __init__ (self):
+        self.runs = []
+
+    def run_jobs(self, resources, command, work_path, tasks, group_size,
+                 forward_common_files, forward_task_files, backward_task_files, *args, callback = None, **kwargs):
+        self.runs.append((command, work_path, list(tasks), list(forward_task_files), list(backward_task_files)))
+        for ii in tasks :
+            for jj in backward_task_files :
+                with open(os.path.join(work_path, ii, jj), 'w') as fp :
+                    fp.write('')
+        if callback is not None:
+            for ii in range(0, len(tasks), group_size):
+                callback(tasks[ii:ii+group_size])
+
+
+class TestRunTrainAsyncPost(unittest.TestCase):
+    def setUp(self) :
+        with open (param_file, 'r') as fp :
+            self.jdata = json.load (fp)
+        with open (machine_file, 'r') as fp:
+            self.mdata = json.load (fp)
+        make_train(0, self.jdata, self.mdata)
+        self.mdata['deepmd_version'] = '1.2'
+        self.mdata['python_path'] = 'python3'
+        self.mdata['train_resources'] = {}
+        self.jdata['train_async_post'] = True
+        self.jdata['dp_compress'] = True
+
+    def tearDown(self) :
+        shutil.rmtree('iter.000000')
+
+    def test_run(self) :
+        disp = FakeTrainDispatcher()
+        run_train(0, self.jdata, self.mdata, disp)
+        numb_models = self.jdata['numb_models']
+        self.assertEqual(len(disp.runs), numb_models + 1)
+        # the training job does not freeze the models
+        self.assertEqual(disp.runs[0][0], ['python3 -m deepmd train input.json'])
+        self.assertFalse('frozen_model.pb' in disp.runs[0][4])
+        self.assertTrue('checkpoint' in disp.runs[0][4])
+        post_runs = sorted(disp.runs[1:], key = lambda x : x[1])
+        for ii in range(numb_models) :
+            command, work_path, tasks, forward_files, backward_files = post_runs[ii]
+            self.assertEqual(command, ['python3 -m deepmd freeze',
+                                       'python3 -m deepmd compress input.json -i frozen_model.pb -o frozen_model_compressed.pb'])
+            self.assertEqual(work_path, os.path.abspath(os.path.join('iter.000000', '00.train', '%03d' % ii)))
+            self.assertEqual(tasks, ['.'])
+            self.assertTrue('checkpoint' in forward_files)
+            self.assertEqual(backward_files, ['frozen_model.pb', 'frozen_model_compressed.pb'])
+        post_train(0, self.jdata, self.mdata)
+        for ii in range(numb_models) :
+            self.assertEqual(os.readlink(os.path.join('iter.000000', '00.train', 'graph.%03d.pb' % ii)),
+                             os.path.join('%03d' % ii, 'frozen_model_compressed.pb'))
+
+    def test_sync(self) :
+        self.jdata['train_async_post'] = False
+        disp = FakeTrainDispatcher()
+        run_train(0, self.jdata, self.mdata, disp)
+        self.assertEqual(len(disp.runs), 1)
+        self.assertEqual(len(disp.runs[0][0]), 3)
+        self.assertTrue(os.path.isfile(os.path.join('iter.000000', '00.train', '000', 'frozen_model_compressed.pb')))
+
+
+class TestTrainingReuse(unittest.TestCase):
+    def setUp(self) :
+        with open (param_file, 'r') as fp :
+            self.jdata = json.load (fp)
+        with open (machine_file, 'r') as fp:
+            self.mdata = json.load (fp)
+        self.mdata['deepmd_version'] = '1.2'
+        self.mdata['python_path'] = 'python3'
+        self.mdata['train_resources'] = {}
+        self.jdata['default_training_param'] = {
+            'model': {'descriptor': {}, 'fitting_net': {}},
+            'learning_rate': {'start_lr': 1e-3, 'decay_steps': 2000},
+            'loss': {'start_pref_e': 0.02, 'start_pref_f': 1000},
+            'training': {'stop_batch': 400000}}
+        self.jdata['training_reuse_iter'] = 1
+        make_train(0, self.jdata, self.mdata)
+        for ii in range(self.jdata['numb_models']) :
+            for jj in ['model.ckpt.index', 'model.ckpt.meta', 'model.ckpt.data-00000-of-00001', 'checkpoint'] :
+                with open(os.path.join('iter.000000', '00.train', '%03d' % ii, jj), 'w') as fp :
+                    fp.write('')
+        _make_fake_fp(0, 0, self.jdata['fp_task_min'])
+
+    def tearDown(self) :
+        for ii in glob.glob('iter.*') :
+            shutil.rmtree(ii)
+
+    def _load_input(self, iter_idx) :
+        with open(os.path.join('iter.%06d' % iter_idx, '00.train', '000', 'input.json')) as fp :
+            return json.load(fp)
+
+    def test_reuse(self) :
+        # trained from scratch, the checkpoints are downloaded for the next iteration
+        disp = FakeTrainDispatcher()
+        run_train(0, self.jdata, self.mdata, disp)
+        self.assertEqual(disp.runs[0][0][0], 'python3 -m deepmd train input.json')
+        self.assertTrue('model.ckpt.index' in disp.runs[0][4])
+        self.assertEqual(self._load_input(0)['training']['stop_batch'], 400000)
+        make_train(1, self.jdata, self.mdata)
+        jinput = self._load_input(1)
+        self.assertEqual(jinput['training']['stop_batch'], 80000)
+        self.assertEqual(jinput['learning_rate'], {'start_lr': 1e-4, 'decay_steps': 400})
+        self.assertEqual(jinput['loss'], {'start_pref_e': 0.1, 'start_pref_f': 100})
+        self.assertTrue(os.path.islink(os.path.join('iter.000001', '00.train', '000', 'old', 'model.ckpt.index')))
+        # the default param is not changed
+        self.assertEqual(self.jdata['default_training_param']['training']['stop_batch'], 400000)
+        disp = FakeTrainDispatcher()
+        run_train(1, self.jdata, self.mdata, disp)
+        self.assertTrue('--init-model old/model.ckpt' in disp.runs[0][0][0])
+        self.assertTrue('--restart model.ckpt' in disp.runs[0][0][0])
+        self.assertTrue(os.path.join('old', 'model.ckpt.index') in disp.runs[0][3])
+
+    def test_job_settings(self) :
+        self.jdata['model_devi_jobs'][0]['training_reuse'] = {'numb_steps': 1000, 'start_lr': 5e-4}
+        make_train(1, self.jdata, self.mdata)
+        jinput = self._load_input(1)
+        self.assertEqual(jinput['training']['stop_batch'], 1000)
+        self.assertEqual(jinput['learning_rate']['start_lr'], 5e-4)
+        shutil.rmtree('iter.000001')
+        # not reused for this iteration
+        self.jdata['model_devi_jobs'][0]['training_reuse'] = False
+        make_train(1, self.jdata, self.mdata)
+        self.assertEqual(self._load_input(1)['training']['stop_batch'], 400000)
+        disp = FakeTrainDispatcher()
+        run_train(1, self.jdata, self.mdata, disp)
+        self.assertEqual(disp.runs[0][0][0], 'python3 -m deepmd train input.json')
+
+    def test_param_layouts(self) :
+        settings = _training_reuse(1, self.jdata)
+        # the sections left out
+        jinput = _reuse_train_param({'model': {}, 'training': {'numb_steps': 1000}}, settings)
+        self.assertEqual(jinput['training']['numb_steps'], 200)
+        self.assertEqual(jinput['learning_rate'], {'start_lr': 1e-4})
+        self.assertEqual(jinput['loss'], {'start_pref_e': 0.1, 'start_pref_f': 100})
+        # the flat layout of 0.x
+        jinput = _reuse_train_param({'stop_batch': 1000, 'start_lr': 1e-3, 'decay_steps': 100}, settings, '0.12')
+        self.assertEqual(jinput, {'stop_batch': 200, 'start_lr': 1e-4, 'decay_steps': 20,
+                                  'start_pref_e': 0.1, 'start_pref_f': 100})
+        with self.assertRaises(RuntimeError) :
+            _reuse_train_param({}, settings, '0.12')
+
+
+class TestCompressCheck(unittest.TestCase):
+    def setUp(self) :
+        with open (param_file, 'r') as fp :
+            self.jdata = json.load (fp)
+        with open (machine_file, 'r') as fp:
+            self.mdata = json.load (fp)
+        self.jdata['dp_compress'] = True
+        self.jdata['dp_compress_check'] = {'nframes': 2, 'lmp_steps': 10}
+        make_train(0, self.jdata, self.mdata)
+        self.mdata['deepmd_version'] = '1.2'
+        self.mdata['python_path'] = 'python3'
+        self.mdata['train_resources'] = {}
+
+    def tearDown(self) :
+        shutil.rmtree('iter.000000')
+
+    def _write_check(self, task_path, name, f_shift, loop_time) :
+        with open(os.path.join(task_path, 'check_%s.000.e.out' % name), 'w') as fp :
+            fp.write('1.0 2.0\n1.0 3.0\n')
+        with open(os.path.join(task_path, 'check_%s.000.f.out' % name), 'w') as fp :
+            fp.write('0 0 0 0.1 0.2 %f\n' % (0.3 + f_shift))
+        with open(os.path.join(task_path, 'check_%s.lammps.log' % name), 'w') as fp :
+            fp.write('Loop time of %f on 1 procs for 10 steps with 4 atoms\n' % loop_time)
+
+    def test_check(self) :
+        work_path = os.path.join('iter.000000', '00.train')
+        numb_models = self.jdata['numb_models']
+        train = dpdata.LabeledSystem(os.path.join(self.jdata['init_data_prefix'], self.jdata['init_data_sys'][0]), fmt = 'deepmd/npy')
+        for ii in range(numb_models) :
+            check = dpdata.LabeledSystem(os.path.join(work_path, '%03d' % ii, 'check', 'sys.000'), fmt = 'deepmd/npy')
+            self.assertEqual(check.get_nframes(), 2)
+            # perturbed, not the training frames
+            disp = np.abs(check['coords'] - train['coords'][-2:])
+            self.assertTrue(np.max(disp) <= 0.05 and np.max(disp) > 0)
+            with open(os.path.join(work_path, '%03d' % ii, 'check', 'in.lammps')) as fp :
+                lmp_input = fp.read()
+            # one mass for each atom type of the conf
+            self.assertEqual(lmp_input.count('mass '), 2)
+            with open(os.path.join(work_path, '%03d' % ii, 'check', 'conf.lmp')) as fp :
+                self.assertTrue('2 atom types' in fp.read())
+        disp = FakeTrainDispatcher()
+        run_train(0, self.jdata, self.mdata, disp)
+        command, _, _, forward_files, backward_files = disp.runs[0]
+        self.assertTrue('{ python3 -m deepmd test -m frozen_model_compressed.pb -s check/sys.000 -n 2 -d check_compressed.000 '
+                        '1> check_compressed.000.log 2>&1 || echo "check failed with exit code $?" >> check_compressed.000.log; '
+                        'touch check_compressed.000.e.out check_compressed.000.f.out; }' in command)
+        self.assertTrue(any(['lmp_mpi_010 -i check/in.lammps' in ii for ii in command]))
+        self.assertTrue(os.path.join('check', 'sys.000', 'type.raw') in forward_files)
+        self.assertTrue('check_raw.000.f.out' in backward_files)
+        self.assertTrue('check_raw.000.log' in backward_files)
+        # within the tolerances, beyond them, and no output of the check
+        for ii in range(numb_models) :
+            task_path = os.path.join(work_path, '%03d' % ii)
+            for jj in ['frozen_model.pb', 'frozen_model_compressed.pb'] :
+                with open(os.path.join(task_path, jj), 'w') as fp :
+                    fp.write(jj)
+            if ii < 2 :
+                self._write_check(task_path, 'raw', 0, 2.)
+                self._write_check(task_path, 'compressed', [1e-4, 0.1][ii], 1.)
+            elif ii == 2 :
+                # dp test failed: empty outputs and the error in the log
+                self._write_check(task_path, 'raw', 0, 2.)
+                for jj in ['e', 'f'] :
+                    open(os.path.join(task_path, 'check_compressed.000.%s.out' % jj), 'w').close()
+                with open(os.path.join(task_path, 'check_compressed.000.log'), 'w') as fp :
+                    fp.write('RuntimeError: bad model\ncheck failed with exit code 1\n')
+        post_train(0, self.jdata, self.mdata)
+        for ii in range(numb_models) :
+            with open(os.path.join(work_path, 'graph.%03d.pb' % ii)) as fp :
+                self.assertEqual(fp.read(), 'frozen_model_compressed.pb' if ii == 0 else 'frozen_model.pb')
+        with open(os.path.join(work_path, 'compress.json')) as fp :
+            summary = json.load(fp)
+        self.assertAlmostEqual(summary['000']['f_dev'], 1e-4)
+        self.assertAlmostEqual(summary['000']['e_dev'], 0.)
+        self.assertEqual(summary['000']['raw_time'], 2.)
+        self.assertFalse(summary['001']['passed'])
+        self.assertEqual(summary['002']['e_dev'], None)
+        self.assertEqual(summary['000']['errors'], [])
+        self.assertTrue(any(['check failed with exit code 1' in ii for ii in summary['002']['errors']]))
+        # no output at all
+        self.assertFalse(summary['003']['passed'])
+        self.assertTrue(len(summary['003']['errors']) > 0)
+
+
 if __name__ == '__main__':
     unittest.main()